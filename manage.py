@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Maintenance commands, to be run from cron or by hand::
+
+    ./manage.py archive [--days N]
+    ./manage.py bankdir SOURCE.csv
+    ./manage.py export [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--format csv|jsonl]
+    ./manage.py loadtest URL [--quotes N] [--rate R] [--concurrency C]
+    ./manage.py reconcile STATEMENT [--format camt053|csv]
+    ./manage.py release-quotes
+    ./manage.py retry-worker
+    ./manage.py stats [--rebuild]
+    ./manage.py traces [FILE]
+    ./manage.py upgrade-db
+"""
+
+import argparse
+from decimal import Decimal
+import sys
+import confcollect
+from ripple.sepa import create_app
+from ripple.sepa import bankdir
+from ripple.sepa.export import FORMATS, export_tickets, parse_date
+from ripple.sepa import loadtest as lt
+from ripple.sepa.model import db, Ticket, LimitBudget, upgrade_schema
+from ripple.sepa.reconcile import parse_camt053, parse_csv, reconcile
+from ripple.sepa.retry import RetryScheduler
+from ripple.sepa import stats
+from ripple.sepa import tracing
+
+
+def archive(app, args):
+    """Move finished tickets out of the live table."""
+    days = args.days if args.days is not None \
+        else app.config['ARCHIVE_AFTER_DAYS']
+    moved = Ticket.archive_finished(days)
+    print('Archived %s tickets older than %s days' % (moved, days))
+
+
+def build_bank_directory(app, args):
+    """Build the bank directory from a CSV file."""
+    path = app.config['BANK_DIRECTORY']
+    if not path:
+        sys.exit('BANK_DIRECTORY is not configured')
+    with open(args.source, newline='', encoding='utf-8') as f:
+        count = bankdir.build(bankdir.read_csv(f), path)
+    print('Wrote %s banks to %s; restart the bridge to use them' % (
+        count, path))
+
+
+def export(app, args):
+    """Write tickets created in a date range to stdout."""
+    render = FORMATS[args.format][0]
+    with db.replica():
+        rows = export_tickets(parse_date(args.start), parse_date(args.end))
+        for chunk in render(rows):
+            sys.stdout.write(chunk)
+
+
+def loadtest(app, args):
+    """Replay payment notifications against a running bridge."""
+    stub = lt.SepaStub(args.stub_port, args.sepa_latency)
+    stub.start()
+
+    url = args.url.rstrip('/')
+    quotes, errors = lt.create_quotes(url, args.quotes, args.amount)
+    if errors.get('disabled'):
+        print('Quoting is disabled, creating tickets directly')
+        quotes = lt.seed_quotes(app, args.quotes, args.amount)
+    elif errors:
+        print('Quotes refused: %s' % dict(errors))
+
+    sends, expected = lt.plan(
+        quotes, duplicates=args.duplicates, wrong_amount=args.wrong_amount,
+        unknown=args.unknown, seed=args.seed)
+    elapsed, results = lt.replay(url, sends, args.rate, args.concurrency)
+
+    db.session.expire_all()
+    problems = lt.check(expected, stub.submissions)
+    lt.report(elapsed, results, problems, print)
+    if problems:
+        sys.exit(1)
+
+
+def reconcile_statement(app, args):
+    """Confirm sent tickets found in a bank statement."""
+    fmt = args.format or ('csv' if args.statement.endswith('.csv') else 'camt053')
+    def report(reference, amount, reason):
+        print('Unmatched: %s %s (%s)' % (reference, amount, reason))
+
+    if fmt == 'csv':
+        with open(args.statement, newline='') as f:
+            counts = reconcile(parse_csv(f), on_unmatched=report)
+    else:
+        with open(args.statement, 'rb') as f:
+            counts = reconcile(parse_camt053(f), on_unmatched=report)
+    print('%(matched)s tickets confirmed, %(unmatched)s entries unmatched' % counts)
+
+
+def release_quotes(app, args):
+    """Release the budgets of expired quotes, clear old ones."""
+    released = 0
+    while True:
+        batch = LimitBudget.release_expired()
+        if not batch:
+            break
+        released += batch
+    print('Released %s expired quotes' % released)
+    cleared = Ticket.clear_expired(app.config['EXPIRED_QUOTE_DAYS'])
+    print('Cleared %s quotes expired over %s days ago' % (
+        cleared, app.config['EXPIRED_QUOTE_DAYS']))
+
+
+def retry_worker(app, args):
+    """Keep resubmitting transfers the SEPA backend did not accept."""
+    RetryScheduler(app).run_forever()
+
+
+def update_stats(app, args):
+    """Bring the ticket statistics up to date."""
+    hours = stats.rebuild() if args.rebuild else stats.refresh()
+    print('Recomputed statistics for %s hours' % hours)
+
+
+def traces(app, args):
+    """Summarize request latency by endpoint from the trace file."""
+    path = args.file or app.config['TRACE_FILE']
+    if not path:
+        sys.exit('TRACE_FILE is not configured')
+    with open(path) as f:
+        samples = tracing.load_samples(f)
+    for endpoint, endpoint_samples in sorted(samples.items()):
+        stats = tracing.breakdown(endpoint_samples)
+        print('%s: %s requests, p50 %.1fms, p90 %.1fms, p99 %.1fms, '
+              'max %.1fms' % (endpoint, stats['count'], stats['p50'] * 1000,
+                              stats['p90'] * 1000, stats['p99'] * 1000,
+                              stats['max'] * 1000))
+        for name, seconds in sorted(stats['tail'].items(),
+                                    key=lambda i: -i[1]):
+            print('    %s: %.1fms' % (name, seconds * 1000))
+
+
+def upgrade_db(app, args):
+    """Add columns new versions introduced to existing tables."""
+    changes = upgrade_schema(db.get_engine(app))
+    for change in changes:
+        print(change)
+    print('Schema is up to date' if not changes else
+          'Made %s changes' % len(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('archive', help=archive.__doc__)
+    p.add_argument('--days', type=int)
+    p.set_defaults(func=archive)
+
+    p = commands.add_parser('bankdir', help=build_bank_directory.__doc__)
+    p.add_argument('source')
+    p.set_defaults(func=build_bank_directory)
+
+    p = commands.add_parser('export', help=export.__doc__)
+    p.add_argument('--start')
+    p.add_argument('--end')
+    p.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser('loadtest', help=loadtest.__doc__)
+    p.add_argument('url')
+    p.add_argument('--quotes', type=int, default=100)
+    p.add_argument('--amount', type=Decimal, default=Decimal('1.00'))
+    p.add_argument('--rate', type=float, default=20,
+                   help='notifications per second')
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--duplicates', type=float, default=0.1)
+    p.add_argument('--wrong-amount', type=float, default=0.05)
+    p.add_argument('--unknown', type=float, default=0.05)
+    p.add_argument('--seed', type=int)
+    p.add_argument('--stub-port', type=int, default=8099)
+    p.add_argument('--sepa-latency', type=float, default=0.05,
+                   help='seconds the stub SEPA backend takes')
+    p.set_defaults(func=loadtest)
+
+    p = commands.add_parser('reconcile', help=reconcile_statement.__doc__)
+    p.add_argument('statement')
+    p.add_argument('--format', choices=('camt053', 'csv'))
+    p.set_defaults(func=reconcile_statement)
+
+    p = commands.add_parser('release-quotes', help=release_quotes.__doc__)
+    p.set_defaults(func=release_quotes)
+
+    p = commands.add_parser('retry-worker', help=retry_worker.__doc__)
+    p.set_defaults(func=retry_worker)
+
+    p = commands.add_parser('stats', help=update_stats.__doc__)
+    p.add_argument('--rebuild', action='store_true')
+    p.set_defaults(func=update_stats)
+
+    p = commands.add_parser('traces', help=traces.__doc__)
+    p.add_argument('file', nargs='?')
+    p.set_defaults(func=traces)
+
+    p = commands.add_parser('upgrade-db', help=upgrade_db.__doc__)
+    p.set_defaults(func=upgrade_db)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        parser.error('no command given')
+
+    try:
+        config = confcollect.from_module('config', silent=False)
+    except ImportError:
+        config = {}
+    app = create_app(config=config)
+    with app.app_context():
+        args.func(app, args)
+
+
+if __name__ == '__main__':
+    main()
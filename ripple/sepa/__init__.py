@@ -1,12 +1,26 @@
 from decimal import Decimal
+import os
 import confcollect
 from flask import Flask
 from flask.ext.sslify import SSLify
+from jinja2 import FileSystemBytecodeCache
 import logbook
+from sqlalchemy.engine.url import make_url
 from .model import db
 from .admin import admin
 from .bridge import bridge
-from .utils import timesince
+from . import events, liquidity, logs, slowlog, tracing
+from .fees import FeeSchedule
+from .admission import AdmissionController
+from .screening import Screening
+from .bankdir import BankDirectory
+from .trustlines import TrustlineSnapshot
+from .rates import RateFeed
+from .assets import Assets
+from .utils import timesince, bridge_addresses
+
+
+log = logbook.Logger(__name__)
 
 
 CONFIG_DEFAULTS = {
@@ -16,16 +30,56 @@ CONFIG_DEFAULTS = {
     'PGPASSWORD': None,
     'PGDATABASE': None,
     'DB_PORT_5432_TCP_ADDR': None,
+    # Optional read replica. Reporting and listing views will read from
+    # it; anything that moves money stays on the primary. Either give
+    # a full url, or a host that shares the PG* credentials above.
+    'REPLICA_DATABASE_URI': None,
+    'PGREPLICAHOST': None,
+
+    # Refuse all new quotes; payments for existing tickets are still
+    # processed.
+    'QUOTES_DISABLED': True,
 
     # Fixed fee to charge for every transaction.
     'FIXED_FEE': Decimal('1.50'),
     # Additional fee based on percentage of transfer amount
     'VOLUME_FEE': Decimal('5'),
+    # Optional pricing rules by amount band, IBAN country and time of
+    # day, replacing the two fees above where they apply. See
+    # :class:`ripple.sepa.fees.FeeSchedule` for the format.
+    'FEE_SCHEDULE': [],
+    # CSV file with the ``name`` and ``iban`` of sanctioned parties; no
+    # quotes are given for transfers to them. Names match if similar by
+    # at least MATCH_THRESHOLD (0-1). The file is reloaded when it
+    # changes, checking every CHECK_INTERVAL seconds.
+    'SANCTIONS_LIST': None,
+    'SANCTIONS_MATCH_THRESHOLD': 0.85,
+    'SANCTIONS_CHECK_INTERVAL': 60,
+    # Bank directory built by ``manage.py bankdir``, used to fill in
+    # the BIC for an IBAN, and to refuse quotes where they disagree.
+    'BANK_DIRECTORY': None,
     # Limits daily, and for individual transactions
     'USER_TX_LIMIT': Decimal(100),
     'BRIDGE_TX_LIMIT': Decimal(500),
+    # File with the EUR balance available at the bank. If set, quotes
+    # are only given while the balance covers them on top of the open
+    # quotes and the paid tickets not yet sent; this is recounted every
+    # SYNC_INTERVAL seconds. The SEPA backend can report the balance to
+    # /on_balance.
+    'LIQUIDITY_BALANCE_FILE': None,
+    'LIQUIDITY_SYNC_INTERVAL': 30,
+    # Stop giving out quotes while this many paid transfers are waiting
+    # for the SEPA backend, or while the oldest one is this many seconds
+    # old. The backlog is measured at most every CHECK_INTERVAL seconds.
+    'BACKLOG_MAX_DEPTH': None,
+    'BACKLOG_MAX_AGE': None,
+    'BACKLOG_CHECK_INTERVAL': 10,
     # Ask client to pay to this address
     'BRIDGE_ADDRESS': None,
+    # Optionally, further accounts to spread incoming payments over.
+    # Each quote is assigned one of these or BRIDGE_ADDRESS, and
+    # payments to any of them are accepted.
+    'BRIDGE_ADDRESSES': [],
     # Ask client to pay EUR of one of these issuers. Due to
     # https://ripplelabs.atlassian.net/browse/WC-1855 only the first
     # issuer will actually be considered by the client.
@@ -33,9 +87,35 @@ CONFIG_DEFAULTS = {
     # If you leave this empty the bridge responds in such a way that
     # any currency accepted by the bridge account is considered.
     'ACCEPTED_ISSUERS': [],
+    # JSON-RPC URL of a rippled server. If set, and no ACCEPTED_ISSUERS
+    # are given, the issuers the bridge accounts trust are fetched from
+    # it every REFRESH_INTERVAL seconds and named in quotes instead.
+    'RIPPLED_URL': None,
+    'TRUSTLINE_REFRESH_INTERVAL': 300,
+    # Exchange rate feed; if set, quotes may also be paid in XRP and the
+    # other currencies it lists. See :mod:`ripple.sepa.rates` for the
+    # format. Rates older than MAX_AGE seconds are not used.
+    'RATES_URL': None,
+    'RATES_REFRESH_INTERVAL': 60,
+    'RATES_MAX_AGE': 300,
     # URL of the SEPA service to call
     'SEPA_API': None,
     'SEPA_API_AUTH': None,
+    # Seconds to wait for a connection to the SEPA service, and then for
+    # its response. A transfer whose response does not arrive in time
+    # may have been accepted, and is left for manual review.
+    'SEPA_API_CONNECT_TIMEOUT': 5,
+    'SEPA_API_TIMEOUT': 30,
+    # Submissions the SEPA service did not accept are retried by
+    # ``manage.py retry-worker``, at most CONCURRENCY at once, with
+    # exponential backoff (in seconds) until MAX_ATTEMPTS is reached.
+    'RETRY_CONCURRENCY': 4,
+    'RETRY_BASE_DELAY': 30,
+    'RETRY_MAX_DELAY': 3600,
+    'RETRY_MAX_ATTEMPTS': 20,
+    # Authorization header the SEPA service has to send when reporting
+    # status changes to /on_status. The endpoint is disabled if unset.
+    'SEPA_CALLBACK_AUTH': None,
     # The postmark API config; the bridge will notify you if it receives
     # transactions that it cannot process.
     'POSTMARK_KEY': None,
@@ -47,9 +127,49 @@ CONFIG_DEFAULTS = {
     'USE_HTTPS': True,
     # URL for sentry error reporting
     'SENTRY_DSN': None,
+    # Finished tickets older than this many days are moved to the
+    # archive table by ``manage.py archive``.
+    'ARCHIVE_AFTER_DAYS': 30,
+    # Quotes paid this many days after they expired are still sent;
+    # after that, ``manage.py release-quotes`` clears their recipient
+    # data, and they are archived like finished tickets.
+    'EXPIRED_QUOTE_DAYS': 7,
+    # /events answers with the current status of the tickets asked for,
+    # and the browser asks again after POLL_INTERVAL seconds. With
+    # STREAM_TIMEOUT, it also keeps streaming changes for that many
+    # seconds; each open stream occupies a worker thread, so only do
+    # this with threaded or async workers serving /events.
+    'EVENTS_POLL_INTERVAL': 10,
+    'EVENTS_STREAM_TIMEOUT': 0,
+    # Most tickets one /events request may ask for.
+    'EVENTS_MAX_TICKETS': 50,
+    # Compiled templates are kept here, so that new worker processes do
+    # not have to compile them again. Anyone who can write there can
+    # have code run by the bridge; give a directory only it can write
+    # to. Defaults to Jinja's private directory (per user, mode 0700)
+    # in the system temp dir.
+    'TEMPLATE_CACHE_DIR': None,
+    # Fingerprinted and compressed static files are written here at
+    # startup. Defaults to the assets directory in the instance folder.
+    'ASSETS_DIR': None,
+    # Statements taking longer than this many seconds are recorded, with
+    # their plan, and listed in the admin. None disables this.
+    'SLOW_QUERY_THRESHOLD': 0.5,
+    # Trace every request, with spans for statements, commits, and calls
+    # to wasipaid, the SEPA service and Postmark. Finished traces are
+    # appended to TRACE_FILE as OTLP JSON, one per line, if set; the
+    # last KEEP per endpoint are kept for the breakdown in the admin.
+    'TRACING': True,
+    'TRACE_FILE': None,
+    'TRACE_KEEP': 1000,
+    # Log records waiting to be written beyond this many are dropped,
+    # rather than making requests wait.
+    'LOG_QUEUE_SIZE': 10000,
     # Passwords for the admin interface. If none are given, it will
     # be disabled.
-    'ADMIN_AUTH': {}
+    'ADMIN_AUTH': {},
+    # Lets the admin show the outcome of actions.
+    'SECRET_KEY': None,
 }
 
 
@@ -79,11 +199,26 @@ def create_app(config=None):
                 n=app.config['PGDATABASE'],
             )
 
-    print('Using %s as database' % app.config['SQLALCHEMY_DATABASE_URI'])
+    if app.config['PGREPLICAHOST']:
+        app.config['REPLICA_DATABASE_URI'] = \
+            'postgres://{u}:{p}@{h}/{n}'.format(
+                u=app.config['PGUSER'],
+                p=app.config['PGPASSWORD'],
+                h=app.config['PGREPLICAHOST'],
+                n=app.config['PGDATABASE'],
+            )
+    if app.config['REPLICA_DATABASE_URI']:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds['replica'] = app.config['REPLICA_DATABASE_URI']
+        app.config['SQLALCHEMY_BINDS'] = binds
 
     # In production, Flask doesn't even both to log errors to console,
-    # which I judge to be a bit eccentric.
-    logbook.StderrHandler(level='INFO').push_application()
+    # which I judge to be a bit eccentric. Written as JSON from a
+    # background thread, so that requests never wait for stderr.
+    app.extensions['log_handler'] = logs.install(app.config['LOG_QUEUE_SIZE'])
+
+    log.info('Using {!r} as database',
+             make_url(app.config['SQLALCHEMY_DATABASE_URI']))
 
     # Log to sentry on errors
     if app.config['SENTRY_DSN']:
@@ -93,10 +228,33 @@ def create_app(config=None):
     # Add SSL support
     sslify = SSLify(app)
 
+    # Resolve the fee rules once, rather than on every quote.
+    app.extensions['fee_schedule'] = FeeSchedule.from_config(app.config)
+    app.extensions['admission'] = AdmissionController.from_config(app.config)
+    app.extensions['screening'] = Screening.from_config(app.config)
+    app.extensions['bank_directory'] = BankDirectory.from_config(app.config)
+    app.extensions['trustlines'] = TrustlineSnapshot.from_config(
+        app.config, bridge_addresses(app.config))
+    app.extensions['rates'] = RateFeed.from_config(app.config)
+
     # Setup app modules
     app.jinja_env.filters['timesince'] = timesince
     app.register_blueprint(bridge)
 
+    # Only writes what changed since the last start.
+    assets = app.extensions['assets'] = Assets.from_config(app)
+    assets.build()
+    app.jinja_env.globals['asset_url'] = assets.url
+
+    # Load our templates now, from the bytecode cache if possible,
+    # rather than compiling them during the first request.
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    for name in app.jinja_loader.list_templates():
+        app.jinja_env.get_template(name)
+
     # Enable the admin
     if app.config['ADMIN_AUTH']:
         admin.init_app(app)
@@ -106,4 +264,9 @@ def create_app(config=None):
     with app.app_context():
         db.create_all()
 
+    events.init_app(app)
+    liquidity.init_app(app)
+    slowlog.init_app(app)
+    tracing.init_app(app)
+
     return app
@@ -1,8 +1,23 @@
-from flask import url_for, redirect, Response, request, current_app
-from flask.ext.admin import Admin, AdminIndexView, expose
-from flask.ext.admin.contrib.sqla import ModelView
+from datetime import datetime, timedelta
+from flask import (
+    url_for, redirect, Response, request, current_app, stream_with_context,
+    jsonify, flash)
+from flask.ext.admin import Admin, AdminIndexView, BaseView, expose
+from flask.ext.admin.actions import action
+from flask.ext.admin.contrib.sqla import ModelView, tools
+import logbook
 from markupsafe import Markup
+import sqlalchemy
 from ripple.sepa.bridge import Ticket, db
+from werkzeug.exceptions import BadRequest, Forbidden
+from ripple.sepa.export import FORMATS, export_tickets, parse_date
+from ripple.sepa.model import (
+    AnyTicket, SlowQuery, SubmissionRetry, FAILED, NOT_FAILED,
+    reads_from_replica, tickets_changed)
+from ripple.sepa.stats import PERIODS, series, truncate
+
+
+log = logbook.Logger(__name__)
 
 
 def check_auth(username, password):
@@ -35,6 +50,71 @@ class IndexView(AdminIndexView):
         return redirect(url_for('ticketview.index_view'))
 
 
+# Bulk actions on tickets: the text, the condition a ticket has to meet
+# for the action to apply, and the values set. Tickets that do not meet
+# it, for example because they moved on meanwhile, are left alone.
+BULK_ACTIONS = {
+    'fail': (
+        'Mark failed',
+        sqlalchemy.and_(Ticket.status.in_(('received', 'sending', 'sent')),
+                        NOT_FAILED),
+        {'failed': 'manual'}),
+    'cancel': (
+        'Cancel',
+        sqlalchemy.and_(Ticket.status.in_(('quoted', 'received')),
+                        NOT_FAILED),
+        {'failed': 'cancelled'}),
+    # Transfers the retry worker gave up on, as the backend verifiably
+    # did not take them, and that still have the retry row with the
+    # payment's hash; the worker submits them again. Tickets in sending
+    # or sent may be with the backend, and are for manual review.
+    'requeue': (
+        'Re-queue for submission',
+        sqlalchemy.and_(
+            Ticket.status == 'received', Ticket.failed == 'backend',
+            Ticket.iban != None, Ticket.iban != '',
+            Ticket.id.in_(sqlalchemy.select(
+                [SubmissionRetry.__table__.c.ticket_id]))),
+        {'failed': None}),
+    'clear': (
+        'Clear recipient data',
+        sqlalchemy.or_(Ticket.status.in_(('sent', 'confirmed')), FAILED),
+        Ticket.CLEARED),
+}
+
+
+# Receivers query the changed tickets by id; stay below SQLite's limit
+# of parameters per statement.
+BULK_SIGNAL_SIZE = 500
+
+
+def bulk_action(name, criterion):
+    """Apply the bulk action ``name`` to the tickets matching
+    ``criterion``, with a single UPDATE. Returns the number changed.
+    Commits.
+    """
+    text, guard, values = BULK_ACTIONS[name]
+    if criterion is not None:
+        guard = sqlalchemy.and_(guard, criterion)
+    # Which tickets these are, for the status stream; locked, so that
+    # the UPDATE changes the same ones.
+    ids = [id for id, in db.session.query(Ticket.id).filter(guard)
+                            .with_for_update()]
+    # While the guard still tells which tickets these are.
+    if name == 'requeue':
+        SubmissionRetry.schedule_all(guard)
+    elif name in ('fail', 'cancel'):
+        # Or the retry worker would still submit them.
+        SubmissionRetry.cancel_all(guard)
+    count = Ticket.query.filter(guard)\
+        .update(values, synchronize_session=False)
+    db.session.commit()
+    app = current_app._get_current_object()
+    for i in range(0, len(ids), BULK_SIGNAL_SIZE):
+        tickets_changed.send(app, ids=ids[i:i+BULK_SIGNAL_SIZE])
+    return count
+
+
 class TicketView(ModelView):
 
     def is_accessible(self):
@@ -52,5 +132,196 @@ class TicketView(ModelView):
         'ripple_address': lambda v, c, m, p: format_id(m.ripple_address)
     }
 
+    # Browsing and searching is fine on the replica; edits are not.
+    @expose('/')
+    @reads_from_replica
+    def index_view(self):
+        return super().index_view()
+
+    # Bulk actions, on the selected tickets, or via :meth:`bulk_view`
+    # on all that the list is filtered to.
+    list_template = 'admin/ticket_list.html'
+
+    def _bulk(self, name, criterion):
+        count = bulk_action(name, criterion)
+        message = '%s: %s tickets changed.' % (BULK_ACTIONS[name][0], count)
+        log.info('Admin {}: {}', request.authorization.username, message)
+        # Messages need a session, and with that a SECRET_KEY.
+        if current_app.secret_key:
+            flash(message)
+
+    @action('fail', 'Mark failed', 'Mark the selected tickets as failed?')
+    def action_fail(self, ids):
+        self._bulk('fail', Ticket.id.in_(ids))
+
+    @action('cancel', 'Cancel', 'Cancel the selected tickets?')
+    def action_cancel(self, ids):
+        self._bulk('cancel', Ticket.id.in_(ids))
+
+    @action('requeue', 'Re-queue for submission',
+            'Submit the selected tickets to the SEPA backend again?')
+    def action_requeue(self, ids):
+        self._bulk('requeue', Ticket.id.in_(ids))
+
+    @action('clear', 'Clear recipient data',
+            'Clear the recipient data of the selected tickets?')
+    def action_clear(self, ids):
+        self._bulk('clear', Ticket.id.in_(ids))
+
+    def is_action_allowed(self, name):
+        if name in BULK_ACTIONS and not self.can_edit:
+            return False
+        return super().is_action_allowed(name)
+
+    def _list_criterion(self):
+        """The WHERE clause of the list as currently searched and
+        filtered, without paging.
+        """
+        page, sort, sort_desc, search, filters = self._get_list_extra_args()
+        query = self.session.query(self.model)
+        for term in (search or '').split(' '):
+            if term:
+                like = tools.parse_like_term(term)
+                query = query.filter(sqlalchemy.or_(
+                    *[c.ilike(like) for c in self._search_fields]))
+        for idx, value in filters or ():
+            query = self._filters[idx].apply(query, value)
+        return query.whereclause
+
+    @expose('/bulk/', methods=['POST'])
+    def bulk_view(self):
+        """Apply a bulk action to every ticket matching the search and
+        filters given in the query string.
+        """
+        name = request.form.get('action')
+        if not self.is_action_allowed(name):
+            raise Forbidden()
+        if name not in BULK_ACTIONS:
+            raise BadRequest()
+        self._bulk(name, self._list_criterion())
+        return redirect(url_for('.index_view', **request.args.to_dict()))
+
+
+class AllTicketsView(TicketView):
+    """Searches live and archived tickets together."""
+    can_create = can_edit = can_delete = False
+    list_template = 'admin/model/list.html'
+
+
+class SlowQueryView(ModelView):
+    """Statements recorded by :mod:`ripple.sepa.slowlog`, the ones
+    costing most time overall first. Delete a row to start over.
+    """
+
+    def is_accessible(self):
+        return is_authenticated()
+
+    def _handle_view(self, name, *args, **kwargs):
+        if not self.is_accessible():
+            return authenticate()
+
+    can_create = can_edit = False
+    column_list = ('view', 'statement', 'count', 'total_time', 'max_time',
+                   'last_seen', 'plan')
+    column_default_sort = ('total_time', True)
+    column_filters = ('view',)
+    column_formatters = {
+        'statement': lambda v, c, m, p: Markup('<code>%s</code>') % m.statement,
+        'plan': lambda v, c, m, p: Markup('<pre>%s</pre>') % (m.plan or ''),
+    }
+
+
+class ProtectedView(BaseView):
+
+    def is_accessible(self):
+        return is_authenticated()
+
+    def _handle_view(self, name, *args, **kwargs):
+        if not self.is_accessible():
+            return authenticate()
+
+
+class ExportView(ProtectedView):
+    """Streams tickets as CSV or JSON lines, for accounting::
+
+        /admin/export/?start=2014-01-01&end=2015-01-01&format=jsonl
+
+    ``end`` is exclusive; both are optional.
+    """
+
+    @expose('/')
+    def index(self):
+        fmt = request.args.get('format', 'csv')
+        try:
+            start = parse_date(request.args.get('start'))
+            end = parse_date(request.args.get('end'))
+            render, mimetype = FORMATS[fmt]
+        except (ValueError, KeyError):
+            raise BadRequest()
+
+        def stream():
+            with db.replica():
+                for chunk in render(export_tickets(start, end)):
+                    yield chunk
+
+        return Response(
+            stream_with_context(stream()), mimetype=mimetype, headers={
+                'Content-Disposition':
+                    'attachment; filename=tickets.%s' % fmt})
+
+
+class StatsView(ProtectedView):
+    """Volume, fees and failures from the statistics rollup; see
+    :mod:`ripple.sepa.stats`. The same data is available as JSON::
+
+        /admin/stats/json?period=hour&start=2014-06-01&end=2014-06-02
+    """
+
+    @expose('/')
+    @reads_from_replica
+    def index(self):
+        now = datetime.utcnow()
+        return self.render(
+            'admin/stats.html',
+            days=series('day', truncate(now, 'day') - timedelta(days=30)),
+            hours=series('hour', truncate(now, 'hour') - timedelta(hours=48)))
+
+    @expose('/json')
+    @reads_from_replica
+    def json(self):
+        period = request.args.get('period', 'day')
+        try:
+            start = parse_date(request.args.get('start'))
+            end = parse_date(request.args.get('end'))
+        except ValueError:
+            raise BadRequest()
+        if period not in PERIODS:
+            raise BadRequest()
+        return jsonify({'period': period,
+                        'stats': series(period, start, end)})
+
+
+class TracesView(ProtectedView):
+    """Latency by endpoint, and where the slowest tenth of requests
+    spent their time; see :mod:`ripple.sepa.tracing`. Covers only the
+    requests this worker served; ``manage.py traces`` summarizes the
+    trace file of all of them.
+    """
+
+    @expose('/')
+    def index(self):
+        tracer = current_app.extensions.get('tracer')
+        return self.render(
+            'admin/traces.html',
+            endpoints=sorted(tracer.breakdown().items()) if tracer else None)
+
+
 admin = Admin(index_view=IndexView())
 admin.add_view(TicketView(Ticket, db.session))
+admin.add_view(AllTicketsView(
+    AnyTicket, db.session, name='All tickets', endpoint='alltickets'))
+admin.add_view(StatsView(name='Statistics', endpoint='stats'))
+admin.add_view(SlowQueryView(
+    SlowQuery, db.session, name='Slow queries', endpoint='slowqueries'))
+admin.add_view(ExportView(name='Export', endpoint='export'))
+admin.add_view(TracesView(name='Traces', endpoint='traces'))
@@ -0,0 +1,78 @@
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+from ripple.sepa.model import db, Ticket
+
+
+# Tickets that have been paid for, but not yet handed off to the bank.
+BACKLOG_STATUSES = ('received', 'sending')
+
+
+class AdmissionController(object):
+    """Decides whether to accept new quotes, based on how many paid
+    transfers are still waiting for the SEPA backend, and for how long.
+
+    The backlog is measured with a single indexed aggregate query at
+    most every ``interval`` seconds per process, not on every request.
+    """
+
+    def __init__(self, max_depth=None, max_age=None, interval=10):
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.interval = interval
+        self.depth = 0
+        self.oldest = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['BACKLOG_MAX_DEPTH'], config['BACKLOG_MAX_AGE'],
+                   config['BACKLOG_CHECK_INTERVAL'])
+
+    @property
+    def enabled(self):
+        return bool(self.max_depth or self.max_age)
+
+    def refresh(self):
+        # Tickets paid before paid_at was recorded were last changed
+        # when they were paid, or retried.
+        self.depth, self.oldest = db.session\
+            .query(sqlalchemy.func.count(Ticket.id),
+                   sqlalchemy.func.min(sqlalchemy.func.coalesce(
+                       Ticket.paid_at, Ticket.updated_at)))\
+            .filter(Ticket.status.in_(BACKLOG_STATUSES))\
+            .filter(sqlalchemy.or_(Ticket.failed == None, Ticket.failed == ''))\
+            .one()
+        self._checked_at = time.time()
+
+    def _maybe_refresh(self):
+        if self._checked_at and time.time() - self._checked_at < self.interval:
+            return
+        # Only one thread needs to do this; the others use the old
+        # numbers meanwhile.
+        if self._lock.acquire(False):
+            try:
+                self.refresh()
+            finally:
+                self._lock.release()
+
+    @property
+    def age(self):
+        """Seconds since the oldest backlog ticket was paid."""
+        if not self.oldest:
+            return 0
+        return (datetime.utcnow() - self.oldest).total_seconds()
+
+    def overloaded(self):
+        if not self.enabled:
+            return False
+        self._maybe_refresh()
+        if self.max_depth and self.depth >= self.max_depth:
+            return True
+        if self.max_age and self.age >= self.max_age:
+            return True
+        return False
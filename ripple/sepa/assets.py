@@ -0,0 +1,165 @@
+"""Static assets, fingerprinted and precompressed.
+
+:meth:`Assets.build` copies every file from ``static/`` into the build
+directory under a name that contains a hash of its content. CSS is
+minified on the way, with its ``url()`` references rewritten to the
+fingerprinted names. Text files also get gzip and, if the ``brotli``
+module is installed, brotli compressed variants next to them.
+
+As a changed file gets a new name, built files never change, and are
+served with a far-future, immutable Cache-Control. Builds of earlier
+versions are removed once they are :attr:`Assets.KEEP_OLD` seconds old;
+until then, workers still running the previous release can serve them.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import time
+
+from flask import request, send_from_directory, url_for
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.html')
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+class Assets(object):
+
+    """Maps the names of static files to their built versions."""
+
+    # Seconds to keep built files that are no longer current.
+    KEEP_OLD = 86400
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.manifest = {}
+
+    @classmethod
+    def from_config(cls, app):
+        source = os.path.join(app.root_path, 'static')
+        return cls(source, app.config['ASSETS_DIR'] or
+                   os.path.join(app.instance_path, 'assets'))
+
+    def _sources(self):
+        for root, dirs, files in os.walk(self.source):
+            dirs[:] = [d for d in dirs
+                       if os.path.join(root, d) != self.target]
+            for filename in files:
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, self.source).replace(os.sep, '/')
+
+    def _rewrite_urls(self, name, css):
+        base = posixpath.dirname(name)
+
+        def replace(match):
+            ref = match.group(1)
+            built = self.manifest.get(posixpath.normpath(posixpath.join(base, ref)))
+            if not built:
+                return match.group(0)
+            return 'url(%s)' % posixpath.relpath(built, base or '.')
+        return re.sub(r'''url\(\s*['"]?([^'")]+?)['"]?\s*\)''', replace, css)
+
+    def _write(self, name, data):
+        """Write ``data`` to the build directory, unless already there.
+        Files appear atomically, so concurrent builds do no harm.
+        """
+        path = os.path.join(self.target, name)
+        if os.path.exists(path):
+            # Still current; see _prune.
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def _prune(self, current):
+        """Remove built files not in ``current`` that no build has
+        written or used for :attr:`KEEP_OLD` seconds.
+        """
+        cutoff = time.time() - self.KEEP_OLD
+        for root, dirs, files in os.walk(self.target):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.target).replace(os.sep, '/')
+                if name in current:
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    # Removed by another worker meanwhile.
+                    pass
+
+    def build(self):
+        """Bring the build directory up to date. Only files that changed
+        are written, so this is cheap to do on every start.
+        """
+        written = set()
+        self.manifest = {}
+        # Stylesheets last, so they can refer to everything else.
+        for name in sorted(self._sources(), key=lambda n: (n.endswith('.css'), n)):
+            with open(os.path.join(self.source, name), 'rb') as f:
+                data = f.read()
+            if name.endswith('.css'):
+                css = self._rewrite_urls(name, data.decode('utf-8'))
+                data = minify_css(css).encode('utf-8')
+
+            root, ext = posixpath.splitext(name)
+            built = '%s.%s%s' % (root, hashlib.md5(data).hexdigest()[:12], ext)
+            self._write(built, data)
+            written.add(built)
+            if ext in COMPRESSIBLE:
+                self._write(built + '.gz', gzip.compress(data, 9))
+                written.add(built + '.gz')
+                if brotli:
+                    self._write(built + '.br', brotli.compress(data))
+                    written.add(built + '.br')
+            self.manifest[name] = built
+        self._prune(written)
+        return self.manifest
+
+    def url(self, name):
+        """URL of the built version of the static file ``name``."""
+        return url_for('bridge.asset', filename=self.manifest[name])
+
+    def serve(self, filename):
+        if filename not in self.manifest.values():
+            raise NotFound()
+
+        # Prefer the precompressed variants where the client takes them.
+        served, encoding = filename, None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in request.accept_encodings and \
+                    os.path.exists(os.path.join(self.target, filename + suffix)):
+                served, encoding = filename + suffix, candidate
+                break
+
+        response = send_from_directory(
+            self.target, served, mimetype=mimetypes.guess_type(filename)[0])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
@@ -0,0 +1,171 @@
+"""Directory of banks, to find the BIC belonging to an IBAN.
+
+The directory is built by ``manage.py bankdir`` from a CSV file with
+``country``, ``bank_code`` and ``bic`` columns (as published by the
+national banks, e.g. the Bundesbank's Bankleitzahlen file), into a
+file configured as ``BANK_DIRECTORY``. That file is a hash table of
+fixed-size slots, which is memory-mapped rather than read: every
+worker process shares the same pages, and a lookup touches one or two
+slots.
+
+To use a new version of the directory, restart the workers.
+"""
+
+import csv
+import mmap
+import os
+import struct
+import zlib
+
+import logbook
+
+
+log = logbook.Logger(__name__)
+
+
+MAGIC = b'BANKDIR1'
+HEADER = struct.Struct('>8sI')
+
+# A slot holds the country and bank code, padded to KEY_SIZE, and the
+# BIC, padded to 11 characters. Empty slots are all zeros.
+KEY_SIZE = 14
+BIC_SIZE = 11
+SLOT_SIZE = KEY_SIZE + BIC_SIZE
+
+# Where the national bank code is found in the BBAN (the IBAN after the
+# country code and check digits), by country: offset and length.
+BANK_CODES = {
+    'AT': (0, 5),
+    'BE': (0, 3),
+    'CH': (0, 5),
+    'DE': (0, 8),
+    'ES': (0, 4),
+    'FI': (0, 3),
+    'FR': (0, 5),
+    'GB': (0, 4),
+    'IE': (0, 4),
+    'IT': (1, 5),
+    'LI': (0, 5),
+    'LU': (0, 3),
+    'NL': (0, 4),
+    'PT': (0, 4),
+}
+
+
+def bank_key(iban):
+    """The country and national bank code of an IBAN, or None if we
+    do not know where to find the bank code for its country.
+    """
+    iban = iban.replace(' ', '').upper()
+    position = BANK_CODES.get(iban[:2])
+    if not position:
+        return None
+    offset, length = position
+    code = iban[4+offset:4+offset+length]
+    if len(code) != length:
+        return None
+    return iban[:2] + code
+
+
+def _slot(key, slots):
+    return zlib.crc32(key) & (slots - 1)
+
+
+def build(rows, path):
+    """Write the directory for the ``(country, bank_code, bic)`` tuples
+    in ``rows`` to ``path``, replacing the existing file atomically.
+    Returns the number of banks.
+    """
+    entries = {}
+    for country, bank_code, bic in rows:
+        key = (country.strip().upper() + bank_code.strip().upper())
+        bic = bic.strip().upper()
+        if not bic or len(key) > KEY_SIZE or len(bic) > BIC_SIZE:
+            continue
+        entries[key.encode('ascii')] = bic.encode('ascii')
+
+    # A power of two, at most half full, so probe sequences stay short.
+    slots = 8
+    while slots < 2 * len(entries):
+        slots *= 2
+    table = bytearray(slots * SLOT_SIZE)
+    for key, bic in entries.items():
+        i = _slot(key, slots)
+        while table[i * SLOT_SIZE]:
+            i = (i + 1) & (slots - 1)
+        table[i * SLOT_SIZE:(i + 1) * SLOT_SIZE] = \
+            key.ljust(KEY_SIZE, b'\0') + bic.ljust(BIC_SIZE, b'\0')
+
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, slots))
+        f.write(table)
+    os.replace(temp, path)
+    return len(entries)
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield row['country'], row['bank_code'], row['bic']
+
+
+class BankDirectory(object):
+    """Looks up the BIC of the bank an IBAN belongs to. Without a file,
+    no bank is known.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._map = None
+        self._slots = 0
+        if path and not os.path.exists(path):
+            log.warning('Bank directory {} has not been built', path)
+        elif path:
+            with open(path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._slots = HEADER.unpack_from(self._map)
+            if magic != MAGIC:
+                raise ValueError('%s is not a bank directory' % path)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['BANK_DIRECTORY'])
+
+    def __bool__(self):
+        return self._map is not None
+
+    def bic(self, iban):
+        """The BIC of the bank of ``iban``, or None if not known."""
+        if self._map is None:
+            return None
+        key = bank_key(iban)
+        if not key:
+            return None
+        try:
+            key = key.encode('ascii')
+        except UnicodeEncodeError:
+            # No bank has such a code; this is user input.
+            return None
+        padded = key.ljust(KEY_SIZE, b'\0')
+        i = _slot(key, self._slots)
+        while True:
+            start = HEADER.size + i * SLOT_SIZE
+            slot = self._map[start:start + SLOT_SIZE]
+            if not slot[0]:
+                return None
+            if slot[:KEY_SIZE] == padded:
+                return slot[KEY_SIZE:].rstrip(b'\0').decode('ascii')
+            i = (i + 1) & (self._slots - 1)
+
+    def check(self, iban, bic):
+        """Raise a ValueError if ``bic`` is not of the bank ``iban``
+        belongs to, as far as we know the bank.
+
+        Only the institution and country are compared: the location and
+        branch parts of a bank's BICs vary, and any of them will do.
+        """
+        expected = self.bic(iban)
+        if expected and expected[:6] != bic.upper()[:6]:
+            raise ValueError(
+                'The BIC %s does not belong to the bank of IBAN %s (%s)' % (
+                    bic, iban, expected))
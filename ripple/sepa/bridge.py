@@ -1,39 +1,100 @@
 import calendar
-from decimal import Decimal
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import errno
+import hmac
 import json
+import queue
+import time
 
 from flask import (
     request, Response, url_for, jsonify, render_template, Blueprint,
     current_app)
+import logbook
 from postmark import PMMail
 import requests
-from requests.exceptions import RequestException
+from requests.exceptions import (
+    ConnectionError, ConnectTimeout, RequestException)
+from requests.packages.urllib3.exceptions import (
+    MaxRetryError, ProtocolError)
 from werkzeug.exceptions import BadRequest
 
-from ripple.sepa.model import db, Ticket
+from ripple.sepa.model import (
+    db, Ticket, LimitBudget, SubmissionRetry, NOT_FAILED, REFERENCE_LENGTH,
+    reads_from_replica, tickets_changed)
 from ripple_federation import Federation
-from .utils import add_response_headers, parse_sepa_destination, validate_sepa
+from .events import describe
+from .liquidity import valid_balance
+from .rates import to_eur, from_eur
+from .tracing import span, trace_headers
+from .utils import (
+    add_response_headers, parse_sepa_destination, validate_sepa,
+    bridge_addresses, assign_bridge_address)
 
 
 bridge = Blueprint('bridge', __name__, static_folder='static')
+log = logbook.Logger(__name__)
 
 
 @bridge.teardown_app_request
 def shutdown_session(exception=None):
     if exception:
-        print("Requested ended with exception:", exception)
-        # The gunicorn-bug exceptions are on the stack and can be printed.
-        #import traceback
-        #print(traceback.format_exc())
+        log.error('Request ended with exception: {}', exception, exc_info=(
+            type(exception), exception, exception.__traceback__))
+    if not db.session.registry.has():
+        return
     if exception:
         db.session.rollback()
-    else:
+    # Views that change tickets commit as they go; only pay for a commit
+    # here if something was left pending. Read-only requests skip it.
+    elif db.session.new or db.session.dirty or db.session.deleted:
         db.session.commit()
 
 
 CORS = {"Access-Control-Allow-Origin": "*"}
 
 
+def accepted_issuers(address=None, currency='EUR'):
+    """The issuers payments to ``address`` (or any bridge account) may
+    use: for EUR, those configured, or else the trustlines last fetched
+    from rippled. Empty if neither is known.
+    """
+    if currency == 'EUR' and current_app.config['ACCEPTED_ISSUERS']:
+        return current_app.config['ACCEPTED_ISSUERS']
+    return current_app.extensions['trustlines'].issuers(address, currency)
+
+
+def send_amounts(ticket, address):
+    """The amounts a quote asks for; one per issuer accepted."""
+    currency = ticket.send_currency
+    value = '%s' % ticket.send_value
+    if currency == 'XRP':
+        return [{"currency": "XRP", "value": value}]
+    # Accept either an explicit list of issuers, those the account has
+    # trustlines for, or - by specifying the bridge destination address
+    # as the issuer - any issue the bridge has trustlines for, until we
+    # know them. https://ripplelabs.atlassian.net/browse/WC-1855
+    return [{"currency": currency, "value": value, "issuer": issuer}
+            for issuer in (accepted_issuers(address, currency) or [address])]
+
+
+def accepted_currencies():
+    """What the federation response offers: EUR, and whatever we have
+    current exchange rates for.
+    """
+    rates = current_app.extensions['rates'].current()
+    currencies = []
+    for currency in ['EUR'] + sorted(rates.rates if rates else ()):
+        issuers = accepted_issuers(currency=currency) \
+            if currency != 'XRP' else []
+        # Either list all specific issuers we accept, or just the currency.
+        currencies.extend(
+            [{"currency": currency, "issuer": issuer} for issuer in issuers]
+            or [{"currency": currency}])
+    return currencies
+
+
 @bridge.route('/ripple.txt')
 @add_response_headers(CORS)
 def ripple_txt():
@@ -44,7 +105,7 @@ def ripple_txt():
         'federation_url': '{}://{}{}'.format(
             'https' if current_app.config['USE_HTTPS'] else 'http',
             request.host, url_for('.federation')),
-        'accounts': '\n'.join([current_app.config['BRIDGE_ADDRESS']])
+        'accounts': '\n'.join(bridge_addresses(current_app.config))
     }
     return Response("""
 [domain]
@@ -75,6 +136,10 @@ def federation():
             defaults = parse_sepa_destination(user)
         except ValueError as e:
             defaults = {'name': '', 'iban': '', 'bic': '', 'text': ''}
+        # Where we know the bank, the BIC is optional, and filled in.
+        banks = current_app.extensions['bank_directory']
+        if defaults['iban'] and not defaults['bic']:
+            defaults['bic'] = banks.bic(defaults['iban']) or ''
 
         config = {
             "extra_fields": [
@@ -97,8 +162,11 @@ def federation():
                 {
                     "label": "BIC",
                     "name": "bic",
-                    "hint": "Required. Will look something like this: DABADKKK",
-                    "required": True,
+                    "hint": "Optional for most banks, we look it up from the IBAN. "
+                            "Will look something like this: DABADKKK"
+                            if banks else
+                            "Required. Will look something like this: DABADKKK",
+                    "required": not banks,
                     "value": defaults['bic'],
                     "type": "text"
                 },
@@ -111,18 +179,7 @@ def federation():
                     "type": "text"
                 }
             ],
-            "currencies":
-                # Either list all specific issuers we accept, or just say EUR.
-                [{"currency": "EUR"}]
-                if not current_app.config['ACCEPTED_ISSUERS']
-                else
-                [
-                    {
-                        "currency": "EUR",
-                        "issuer": issuer
-                    }
-                    for issuer in (current_app.config['ACCEPTED_ISSUERS'])]
-            ,
+            "currencies": accepted_currencies(),
             "quote_url": '{}://{}{}'.format(
                 'https' if current_app.config['USE_HTTPS'] else 'http',
                 request.host, url_for('.quote')),
@@ -135,11 +192,28 @@ def federation():
     return jsonify(federation.endpoint(request.values, ))
 
 
+@bridge.route('/bic')
+@add_response_headers(CORS)
+def bic_lookup():
+    """The BIC for an IBAN, for the form to fill in."""
+    bic = current_app.extensions['bank_directory'].bic(
+        request.values.get('iban', ''))
+    return jsonify({'bic': bic})
+
+
 @bridge.route('/quote')
 @add_response_headers(CORS)
 def quote():
-    return jsonify(Federation.error(
-                'disabled', 'This bridge has been disabled.'))
+    if current_app.config['QUOTES_DISABLED']:
+        return jsonify(Federation.error(
+                    'disabled', 'This bridge has been disabled.'))
+
+    # Shed load early while the SEPA backend is not keeping up, rather
+    # than taking more payments we cannot forward.
+    if current_app.extensions['admission'].overloaded():
+        return jsonify(Federation.error(
+            'unavailable', 'We are currently unable to accept new '
+                           'transfers, try again later.'))
 
     sepa = {
         'bic': request.values.get('bic', ''),
@@ -147,69 +221,150 @@ def quote():
         'name': request.values.get('name', ''),
         'text': request.values.get('text', ''),
     }
+    banks = current_app.extensions['bank_directory']
+    if not sepa['bic']:
+        sepa['bic'] = banks.bic(sepa['iban']) or ''
     try:
         validate_sepa(sepa)
+        banks.check(sepa['iban'], sepa['bic'])
     except ValueError as e:
         return jsonify(Federation.error(
             'invalidSEPA', '%s' % e))
 
+    # Do not pay out to sanctioned parties; without telling them why.
+    with span('quote.screening'):
+        hit = current_app.extensions['screening'].screen(
+            sepa['name'], sepa['iban'])
+    if hit:
+        log.warning('Refused quote, sanctions screening: {}', hit)
+        send_mail('SEPA bridge: Quote refused by sanctions screening',
+                  'A quote for a transfer to %s (%s) was refused: %s.' % (
+                      sepa['name'], sepa['iban'], hit))
+        return jsonify(Federation.error(
+            'unavailable', 'We are unable to process this transfer.'))
+
     amount = request.values['amount'].split('/')
     if len(amount) != 2:
         raise BadRequest()
-    if not amount[1] == 'EUR':
+    amount, currency = Decimal(amount[0]), amount[1]
+    # Before anything is reserved; a negative amount would credit the
+    # budgets.
+    if not amount.is_finite() or amount <= 0:
         return jsonify(Federation.error(
-            'invalidAmount', 'You can only send EUR.'))
-    amount = Decimal(amount[0])
+            'invalidAmount', 'The amount is too small'))
+    rates = None
+    if currency != 'EUR':
+        # Paid in another currency; what arrives at the bank is EUR.
+        rates = current_app.extensions['rates'].current()
+        if not rates or currency not in rates.rates:
+            return jsonify(Federation.error(
+                'invalidAmount', 'You can only send EUR.'))
+        amount = to_eur(rates, amount, currency)
+        if amount <= 0:
+            return jsonify(Federation.error(
+                'invalidAmount', 'The amount is too small'))
 
     # Make sure the amount isn't dividing up any cents.
     if amount.quantize(Decimal('0.00')) != amount:
         return jsonify(Federation.error(
                 'invalidAmount', 'The amount must be divisible by 1 cent'))
 
-    # Validate limits
-    if current_app.config['USER_TX_LIMIT']:
-        cur_volume = Ticket.tx_volume_today(sepa['iban'])
-        if amount + cur_volume > Decimal(current_app.config['USER_TX_LIMIT']):
-            return jsonify(Federation.error(
-                'limitExceeded',
-                'The amount you are trying to send is too large (limit: %s)' %
-                    current_app.config['USER_TX_LIMIT']))
-    if current_app.config['BRIDGE_TX_LIMIT']:
-        cur_volume = Ticket.tx_volume_today()
-        if amount + cur_volume > Decimal(current_app.config['BRIDGE_TX_LIMIT']):
-            return jsonify(Federation.error(
-                'limitExceeded',
-                'We are currently unable to process such an amount, try '
-                'again later.'))
+    # Do not take payments we could not pass on.
+    if not current_app.extensions['liquidity'].can_pay(amount):
+        return jsonify(Federation.error(
+            'limitExceeded', 'We are currently unable to process such an '
+                             'amount, try again later.'))
+
+    # Validate limits, and reserve the amount against them. This is
+    # atomic, so concurrent quotes cannot exceed a limit together.
+    errors = {
+        sepa['iban']:
+            'The amount you are trying to send is too large (limit: %s)' %
+                current_app.config['USER_TX_LIMIT'],
+        LimitBudget.BRIDGE:
+            'We are currently unable to process such an amount, try '
+            'again later.',
+    }
+    limits = tx_limits(sepa['iban'])
+    for key, limit in limits:
+        if amount > limit:
+            return jsonify(Federation.error('limitExceeded', errors[key]))
+    with span('quote.reserve'):
+        exceeded = LimitBudget.reserve(amount, limits)
+        if exceeded and LimitBudget.release_expired():
+            exceeded = LimitBudget.reserve(amount, limits)
+    if exceeded:
+        return jsonify(Federation.error('limitExceeded', errors[exceeded]))
 
     # Determine the fee the user has to pay
-    fee = Decimal(current_app.config.get('FIXED_FEE'))
-    fee = fee + amount * (Decimal(current_app.config.get('VOLUME_FEE'))/100)
+    fee = current_app.extensions['fee_schedule'].fee(amount, sepa['iban'])
 
     # Generate a quote id, store the thing in the database
     ticket = Ticket(amount=amount, fee=fee, **sepa)
+    if rates:
+        ticket.currency = currency
+        ticket.send_amount = from_eur(rates, amount + fee, currency)
+        ticket.rate_version = rates.version
     db.session.add(ticket)
+    address = assign_bridge_address(
+        ticket.id, bridge_addresses(current_app.config))
 
-    return jsonify({
+    response = jsonify({
         "result": "success",
         "quote": {
             "invoice_id": ticket.id,
-            # Accept either an explicit list of issuers, or - by specifying
-            # the bridge destination address as the issuer, accept any issue
-            # the bridge as trustlines for.
-            # https://ripplelabs.atlassian.net/browse/WC-1855
-            "send": [
-                {
-                    "currency": "EUR",
-                    "value": "%s" % (ticket.amount + ticket.fee),
-                    "issuer": issuer
-                } for issuer in (current_app.config['ACCEPTED_ISSUERS'] or
-                        [current_app.config['BRIDGE_ADDRESS']])
-            ],
-            "address": current_app.config['BRIDGE_ADDRESS'],
+            "send": send_amounts(ticket, address),
+            "address": address,
             "expires": calendar.timegm(ticket.expires.timetuple())
         }
     })
+    # Release the budget rows as soon as possible.
+    db.session.commit()
+    return response
+
+
+def tx_limits(iban):
+    """The ``(key, limit)`` pairs a transfer to ``iban`` is reserved
+    against, in the order :meth:`LimitBudget.reserve` wants them.
+    """
+    return [(key, Decimal(current_app.config[option]))
+            for key, option in ((iban, 'USER_TX_LIMIT'),
+                                (LimitBudget.BRIDGE, 'BRIDGE_TX_LIMIT'))
+            if current_app.config[option]]
+
+
+def accept_payment(ticket, to_status, sender):
+    """Move a paid ticket on from quoted or received to ``to_status``,
+    provided nobody failed or cancelled it meanwhile. Does not commit.
+
+    A quote that expired unpaid is still honoured, until it is cleared;
+    as its reservation was given back, the amount is reserved again,
+    against today's limits. Returns None if the ticket was moved, or
+    why the payment cannot be sent. Raises a RuntimeError if the ticket
+    was processed already.
+    """
+    paid = dict(ripple_address=sender, failed=None,
+                paid_at=datetime.utcnow())
+    if ticket.transition(('quoted', 'received'), to_status, NOT_FAILED,
+                         **paid):
+        return None
+
+    # What stopped us may have happened after the ticket was loaded.
+    db.session.refresh(ticket)
+    if ticket.status not in ('quoted', 'received'):
+        raise RuntimeError("Ticket was already processed: %s" % ticket.id)
+    if ticket.failed != 'expired':
+        return 'the ticket is marked failed (%s)' % ticket.failed
+    if not ticket.iban:
+        return 'the quote expired too long ago'
+    if LimitBudget.reserve(ticket.amount, tx_limits(ticket.iban)):
+        return 'the amount exceeds the limits'
+    if not ticket.transition(('quoted',), to_status, Ticket.LATE_PAYABLE,
+                             **paid):
+        # Give the reservation back.
+        db.session.rollback()
+        raise RuntimeError("Ticket was already processed: %s" % ticket.id)
+    return None
 
 
 @bridge.route('/on_payment', methods=['POST'])
@@ -226,87 +381,91 @@ def on_payment_received():
     # Validate the notification
     if not current_app.config.get('RECEIPT_DEBUGGING'):
         # https://github.com/kennethreitz/requests/issues/2071
-        result = requests.post(
-            'https://wasipaid.com/receipt',
-            data=request.get_data(), headers={
-                'Content-Type': 'application/octet-stream'})
+        with span('wasipaid.receipt'):
+            headers = {'Content-Type': 'application/octet-stream'}
+            headers.update(trace_headers())
+            result = requests.post(
+                'https://wasipaid.com/receipt',
+                data=request.get_data(), headers=headers)
         if result.text != 'VALID':
             return 'not at all ok', 400
 
     payment = request.json['data']
     tx_hash = request.json['transaction']['hash']
 
+    # Payments to any of our accounts are fine, no matter which one the
+    # quote named.
+    if payment.get('destination') and \
+            payment['destination'] not in bridge_addresses(current_app.config):
+        send_mail(
+            'Received payment to unknown account',
+            'Transaction {tx} was sent to {d}, which is not a bridge '
+            'account.'.format(tx=tx_hash, d=payment['destination']))
+        return 'OK', 200
+
     # Find the ticket
     ticket = Ticket.query.get(payment['invoice_id'].lower()) \
-        if 'invoice_id' in payment else None
+        if payment.get('invoice_id') else None
     if ticket:
-        if Decimal(payment['amount']) == (ticket.amount + ticket.fee):
+        if Decimal(payment['amount']) == ticket.send_value and \
+                payment.get('currency', 'EUR') == ticket.send_currency:
             # Make sure the ticket in question is in the right status;
             # otherwise something is wrong, and we are in danger of asking
             # the same payment to be sent twice.
             if not ticket.status in ('received', 'quoted'):
                 raise RuntimeError("Ticket was already processed: %s" % ticket.id)
 
-            # No matter what happens, we can record that we have indeed
-            # received the payment, so the user will not have any doubt
-            # about that; mo matter an error that may occur later.
-            ticket.ripple_address = payment['sender']
-            ticket.status = 'received'
+            # Record the payment first. With a backend, put the ticket
+            # into "sending" in the same step, before handing it off to
+            # the backend API; this is because we don't trust the backend
+            # to be idempotent; we cannot risk that us crashing right
+            # after the backend call could lead to duplicate transfers.
+            # Without one, we only send email; the user will not have any
+            # doubt about the payment being received, no matter an error
+            # that may occur later.
+            backend = current_app.config['SEPA_API']
+            refused = accept_payment(
+                ticket, 'sending' if backend else 'received',
+                payment['sender'])
+            if refused:
+                send_mail(
+                    'SEPA bridge: Payment not sent',
+                    'Transaction {tx} pays ticket {t}, but was not sent: '
+                    '{r}. The payment has to be returned.'.format(
+                        tx=tx_hash, t=ticket.id, r=refused))
+                return 'OK', 200
             db.session.commit()
 
             # Call the SEPA backend
-            if current_app.config['SEPA_API']:
-                # Set the status to "sending" before handing it off to the
-                # backend API; this is because we don't trust the backend
-                # to be idempotent; we cannot risk that us crashing right
-                # after the backend call could lead to duplicate transfers.
-                ticket.status = 'sending'
-                db.session.commit()
-
-                error = None
+            if backend:
                 try:
-                    result = requests.post(current_app.config['SEPA_API'],
-                                           data=json.dumps({
-                        'id': ticket.id[:35],
-                        'name': ticket.recipient_name,
-                        'bic': ticket.bic,
-                        'iban': ticket.iban,
-                        'amount': format(ticket.amount, ',.2f'),
-                        'text': 'sepa.link: %s' % ticket.text,
-                        'verify': tx_hash
-                    }), headers={
-                        'Content-type': 'application/json',
-                        'Authorization': current_app.config['SEPA_API_AUTH']})
-                except RequestException as e:
-                    error = '%s' % e
-                else:
-                    if result.status_code != 200:
-                        error =  "Unexpected status code: %s" % result.status_code
-
-                    elif 'error' in result.json():
-                        error = 'Backend did not accept transfer: %s' % \
-                            result.json()['error']
-
+                    error = submit_transfer(ticket, tx_hash)
+                except SubmissionUnknown as e:
+                    report_unknown(ticket, e)
+                    return 'OK', 200
                 if error:
-                    # We verifiably did not submit, remove the sending state.
-                    ticket.status = 'received'
-                    db.session.commit()
-                    # Make sure we don't accept the notification
-                    raise ValueError(error)
-
-                else:
-                    ticket.status = 'sent'
+                    # We verifiably did not submit, remove the sending
+                    # state, and retry later ourselves rather than have
+                    # the notification repeated.
+                    ticket.transition(('sending',), 'received')
+                    SubmissionRetry.schedule(ticket, tx_hash, error)
                     db.session.commit()
-
-                    send_mail(
-                        'SEPA bridge: Transaction processed',
-                        render_template('transfer.txt', **{'ticket': ticket}))
+                    log.warning('Submission of {} failed, will retry: {}',
+                                ticket.id, error)
+                    return 'OK', 200
+
+                # Mark as sent and forget the sensitive data in the same
+                # commit.
+                text = render_template('transfer.txt', ticket=ticket)
+                ticket.transition(('sending',), 'sent', **Ticket.CLEARED)
+                db.session.commit()
+                send_mail('SEPA bridge: Transaction processed', text)
+                return 'OK', 200
 
             # If no backend is configured, only send email.
-            else:
-                send_mail(
-                    'SEPA bridge: Payment received: Execute a transfer',
-                    render_template('transfer.txt', **{'ticket': ticket}))
+            send_mail(
+                'SEPA bridge: Payment received: Execute a transfer',
+                render_template('transfer.txt', **{'ticket': ticket}))
 
             # Ticket was processed successfully, forget sensitive data
             # and drop the notification.
@@ -321,8 +480,8 @@ def on_payment_received():
                           'amounts do not match ({{txa}} vs {{ta}}).').format(
                    tx=tx_hash,
                    t=ticket.id,
-                   txa=Decimal(payment['amount']),
-                   ta=ticket.amount + ticket.fee
+                   txa='%s %s' % (payment['amount'], payment.get('currency', '')),
+                   ta='%s %s' % (ticket.send_value, ticket.send_currency)
                )
         )
     else:
@@ -334,20 +493,242 @@ def on_payment_received():
     return 'OK', 200
 
 
+# The statuses the SEPA backend may report, and which statuses a
+# ticket may be in for the update to apply.
+BACKEND_TRANSITIONS = {
+    'confirmed': ('sent',),
+}
+BACKEND_FAILABLE = ('sending', 'sent')
+
+
+@bridge.route('/on_balance', methods=['POST'])
+def on_balance_update():
+    """The SEPA backend reports the balance available for transfers::
+
+        {"balance": "1234.56"}
+    """
+    auth = current_app.config['SEPA_CALLBACK_AUTH']
+    if not auth or not hmac.compare_digest(
+            request.headers.get('Authorization', ''), auth):
+        return 'not authorized', 401
+    ledger = current_app.extensions['liquidity']
+    if not ledger.enabled:
+        return 'no balance file configured', 404
+
+    try:
+        balance = Decimal(request.json['balance'])
+    except (KeyError, TypeError, InvalidOperation):
+        raise BadRequest()
+    # NaN would make every later comparison raise.
+    if not valid_balance(balance):
+        raise BadRequest()
+    ledger.set_balance(balance)
+    return jsonify({'balance': format(balance, '.2f'),
+                    'available': format(ledger.available, '.2f')})
+
+
+@bridge.route('/on_status', methods=['POST'])
+def on_status_update():
+    """The SEPA backend reports status changes here, in bulk::
+
+        {"updates": [{"id": "<reference>", "status": "confirmed"},
+                     {"id": "<reference>", "failed": "<error code>"}]}
+
+    All updates are applied in one transaction, with one UPDATE per
+    target status and batch of references. Updates for tickets not in
+    an eligible status are ignored.
+    """
+    auth = current_app.config['SEPA_CALLBACK_AUTH']
+    if not auth or not hmac.compare_digest(
+            request.headers.get('Authorization', ''), auth):
+        return 'not authorized', 401
+
+    grouped = defaultdict(list)
+    try:
+        for update in request.json['updates']:
+            if not isinstance(update['id'], str) or \
+                    not isinstance(update.get('failed', ''), str):
+                raise BadRequest()
+            if 'failed' in update:
+                grouped[('failed', update['failed'])].append(update['id'])
+            elif update.get('status') in BACKEND_TRANSITIONS:
+                grouped[('status', update['status'])].append(update['id'])
+            else:
+                raise BadRequest()
+    except (KeyError, TypeError):
+        raise BadRequest()
+
+    changed = []
+    for (field, value), references in grouped.items():
+        from_status = BACKEND_FAILABLE if field == 'failed' \
+            else BACKEND_TRANSITIONS[value]
+        changed.extend(Ticket.bulk_update(
+            references, from_status, **{field: value}))
+    db.session.commit()
+
+    if changed:
+        tickets_changed.send(current_app._get_current_object(), ids=changed)
+    total = sum(len(r) for r in grouped.values())
+    return jsonify({'updated': len(changed), 'ignored': total - len(changed)})
+
+
+@bridge.route('/assets/<path:filename>')
+def asset(filename):
+    """Static files by their fingerprinted name; see
+    :mod:`ripple.sepa.assets`.
+    """
+    return current_app.extensions['assets'].serve(filename)
+
+
+@bridge.route('/events')
+@reads_from_replica
+def events():
+    """Server-sent events with the status of the tickets given as
+    ``?tickets=id1,id2``.
+
+    By default, this sends the current status, one primary key lookup,
+    and ends; the browser reconnects after ``EVENTS_POLL_INTERVAL``,
+    which makes it a poll that holds no worker. With
+    ``EVENTS_STREAM_TIMEOUT``, changes are streamed for that long
+    without touching the database; see :mod:`ripple.sepa.events`.
+    """
+    ids = [i for i in request.args.get('tickets', '').split(',') if i]
+    if not ids or len(ids) > current_app.config['EVENTS_MAX_TICKETS']:
+        raise BadRequest()
+    timeout = current_app.config['EVENTS_STREAM_TIMEOUT']
+    notifier = current_app.extensions['status_events']
+    subscription = None
+    if timeout:
+        # Before reading the current status, so no change is missed.
+        subscription = notifier.broadcaster.subscribe(ids)
+        notifier.start()
+    current = [describe(t) for t in Ticket.query.filter(Ticket.id.in_(ids))]
+    retry = current_app.config['EVENTS_POLL_INTERVAL'] * 1000
+    deadline = time.time() + timeout
+
+    def stream():
+        yield 'retry: %d\n\n' % retry
+        for change in current:
+            yield 'event: status\ndata: %s\n\n' % json.dumps(change)
+        if subscription is None:
+            return
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                change = subscription.get(timeout=min(remaining, 15))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield 'event: status\ndata: %s\n\n' % json.dumps(change)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    if subscription is not None:
+        response.call_on_close(
+            lambda: notifier.broadcaster.unsubscribe(subscription))
+    return response
+
+
+class SubmissionUnknown(Exception):
+    """The SEPA backend may or may not have accepted a transfer, for
+    example because its response did not arrive. Submitting it again
+    could pay it twice; it needs to be resolved manually.
+    """
+
+
+def _not_sent(error):
+    """Whether a failed request verifiably never reached the backend:
+    the connection could not be made. Failures after that, like a reset
+    connection or a read timeout, may come after the backend acted.
+    """
+    if isinstance(error, ConnectTimeout):
+        return True
+    if not isinstance(error, ConnectionError) or not error.args:
+        return False
+    reason = error.args[0]
+    if isinstance(reason, MaxRetryError):
+        return True
+    # The requests we pin reports a refused connection as an aborted
+    # one; only a connect can be refused.
+    return isinstance(reason, ProtocolError) and \
+        getattr(reason.args[-1], 'errno', None) == errno.ECONNREFUSED
+
+
+def submit_transfer(ticket, tx_hash):
+    """Hand the transfer to the SEPA backend.
+
+    Returns an error message if the backend verifiably did not accept
+    it, and raises :class:`SubmissionUnknown` if we cannot tell. The
+    caller is responsible for the "sending" state.
+    """
+    try:
+        with span('sepa.submit', ticket=ticket.id):
+            headers = {
+                'Content-type': 'application/json',
+                'Authorization': current_app.config['SEPA_API_AUTH']}
+            headers.update(trace_headers())
+            result = requests.post(current_app.config['SEPA_API'],
+                                   data=json.dumps({
+                'id': ticket.id[:REFERENCE_LENGTH],
+                'name': ticket.recipient_name,
+                'bic': ticket.bic,
+                'iban': ticket.iban,
+                'amount': format(ticket.amount, ',.2f'),
+                'text': 'sepa.link: %s' % ticket.text,
+                'verify': tx_hash
+            }), headers=headers, timeout=(
+                current_app.config['SEPA_API_CONNECT_TIMEOUT'],
+                current_app.config['SEPA_API_TIMEOUT']))
+    except RequestException as e:
+        if _not_sent(e):
+            return '%s' % e
+        raise SubmissionUnknown('%s' % e)
+
+    # Client errors, and 503, are refusals; a gateway error or a crash
+    # may have happened after the transfer was made.
+    if result.status_code != 200:
+        message = "Unexpected status code: %s" % result.status_code
+        if 400 <= result.status_code < 500 or result.status_code == 503:
+            return message
+        raise SubmissionUnknown(message)
+    try:
+        response = result.json()
+    except ValueError:
+        raise SubmissionUnknown('Unreadable response: %r' % result.text[:200])
+    if 'error' in response:
+        return 'Backend did not accept transfer: %s' % response['error']
+    return None
+
+
+def report_unknown(ticket, error):
+    """Leave ``ticket`` in sending, and ask for it to be resolved."""
+    log.error('Submission of {} has an unknown outcome: {}', ticket.id, error)
+    send_mail('SEPA bridge: Transfer needs manual review',
+              'Ticket %s was handed to the backend, but we cannot tell '
+              'whether it was accepted: %s. It stays in "sending"; check '
+              'with the backend before doing anything else.' % (
+                  ticket.id, error))
+
+
 def send_mail(subject, text):
-    PMMail(api_key=current_app.config['POSTMARK_KEY'],
-           sender=current_app.config['POSTMARK_SENDER'],
-           to=','.join(current_app.config['ADMINS']),
-           subject=subject,
-           text_body=text).send()
+    # Postmark takes no headers of ours; the trace ends here.
+    with span('mail.send'):
+        PMMail(api_key=current_app.config['POSTMARK_KEY'],
+               sender=current_app.config['POSTMARK_SENDER'],
+               to=','.join(current_app.config['ADMINS']),
+               subject=subject,
+               text_body=text).send()
 
 
 @bridge.route('/')
+@reads_from_replica
 def index():
     tickets = Ticket.query.filter(
         Ticket.status!='quoted').order_by(Ticket.created_at.desc())[:10]
     return render_template(
         'index.html', tickets=tickets, config=current_app.config,
-        Decimal=Decimal)
+        fees=current_app.extensions['fee_schedule'])
 
 
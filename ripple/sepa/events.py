@@ -0,0 +1,210 @@
+"""Pushes ticket status transitions to connected browsers.
+
+Status changes are picked up when they are committed, and handed to a
+notifier. On Postgres, this is a NOTIFY on the ``ticket_status``
+channel, which a single LISTEN connection per worker process turns
+into local messages; on other databases, changes are only seen by
+clients connected to the process that made them.
+
+Either way, clients waiting on :meth:`StatusBroadcaster.subscribe`
+cost no queries. They do hold a worker thread each, which is why
+``/events`` only streams if ``EVENTS_STREAM_TIMEOUT`` is set.
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+
+import logbook
+from sqlalchemy import event, inspect, text
+
+from ripple.sepa.model import (
+    db, Ticket, RoutingSession, tickets_changed, ticket_transitioned)
+
+
+log = logbook.Logger(__name__)
+
+
+CHANNEL = 'ticket_status'
+
+
+def describe(ticket):
+    """What we tell a watching client about a ticket."""
+    return {
+        'id': ticket.id,
+        'status': ticket.status,
+        'failed': ticket.failed or '',
+        'text': ticket.display_status,
+    }
+
+
+class Subscription(object):
+
+    def __init__(self, ids=None, maxsize=100):
+        self.ids = set(ids) if ids else None
+        self.queue = queue.Queue(maxsize)
+
+    def wants(self, change):
+        return self.ids is None or change['id'] in self.ids
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+class StatusBroadcaster(object):
+    """In-process fan-out of status changes to subscribers.
+
+    A subscriber that does not keep up loses messages, rather than
+    growing its queue without bound.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self, ids=None):
+        subscription = Subscription(ids)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, changes):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            for change in changes:
+                if subscription.wants(change):
+                    try:
+                        subscription.queue.put_nowait(change)
+                    except queue.Full:
+                        pass
+
+
+class LocalNotifier(object):
+    """Delivers changes to subscribers in this process only."""
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+
+    def start(self):
+        pass
+
+    def notify(self, changes):
+        self.broadcaster.publish(changes)
+
+
+class PostgresNotifier(object):
+    """Delivers changes to all processes via LISTEN/NOTIFY.
+
+    The listening connection is only opened once the first client
+    subscribes, so workers not serving streams do not hold one.
+    """
+
+    # NOTIFY payloads are limited to 8000 bytes.
+    CHUNK_SIZE = 50
+
+    def __init__(self, broadcaster, engine):
+        self.broadcaster = broadcaster
+        self.engine = engine
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def notify(self, changes):
+        with self.engine.connect() as conn:
+            with conn.begin():
+                for i in range(0, len(changes), self.CHUNK_SIZE):
+                    conn.execute(
+                        text('SELECT pg_notify(:channel, :payload)'),
+                        channel=CHANNEL,
+                        payload=json.dumps(changes[i:i+self.CHUNK_SIZE]))
+
+    def _listen(self):
+        while True:
+            # Taken out of the pool for good: in autocommit and listening,
+            # it must never be handed to a request.
+            proxy = self.engine.raw_connection()
+            proxy.detach()
+            conn = proxy.connection
+            try:
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN %s' % CHANNEL)
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.broadcaster.publish(json.loads(notify.payload))
+            except Exception as e:
+                log.error('Status listener failed, reconnecting: {}', e)
+                time.sleep(5)
+            finally:
+                proxy.close()
+
+
+def init_app(app):
+    broadcaster = StatusBroadcaster()
+    with app.app_context():
+        engine = db.get_engine(app)
+    if engine.dialect.name == 'postgresql':
+        notifier = PostgresNotifier(broadcaster, engine)
+    else:
+        notifier = LocalNotifier(broadcaster)
+    app.extensions['status_events'] = notifier
+
+
+def _notifier(session):
+    app = getattr(session, 'app', None)
+    return app.extensions.get('status_events') if app else None
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_changes(session, flush_context):
+    for obj in session.dirty:
+        if not isinstance(obj, Ticket):
+            continue
+        state = inspect(obj)
+        if state.attrs.status.history.has_changes() or \
+                state.attrs.failed.history.has_changes():
+            session.info.setdefault('status_changes', {})[obj.id] = \
+                describe(obj)
+
+
+@ticket_transitioned.connect
+def _record_transition(ticket, **kwargs):
+    session = db.session()
+    session.info.setdefault('status_changes', {})[ticket.id] = describe(ticket)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _send_changes(session):
+    changes = session.info.pop('status_changes', None)
+    notifier = _notifier(session)
+    if changes and notifier:
+        notifier.notify(list(changes.values()))
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('status_changes', None)
+
+
+@tickets_changed.connect
+def _on_bulk_change(app, ids):
+    notifier = app.extensions.get('status_events')
+    if notifier:
+        tickets = Ticket.query.filter(Ticket.id.in_(ids))
+        notifier.notify([describe(t) for t in tickets])
@@ -0,0 +1,82 @@
+"""Ticket exports for accounting.
+
+Exports cover live and archived tickets alike, and are streamed: rows
+are fetched from a server-side cursor in batches and written out one
+by one, so the size of an export does not affect memory use.
+"""
+
+import csv
+from datetime import datetime
+from decimal import Decimal
+import io
+import json
+
+from ripple.sepa.model import AnyTicket, db
+
+
+COLUMNS = ('id', 'created_at', 'status', 'failed', 'amount', 'fee',
+           'ripple_address', 'currency', 'send_amount', 'rate_version')
+
+
+def parse_date(value):
+    """``YYYY-MM-DD`` to a datetime, or None if empty."""
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+def export_tickets(start=None, end=None, batch_size=1000):
+    """Yield a tuple of :data:`COLUMNS` for every ticket created in
+    ``[start, end)``, oldest first.
+    """
+    query = db.session.query(*[getattr(AnyTicket, c) for c in COLUMNS])
+    if start:
+        query = query.filter(AnyTicket.created_at >= start)
+    if end:
+        query = query.filter(AnyTicket.created_at < end)
+    query = query.order_by(AnyTicket.created_at)\
+        .execution_options(stream_results=True)\
+        .yield_per(batch_size)
+    try:
+        for row in query:
+            yield tuple(row)
+    finally:
+        # Do not keep the snapshot open once we are done reading.
+        db.session.rollback()
+
+
+def _value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def to_csv(rows):
+    """Render rows as CSV, one line at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(COLUMNS)
+    for row in rows:
+        yield line([_value(v) for v in row])
+
+
+def to_jsonl(rows):
+    """Render rows as JSON objects, one per line."""
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, map(_value, row)))) + '\n'
+
+
+FORMATS = {
+    'csv': (to_csv, 'text/csv'),
+    'jsonl': (to_jsonl, 'application/x-ndjson'),
+}
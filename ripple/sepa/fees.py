@@ -0,0 +1,109 @@
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+
+FeeTier = namedtuple('FeeTier', ['min_amount', 'fixed', 'volume'])
+
+
+class FeeSchedule(object):
+    """Determines the fee for a transfer.
+
+    The base fee is given by ``FIXED_FEE`` and ``VOLUME_FEE``. On top of
+    that, ``FEE_SCHEDULE`` can define rules of the form::
+
+        {'min_amount': '100', 'fixed': '1.00', 'volume': '3',
+         'countries': ['DE', 'AT'], 'hours': [22, 6]}
+
+    ``countries`` (the IBAN country code) and ``hours`` (a UTC range,
+    end exclusive, which may wrap around midnight) are optional. For a
+    given country and hour, only the most specific set of rules that
+    applies is used - a country schedule replaces the general one, an
+    hour-restricted schedule replaces an unrestricted one. Within that
+    set, the rule with the highest ``min_amount`` not above the
+    transfer amount wins; below the lowest tier, the base fee applies.
+
+    Everything is resolved up front into sorted tables, so that
+    determining a fee is a dict lookup, a bisect and a multiply.
+    """
+
+    def __init__(self, fixed, volume, rules=()):
+        self.base = FeeTier(Decimal(0), Decimal(fixed), Decimal(volume))
+        self.rules = [self._parse_rule(r) for r in rules]
+
+        countries = set()
+        for rule in self.rules:
+            countries.update(rule['countries'])
+        self._tables = {}
+        for country in [None] + sorted(countries):
+            self._tables[country] = tuple(
+                self._compile(country, hour) for hour in range(24))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['FIXED_FEE'], config['VOLUME_FEE'],
+                   config.get('FEE_SCHEDULE') or ())
+
+    @staticmethod
+    def _parse_rule(rule):
+        hours = rule.get('hours')
+        if hours is not None:
+            start, end = hours
+            if start < end:
+                hours = frozenset(range(start, end))
+            else:
+                hours = frozenset(range(start, 24)) | frozenset(range(0, end))
+        return {
+            'tier': FeeTier(Decimal(rule.get('min_amount', 0)),
+                            Decimal(rule['fixed']),
+                            Decimal(rule['volume'])),
+            'countries': frozenset(c.upper() for c in rule.get('countries') or ()),
+            'hours': hours,
+        }
+
+    def _compile(self, country, hour):
+        applicable = {}
+        for rule in self.rules:
+            if rule['countries'] and country not in rule['countries']:
+                continue
+            if rule['hours'] is not None and hour not in rule['hours']:
+                continue
+            specificity = (bool(rule['countries']), rule['hours'] is not None)
+            applicable.setdefault(specificity, []).append(rule['tier'])
+
+        tiers = applicable[max(applicable)] if applicable else []
+        tiers = sorted(tiers, key=lambda t: t.min_amount)
+        if not tiers or tiers[0].min_amount > 0:
+            tiers.insert(0, self.base)
+
+        bounds = [t.min_amount for t in tiers]
+        rates = [(t.fixed, t.volume / 100) for t in tiers]
+        return bounds, rates, tiers
+
+    def _table(self, country, hour):
+        return self._tables.get(country, self._tables[None])[hour]
+
+    def fee(self, amount, iban='', at=None):
+        """Return the fee to charge for sending ``amount`` to ``iban``.
+        Raises a ValueError unless ``amount`` is positive.
+        """
+        if amount <= 0:
+            raise ValueError('Amount must be positive: %s' % amount)
+        at = at or datetime.utcnow()
+        bounds, rates, _ = self._table(iban[:2].upper() or None, at.hour)
+        fixed, rate = rates[bisect_right(bounds, amount) - 1]
+        return fixed + amount * rate
+
+    def tiers(self, country=None, hour=None):
+        """The list of :class:`FeeTier` objects in effect; used to
+        render the fee table.
+        """
+        hour = datetime.utcnow().hour if hour is None else hour
+        return self._table(country, hour)[2]
+
+    @property
+    def has_special_rates(self):
+        """Whether some fees depend on destination country or time."""
+        return any(r['countries'] or r['hours'] is not None
+                   for r in self.rules)
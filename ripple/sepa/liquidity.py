@@ -0,0 +1,196 @@
+"""How much we can still pay out: the EUR balance at the bank, minus
+what we owe for paid tickets not yet handed to the bank, and what we
+may yet owe for quotes that can still be paid.
+
+The balance is kept in ``LIQUIDITY_BALANCE_FILE``, written either by
+hand, by whatever watches the bank account, or through ``/on_balance``.
+It contains the balance available for new transfers, as a plain
+decimal number.
+
+The commitments, the amounts of ``quoted``, ``received`` and
+``sending`` tickets, are kept in memory. Each worker adjusts them for
+the tickets it creates and the transitions it commits itself, and
+recomputes them from the database every ``LIQUIDITY_SYNC_INTERVAL``
+seconds in a background thread, which picks up what the other workers
+did, and a changed balance file. Checking a quote against the ledger
+therefore costs no queries.
+"""
+
+from decimal import Decimal
+import os
+import threading
+
+import logbook
+import sqlalchemy
+from sqlalchemy import event
+
+from ripple.sepa.model import (
+    db, Ticket, RoutingSession, tickets_changed, ticket_transitioned)
+from ripple.sepa.utils import BackgroundRefresh
+
+
+log = logbook.Logger(__name__)
+
+
+# Quoted, or paid for and not yet with the bank. Expired quotes are
+# marked failed, and no longer count.
+COMMITTED = ('quoted', 'received', 'sending')
+
+
+def commitment(status, failed, amount):
+    """What a ticket in this state holds of the balance."""
+    if status in COMMITTED and not failed and amount:
+        return amount
+    return Decimal('0')
+
+
+def valid_balance(balance):
+    return balance.is_finite() and balance >= 0
+
+
+class LiquidityLedger(object):
+
+    def __init__(self, balance_file=None, interval=30):
+        self.balance_file = balance_file
+        self.interval = interval
+        self.engine = None
+        self.balance = None
+        self.committed = Decimal('0')
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._background = BackgroundRefresh(
+            self.sync, interval, log,
+            'Unable to update the liquidity ledger: {}')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['LIQUIDITY_BALANCE_FILE'],
+                   config['LIQUIDITY_SYNC_INTERVAL'])
+
+    @property
+    def enabled(self):
+        return bool(self.balance_file)
+
+    @property
+    def available(self):
+        if self.balance is None:
+            return Decimal('0')
+        return self.balance - self.committed
+
+    def adjust(self, delta):
+        with self._lock:
+            self.committed += delta
+
+    def _load_balance(self):
+        try:
+            mtime = os.stat(self.balance_file).st_mtime
+        except FileNotFoundError:
+            log.warning('No balance in {}; refusing quotes',
+                        self.balance_file)
+            self.balance = None
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.balance_file) as f:
+            balance = Decimal(f.read().strip())
+        self._mtime = mtime
+        if not valid_balance(balance):
+            log.error('Invalid balance {} in {}; refusing quotes',
+                      balance, self.balance_file)
+            balance = None
+        self.balance = balance
+
+    def set_balance(self, balance):
+        """Record a new balance, for all worker processes."""
+        temp = '%s.%s.tmp' % (self.balance_file, os.getpid())
+        with open(temp, 'w') as f:
+            f.write('%s\n' % balance)
+        os.replace(temp, self.balance_file)
+        self.balance = balance
+        self._mtime = os.stat(self.balance_file).st_mtime
+
+    def sync(self):
+        """Read the balance again if it changed, and recompute the
+        commitments from the database.
+        """
+        self._load_balance()
+        table = Ticket.__table__
+        with self.engine.connect() as conn:
+            committed = conn.execute(
+                sqlalchemy.select([sqlalchemy.func.sum(table.c.amount)])
+                    .where(table.c.status.in_(COMMITTED))
+                    .where(sqlalchemy.or_(table.c.failed == None,
+                                          table.c.failed == ''))).scalar()
+        with self._lock:
+            self.committed = Decimal(committed or 0)
+        self._background.refreshed()
+
+    def can_pay(self, amount):
+        """Whether ``amount`` can be paid out on top of what we owe."""
+        if not self.enabled:
+            return True
+        self._background.maybe_start()
+        return self.balance is not None and amount <= self.available
+
+    def stale(self):
+        """Recompute the commitments at the next opportunity."""
+        self._background.done_at = None
+
+
+def _ledger(session):
+    app = getattr(session, 'app', None)
+    ledger = app.extensions.get('liquidity') if app else None
+    return ledger if ledger and ledger.enabled else None
+
+
+@ticket_transitioned.connect
+def _record_transition(ticket, previous=(None, None)):
+    delta = commitment(ticket.status, ticket.failed, ticket.amount) - \
+        commitment(previous[0], previous[1], ticket.amount)
+    if delta:
+        session = db.session()
+        session.info['liquidity'] = \
+            session.info.get('liquidity', Decimal('0')) + delta
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_new(session, flush_context):
+    # New quotes are inserted, rather than transitioned.
+    for obj in session.new:
+        if isinstance(obj, Ticket):
+            delta = commitment(obj.status, obj.failed, obj.amount)
+            if delta:
+                session.info['liquidity'] = \
+                    session.info.get('liquidity', Decimal('0')) + \
+                    Decimal(delta)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_changes(session):
+    delta = session.info.pop('liquidity', None)
+    ledger = _ledger(session)
+    if delta and ledger:
+        ledger.adjust(delta)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('liquidity', None)
+
+
+@tickets_changed.connect
+def _on_bulk_change(app, ids):
+    # Which tickets a bulk update moved in or out of the commitments is
+    # not known here; count again.
+    ledger = app.extensions.get('liquidity')
+    if ledger:
+        ledger.stale()
+
+
+def init_app(app):
+    ledger = app.extensions['liquidity'] = LiquidityLedger.from_config(app.config)
+    if not ledger.enabled:
+        return
+    with app.app_context():
+        ledger.engine = db.get_engine(app)
+    ledger.sync()
@@ -0,0 +1,264 @@
+"""Load test for the payment notification webhook, ``/on_payment``.
+
+Creates quotes, then replays wasipaid-style notifications for them at
+a given rate and concurrency against a running bridge: one correct
+payment per quote, plus duplicates of some, payments of the wrong
+amount and payments for unknown invoices. Reports throughput and
+latency, and checks that every ticket ended up where it should, with
+every transfer submitted exactly once. Of the two deliveries of a
+duplicated notification, the bridge answers the later one with a 500,
+as the ticket was already processed.
+
+No upstream is contacted. This starts a stub SEPA backend, which the
+bridge under test has to be configured to use; it also needs to skip
+the wasipaid receipt check (``RECEIPT_DEBUGGING = True`` in config.py),
+and use Postmark's test key::
+
+    SEPA_API=http://127.0.0.1:8099/ POSTMARK_KEY=POSTMARK_API_TEST \\
+        gunicorn wsgi:app --workers 6
+    ./manage.py loadtest http://127.0.0.1:8000 --quotes 500 --rate 100
+
+The final state is read from the database, so run this with the same
+configuration as the bridge under test.
+
+The daily limits apply to the quotes, so raise ``BRIDGE_TX_LIMIT`` on
+the bridge under test. If quoting is disabled, the tickets are created
+in the database directly instead.
+"""
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import binascii
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+
+import requests
+
+from ripple.sepa.model import db, Ticket, REFERENCE_LENGTH
+from ripple.sepa.utils import bridge_addresses, assign_bridge_address
+
+
+class SepaStub(socketserver.ThreadingMixIn, HTTPServer):
+    """Accepts every transfer, after ``latency`` seconds, and counts
+    the submissions per reference.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, latency=0):
+        self.latency = latency
+        self.submissions = Counter()
+        self.lock = threading.Lock()
+        HTTPServer.__init__(self, ('127.0.0.1', port), _StubHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        transfer = json.loads(self.rfile.read(length).decode('utf-8'))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.submissions[transfer['id']] += 1
+        body = b'{"success": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def sample_iban(n):
+    """A valid German IBAN for account ``n``; quotes for different IBANs
+    do not share a user limit.
+    """
+    bban = '37040044%010d' % n
+    check = 98 - int(bban + '131400') % 97
+    return 'DE%02d%s' % (check, bban)
+
+
+def create_quotes(url, count, amount):
+    """Request ``count`` quotes, and return ``(invoice_id, value,
+    address)`` for each, plus a Counter of the errors returned.
+    """
+    quotes, errors = [], Counter()
+    session = requests.Session()
+    for n in range(count):
+        result = session.get(url + '/quote', params={
+            'type': 'quote', 'amount': '%s/EUR' % amount,
+            'name': 'Load Test', 'bic': 'COBADEFFXXX',
+            'iban': sample_iban(n), 'text': 'load test %s' % n}).json()
+        if 'quote' not in result:
+            errors[result.get('error', 'unknown')] += 1
+            if result.get('error') == 'disabled':
+                break
+            continue
+        quote = result['quote']
+        quotes.append((quote['invoice_id'], quote['send'][0]['value'],
+                       quote['address']))
+    return quotes, errors
+
+
+def seed_quotes(app, count, amount):
+    """Create tickets in the database, for when quoting is disabled."""
+    fees = app.extensions['fee_schedule']
+    addresses = bridge_addresses(app.config)
+    quotes = []
+    for n in range(count):
+        iban = sample_iban(n)
+        ticket = Ticket(amount=amount, fee=fees.fee(amount, iban),
+                        name='Load Test', bic='COBADEFFXXX', iban=iban,
+                        text='load test %s' % n)
+        db.session.add(ticket)
+        quotes.append((ticket.id, '%s' % (ticket.amount + ticket.fee),
+                       assign_bridge_address(ticket.id, addresses)))
+    db.session.commit()
+    return quotes
+
+
+def notification(invoice_id, value, address, tx_hash=None):
+    """A notification as wasipaid sends it."""
+    return json.dumps({
+        'transaction': {'hash': tx_hash or
+                        binascii.hexlify(os.urandom(32)).decode('ascii')},
+        'ledger': {},
+        'data': {
+            'sender': 'rLoadTestSender',
+            'destination': address,
+            'amount': value,
+            'currency': 'EUR',
+            'issuer': '',
+            'tag': '',
+            'invoice_id': invoice_id,
+        }
+    })
+
+
+def plan(quotes, duplicates=0.1, wrong_amount=0.05, unknown=0.05, seed=None):
+    """The notifications to send, as shuffled ``(kind, invoice_id,
+    body)`` tuples, and the kind of payment each quote received.
+    """
+    rng = random.Random(seed)
+    quotes = list(quotes)
+    rng.shuffle(quotes)
+    wrong = quotes[:int(len(quotes) * wrong_amount)]
+    paid = quotes[len(wrong):]
+
+    sends, expected, bodies = [], {}, {}
+    for invoice_id, value, address in wrong:
+        value = '%s' % (Decimal(value) - Decimal('0.01'))
+        sends.append(('wrong_amount', invoice_id,
+                      notification(invoice_id, value, address)))
+        expected[invoice_id] = 'wrong_amount'
+    for invoice_id, value, address in paid:
+        bodies[invoice_id] = notification(invoice_id, value, address)
+        sends.append(('payment', invoice_id, bodies[invoice_id]))
+        expected[invoice_id] = 'payment'
+    # Repeated deliveries of the same notification
+    for invoice_id, value, address in paid[:int(len(quotes) * duplicates)]:
+        sends.append(('duplicate', invoice_id, bodies[invoice_id]))
+    for n in range(int(len(quotes) * unknown)):
+        invoice_id = binascii.hexlify(os.urandom(32)).decode('ascii')
+        sends.append(('unknown', invoice_id, notification(
+            invoice_id, '1.00', quotes[0][2] if quotes else '')))
+    rng.shuffle(sends)
+    return sends, expected
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def replay(url, sends, rate, concurrency):
+    """Send the notifications at ``rate`` per second, with at most
+    ``concurrency`` in flight. Returns the elapsed time, and the status
+    code (or exception name) and latency of each send, by kind.
+    """
+    results = defaultdict(list)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(kind, body):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.time()
+        try:
+            status = local.session.post(
+                url + '/on_payment', data=body,
+                headers={'Content-Type': 'application/json'}).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        with lock:
+            results[kind].append((status, time.time() - started))
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, (kind, invoice_id, body) in enumerate(sends):
+            delay = started + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, kind, body)
+    return time.time() - started, results
+
+
+def check(expected, submissions):
+    """Compare the tickets and the transfers the stub received with
+    what the notifications should have done. Returns a list of problems.
+    """
+    problems = []
+    tickets = {}
+    ids = list(expected)
+    for i in range(0, len(ids), 500):
+        for ticket in Ticket.query.filter(Ticket.id.in_(ids[i:i+500])):
+            tickets[ticket.id] = ticket
+    for invoice_id, kind in expected.items():
+        ticket = tickets.get(invoice_id)
+        submitted = submissions.get(invoice_id[:REFERENCE_LENGTH], 0)
+        if not ticket:
+            problems.append('%s: ticket missing' % invoice_id)
+        elif kind == 'payment' and (ticket.status != 'sent' or ticket.failed):
+            problems.append('%s: paid, but %s %s' % (
+                invoice_id, ticket.status, ticket.failed or ''))
+        elif kind == 'wrong_amount' and ticket.failed != 'unexpected':
+            problems.append('%s: wrong amount, but not failed' % invoice_id)
+        if submitted != (1 if kind == 'payment' else 0):
+            problems.append('%s: %s submitted %s times' % (
+                invoice_id, kind, submitted))
+    return problems
+
+
+def report(elapsed, results, problems, out):
+    total = sum(len(r) for r in results.values())
+    out('%s notifications in %.1fs: %.1f/s' % (
+        total, elapsed, total / elapsed if elapsed else 0))
+    for kind in sorted(results):
+        latencies = [l * 1000 for s, l in results[kind]]
+        codes = Counter(s for s, l in results[kind])
+        out('  %-13s %5s  p50 %6.1fms  p90 %6.1fms  p99 %6.1fms  '
+            'max %6.1fms  %s' % (
+                kind, len(latencies), percentile(latencies, 50),
+                percentile(latencies, 90), percentile(latencies, 99),
+                max(latencies), dict(codes)))
+    if problems:
+        out('%s inconsistencies:' % len(problems))
+        for problem in problems:
+            out('  ' + problem)
+    else:
+        out('All tickets consistent.')
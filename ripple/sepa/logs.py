@@ -0,0 +1,114 @@
+"""Logging that does not block requests.
+
+Request threads format records as JSON, one object per line, and put
+them on a bounded queue; a background thread writes them to stderr.
+When the queue is full, for example during a storm of errors, records
+are dropped rather than queued without limit, and the number dropped
+is reported once the writer catches up.
+"""
+
+import atexit
+import json
+import queue
+import threading
+
+import logbook
+from logbook.handlers import WrapperHandler
+
+
+def json_formatter(record, handler):
+    data = {
+        'time': record.time.isoformat() + 'Z',
+        'level': record.level_name,
+        'channel': record.channel,
+        'message': record.message,
+        'thread': record.thread_name,
+    }
+    if record.exc_info:
+        data['exception'] = record.formatted_exception
+    data.update(record.extra)
+    return json.dumps(data, default=str)
+
+
+class QueuedHandler(WrapperHandler):
+    """Has the stream handler ``handler`` write records in a background
+    thread, keeping at most ``maxsize`` of them waiting. ``dropped``
+    counts the records that did not fit.
+
+    Like logbook's own ``ThreadedWrapperHandler``, but bounded, and
+    formatting the record before it is queued, while everything it
+    refers to is still as it was when logged.
+    """
+
+    _direct_attrs = frozenset(
+        ['handler', 'queue', 'dropped', '_reported', '_lock', '_thread'])
+
+    def __init__(self, handler, maxsize=10000):
+        WrapperHandler.__init__(self, handler)
+        self.queue = queue.Queue(maxsize)
+        self.dropped = self._reported = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.handler.format_and_encode(record))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+        self.handler.close()
+
+    def _write(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            self._write_line(line)
+            if self.queue.empty():
+                self._report_dropped()
+
+    def _write_line(self, line):
+        with self.handler.lock:
+            try:
+                self.handler.write(line)
+                self.handler.flush()
+            except Exception:
+                # Nowhere left to report this.
+                pass
+
+    def _report_dropped(self):
+        with self._lock:
+            count, self._reported = self.dropped - self._reported, self.dropped
+        if count:
+            record = logbook.LogRecord(
+                __name__, logbook.WARNING,
+                '{} log records dropped, the log queue was full', [count])
+            record.heavy_init()
+            self._write_line(self.handler.format_and_encode(record))
+
+
+_installed = None
+_install_lock = threading.Lock()
+
+
+def install(maxsize):
+    """Send INFO and above to stderr as JSON, through a
+    :class:`QueuedHandler`. Only the first call sets it up; later ones,
+    from further apps in the same process, return the same handler.
+    """
+    global _installed
+    with _install_lock:
+        if _installed is None:
+            stderr = logbook.StderrHandler(level='INFO')
+            stderr.formatter = json_formatter
+            _installed = QueuedHandler(stderr, maxsize)
+            _installed.push_application()
+            # Write out whatever is still queued when the process exits.
+            atexit.register(_installed.close)
+        return _installed
@@ -1,20 +1,107 @@
 import binascii
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from decimal import Decimal
+from functools import partial, wraps
 import os
-from flask.ext.sqlalchemy import SQLAlchemy
+from blinker import Namespace
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
 import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.exc import IntegrityError
 
 
-db = SQLAlchemy()
+class RoutingSession(_SignallingSession):
+    """Sends reads to the ``replica`` bind while :meth:`RoutingSQLAlchemy.replica`
+    is active, and everything else to the primary.
+
+    Flushes always go to the primary, so an accidental write within a
+    replica block ends up where it belongs.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.use_replica = False
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and not self._flushing and \
+                'replica' in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+            return self.db.get_engine(self.app, bind='replica')
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Adds optional read-replica routing to the session.
+
+    The rule is: anything shown to a user or an operator, where a few
+    seconds of replication lag do not matter, may read from the replica.
+    Anything that decides whether money moves - limit checks in
+    ``quote()``, the ticket lookup in ``on_payment_received`` - must
+    read from the primary, since a lagging replica would let concurrent
+    requests slip past a check. Reads default to the primary; opt in
+    with :meth:`replica` or :func:`reads_from_replica`.
+    """
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(
+            partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+    @contextmanager
+    def replica(self):
+        session = self.session()
+        previous = session.use_replica
+        session.use_replica = True
+        try:
+            yield
+        finally:
+            session.use_replica = previous
+
+
+db = RoutingSQLAlchemy()
+
+
+# The SEPA backend is given the first 35 characters of the ticket id
+# as the end-to-end reference; this is all it, and the bank, know.
+REFERENCE_LENGTH = 35
+
+# Statements that look tickets up by reference take two bound parameters
+# for each (see :meth:`Ticket.with_reference`); SQLite allows no more
+# than 999 in a statement, including the other conditions.
+REFERENCE_BATCH_SIZE = 490
+
+
+signals = Namespace()
+# Sent with ``ids`` after ticket status changes applied in bulk were
+# committed; anything caching ticket state should subscribe.
+tickets_changed = signals.signal('tickets-changed')
+# Sent with the ticket whenever :meth:`Ticket.transition` changed it,
+# and the ``previous`` (status, failed); the change is not committed yet.
+ticket_transitioned = signals.signal('ticket-transitioned')
+
+
+def reads_from_replica(f):
+    """Decorator for read-only views."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with db.replica():
+            return f(*args, **kwargs)
+    return wrapper
 
 
 class Ticket(db.Model):
     """Tracks a transfer from initial quote to confirmed submission.
 
+    Finished tickets are eventually moved to the ``ticket_archive``
+    table, see :meth:`archive_finished`.
+
     Possible status values are:
 
-    quoted - Temporary quote, will be deleted if no payment is made.
+    quoted - Temporary quote; if no payment is made, it is marked as
+       failed with ``expired``. A late payment is still processed, until
+       the quote is cleared; see :meth:`clear_expired`.
     received - We received the Ripple payment for the quote, and have
        queued up a bank transfer.
     sent - The SEPA backend has confirmed the execution of the transfer.
@@ -25,6 +112,13 @@ class Ticket(db.Model):
     amount = db.Column(db.Numeric)
     fee = db.Column(db.Numeric)
     created_at = db.Column(db.DateTime(timezone=False))
+    # Stamped on every change, including bulk updates; lets
+    # :mod:`ripple.sepa.stats` find what changed since its last run.
+    updated_at = db.Column(
+        db.DateTime(timezone=False), index=True,
+        default=datetime.utcnow, onupdate=datetime.utcnow)
+    # When the payment was accepted.
+    paid_at = db.Column(db.DateTime(timezone=False))
     ripple_address = db.Column(db.String(255))
     status = db.Column(db.String(255), index=True)
     failed = db.Column(db.String(255), index=True)
@@ -32,6 +126,11 @@ class Ticket(db.Model):
     bic = db.Column(db.String(255))
     iban = db.Column(db.String(255))
     text = db.Column(db.String(255))
+    # Set if the quote was paid in another currency than EUR: what was
+    # to be paid in it, and the version of the exchange rates used.
+    currency = db.Column(db.String(40))
+    send_amount = db.Column(db.Numeric)
+    rate_version = db.Column(db.String(64))
 
     def __init__(self, amount=None, fee=None, name=None, bic=None,
                  iban=None, text=None):
@@ -45,9 +144,22 @@ class Ticket(db.Model):
         self.created_at = datetime.utcnow()
         self.status = 'quoted'
 
+    QUOTE_LIFETIME = timedelta(seconds=3600)
+
+    @property
+    def send_currency(self):
+        return self.currency or 'EUR'
+
+    @property
+    def send_value(self):
+        """What the sender has to pay, in :attr:`send_currency`."""
+        if self.send_amount is not None:
+            return self.send_amount
+        return self.amount + self.fee
+
     @property
     def expires(self):
-        return self.created_at + timedelta(seconds=3600)
+        return self.created_at + self.QUOTE_LIFETIME
 
     @property
     def status_text(self):
@@ -66,16 +178,50 @@ class Ticket(db.Model):
         if not self.failed:
             return ''
         try:
-            return {'cancelled': 'The transfer was cancelled.'}[self.failed]
+            return {'cancelled': 'The transfer was cancelled.',
+                    'expired': 'The quote expired unpaid.'}[self.failed]
         except KeyError:
             return 'Error Code: %s' % self.failed
 
+    @property
+    def display_status(self):
+        return self.error_text if self.failed else self.status_text
+
+    # What :meth:`clear` does, as values for :meth:`transition`.
+    CLEARED = {'bic': '', 'iban': '', 'recipient_name': '', 'text': ''}
+
     def clear(self):
         self.bic = self.iban = self.recipient_name = self.text = ''
 
+    def transition(self, from_status, to_status, where=None, **values):
+        """Move the ticket to ``to_status`` with a compare-and-set UPDATE,
+        provided it is still in one of the ``from_status`` states in the
+        database, and matches the criterion ``where`` if given; also sets
+        any further column ``values``.
+
+        Returns True if this call made the change, in which case this
+        instance reflects it. Does not commit.
+        """
+        values = dict(values, status=to_status)
+        previous = (self.status, self.failed)
+        query = Ticket.query\
+            .filter(Ticket.id == self.id, Ticket.status.in_(from_status))
+        if where is not None:
+            query = query.filter(where)
+        changed = query.update(values, synchronize_session=False)
+        if not changed:
+            return False
+        for key, value in values.items():
+            orm.attributes.set_committed_value(self, key, value)
+        ticket_transitioned.send(self, previous=previous)
+        return True
+
     @classmethod
     def tx_volume_today(cls, iban=None):
         """Determine the volume handled by the bridge today.
+
+        When used for a limit check, call this outside of a replica
+        block; see :class:`RoutingSQLAlchemy`.
         """
         today = datetime.utcnow().date()
         query = (db.session
@@ -93,3 +239,376 @@ class Ticket(db.Model):
             query = query.filter(Ticket.iban == iban)
         volume = query.one()[0]
         return volume or Decimal('0')
+
+    @classmethod
+    def with_reference(cls, references):
+        """Criterion for the tickets whose reference is one of the
+        lowercase ``references``; it takes two bound parameters each.
+        """
+        # Ids are lowercase hex, so the tickets with a reference as
+        # prefix are a range of the primary key index: from the
+        # reference up to, and excluding, the reference followed by 'g'.
+        id = cls.__table__.c.id
+        return sqlalchemy.or_(*[sqlalchemy.and_(id >= r, id < r + 'g')
+                                for r in sorted(references)])
+
+    @classmethod
+    def bulk_update(cls, references, from_status, **values):
+        """Set ``values`` on all tickets whose reference is listed in
+        ``references`` and whose status is one of ``from_status``, with
+        one UPDATE per :data:`REFERENCE_BATCH_SIZE` references. Does not
+        commit.
+
+        Returns the ids of the tickets changed.
+        """
+        references = sorted(set(r.lower() for r in references
+                                if len(r) == REFERENCE_LENGTH))
+        ids = []
+        for i in range(0, len(references), REFERENCE_BATCH_SIZE):
+            ids.extend(cls._bulk_update(
+                references[i:i+REFERENCE_BATCH_SIZE], from_status, values))
+        return ids
+
+    @classmethod
+    def _bulk_update(cls, references, from_status, values):
+        table = cls.__table__
+        criterion = sqlalchemy.and_(
+            cls.with_reference(references), table.c.status.in_(from_status))
+        if db.session.get_bind(cls.__mapper__).dialect.name == 'postgresql':
+            return [row[0] for row in db.session.execute(
+                table.update().where(criterion).values(**values)
+                    .returning(table.c.id))]
+        # Without RETURNING, find out which tickets first, locking them.
+        ids = [row[0] for row in db.session.query(Ticket.id)
+                   .filter(criterion).with_for_update()]
+        if ids:
+            db.session.execute(table.update().where(criterion).values(**values))
+        return ids
+
+    # Quotes that expired unpaid, and can still be paid late.
+    LATE_PAYABLE = sqlalchemy.and_(
+        failed == 'expired', iban != None, iban != '')
+
+    @classmethod
+    def clear_expired(cls, days):
+        """Clear the recipient data of quotes that expired unpaid more
+        than ``days`` ago. Late payments are no longer sent for them,
+        and :meth:`archive_finished` can move them away. Returns the
+        number cleared. Commits.
+        """
+        cutoff = datetime.utcnow() - cls.QUOTE_LIFETIME - timedelta(days=days)
+        cleared = Ticket.query\
+            .filter(Ticket.status == 'quoted', Ticket.LATE_PAYABLE,
+                    Ticket.created_at < cutoff)\
+            .update(cls.CLEARED, synchronize_session=False)
+        db.session.commit()
+        return cleared
+
+    @classmethod
+    def finished_before(cls, cutoff):
+        """Tickets that are no longer needed on any live path: processed
+        or failed, with the recipient data cleared, and created before
+        ``cutoff``.
+        """
+        return sqlalchemy.and_(
+            sqlalchemy.or_(
+                Ticket.status.in_(('sent', 'confirmed')), FAILED),
+            sqlalchemy.or_(Ticket.iban == None, Ticket.iban == ''),
+            Ticket.created_at < cutoff)
+
+    @classmethod
+    def archive_finished(cls, days, batch_size=1000):
+        """Move finished tickets older than ``days`` into the archive
+        table. Each batch is moved with one INSERT .. SELECT and one
+        DELETE in its own transaction. Returns the number of tickets
+        moved.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        columns = [c.name for c in Ticket.__table__.columns]
+        moved = 0
+        while True:
+            ids = [row[0] for row in db.session
+                .query(Ticket.id)
+                .filter(cls.finished_before(cutoff))
+                .limit(batch_size)]
+            if not ids:
+                break
+            db.session.execute(ticket_archive.insert().from_select(
+                columns,
+                sqlalchemy.select([Ticket.__table__.c[c] for c in columns])
+                    .where(Ticket.id.in_(ids))))
+            db.session.execute(
+                Ticket.__table__.delete().where(Ticket.id.in_(ids)))
+            db.session.commit()
+            moved += len(ids)
+        return moved
+
+
+# Tickets that have, or have not, been marked failed (or cancelled).
+NOT_FAILED = sqlalchemy.or_(Ticket.failed == None, Ticket.failed == '')
+FAILED = sqlalchemy.and_(Ticket.failed != None, Ticket.failed != '')
+
+
+class LimitBudget(db.Model):
+    """The volume reserved per day, for the bridge as a whole (``key`` is
+    :attr:`BRIDGE`) and for each IBAN, in cents.
+
+    A quote reserves its amount with a conditional UPDATE that either
+    fits the amount under the limit or changes nothing, so no matter how
+    many workers quote concurrently, a limit cannot be exceeded. The
+    rows are only locked for the duration of the quoting transaction.
+    Quotes that expire unpaid give their reservation back in
+    :meth:`release_expired`.
+    """
+    BRIDGE = '*'
+
+    day = db.Column(db.Date, primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    used = db.Column(db.BigInteger, nullable=False)
+
+    @staticmethod
+    def cents(amount):
+        return int(Decimal(amount) * 100)
+
+    @classmethod
+    def reserve(cls, amount, limits):
+        """Reserve ``amount`` for today against each of the ``(key, limit)``
+        pairs given.
+
+        Returns None on success; the caller has to commit. Otherwise,
+        rolls back the session and returns the key whose limit would be
+        exceeded. Callers should always pass the keys in the same order
+        (IBAN before bridge) so that concurrent reservations cannot
+        deadlock.
+        """
+        day = datetime.utcnow().date()
+        amount = cls.cents(amount)
+        for attempt in range(2):
+            try:
+                for key, limit in limits:
+                    if not cls._try_reserve(day, key, amount, cls.cents(limit)):
+                        db.session.rollback()
+                        return key
+                return None
+            except IntegrityError:
+                # Another worker created the same budget row first.
+                db.session.rollback()
+        raise RuntimeError('Unable to create limit budget')
+
+    @classmethod
+    def _try_reserve(cls, day, key, amount, limit):
+        table = cls.__table__
+        update = table.update()\
+            .where(table.c.day == day)\
+            .where(table.c.key == key)\
+            .where(table.c.used + amount <= limit)\
+            .values(used=table.c.used + amount)
+        if db.session.execute(update).rowcount:
+            return True
+
+        exists = db.session.query(cls.key).filter_by(day=day, key=key).first()
+        if exists:
+            return False
+
+        # First reservation of the day; start from what has already been
+        # paid for, so that this also holds for tickets from before the
+        # budgets were introduced.
+        used = cls.cents(Ticket.tx_volume_today(
+            None if key == cls.BRIDGE else key))
+        db.session.execute(table.insert().values(day=day, key=key, used=used))
+        return db.session.execute(update).rowcount == 1
+
+    @classmethod
+    def release_expired(cls, batch_size=500):
+        """Mark quotes that have expired without being paid as failed,
+        and give their reserved amount back to the budgets. Returns the
+        number of quotes released.
+
+        The tickets are kept, recipient data included, so that a payment
+        arriving late still finds its ticket; see
+        :meth:`Ticket.clear_expired`.
+        """
+        cutoff = datetime.utcnow() - Ticket.QUOTE_LIFETIME
+        tickets = Ticket.query\
+            .filter(Ticket.status == 'quoted')\
+            .filter(NOT_FAILED)\
+            .filter(Ticket.created_at < cutoff)\
+            .limit(batch_size)\
+            .with_for_update()\
+            .all()
+        if not tickets:
+            return 0
+
+        totals = {}
+        for ticket in tickets:
+            day = ticket.created_at.date()
+            for key in (ticket.iban, cls.BRIDGE):
+                if key:
+                    totals[(day, key)] = \
+                        totals.get((day, key), 0) + cls.cents(ticket.amount)
+
+        # Same lock order as in reserve(): IBANs first, the bridge last.
+        table = cls.__table__
+        for (day, key), amount in sorted(
+                totals.items(), key=lambda i: (i[0][1] == cls.BRIDGE, i[0])):
+            db.session.execute(table.update()
+                .where(table.c.day == day)
+                .where(table.c.key == key)
+                .values(used=table.c.used - amount))
+        Ticket.query\
+            .filter(Ticket.id.in_([t.id for t in tickets]))\
+            .update({'failed': 'expired'}, synchronize_session=False)
+        db.session.commit()
+        return len(tickets)
+
+
+class SubmissionRetry(db.Model):
+    """A transfer the SEPA backend did not accept, to be submitted again
+    by the retry worker (see :mod:`ripple.sepa.retry`).
+
+    The ticket stays in ``received`` meanwhile. ``due_at`` is indexed,
+    so finding the next due submissions does not scan anything. Once the
+    worker gives up, ``due_at`` is cleared, and the row kept for the
+    admin to re-queue the ticket; also when the admin fails or cancels
+    the ticket, but then it cannot be re-queued.
+    """
+    ticket_id = db.Column(db.String, primary_key=True)
+    tx_hash = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    due_at = db.Column(db.DateTime(timezone=False), index=True)
+    last_error = db.Column(db.Text)
+
+    @classmethod
+    def schedule(cls, ticket, tx_hash, error, delay=0):
+        """Record a failed submission of ``ticket``; does not commit."""
+        retry = cls.query.get(ticket.id) or cls(
+            ticket_id=ticket.id, tx_hash=tx_hash, attempts=0)
+        retry.last_error = error
+        retry.due_at = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.add(retry)
+        return retry
+
+    @classmethod
+    def schedule_all(cls, criterion):
+        """Make the retries of the tickets matching ``criterion`` due
+        now, with a single UPDATE. Tickets without one are left alone:
+        without the hash of their payment, the backend could not verify
+        it. Does not commit.
+        """
+        table = cls.__table__
+        db.session.execute(table.update()
+            .where(table.c.ticket_id.in_(
+                sqlalchemy.select([Ticket.id]).where(criterion)))
+            .values(due_at=datetime.utcnow(), attempts=0))
+
+    @classmethod
+    def cancel_all(cls, criterion):
+        """Stop retrying the tickets matching ``criterion``. The rows
+        are kept, with the hash of the payment. Does not commit.
+        """
+        table = cls.__table__
+        db.session.execute(table.update()
+            .where(table.c.ticket_id.in_(
+                sqlalchemy.select([Ticket.id]).where(criterion)))
+            .values(due_at=None))
+
+    @classmethod
+    def claim(cls, retry, lease):
+        """Take ``retry`` for ``lease`` seconds by moving its due time,
+        provided nobody else did so first. Commits.
+        """
+        claimed = cls.query\
+            .filter_by(ticket_id=retry.ticket_id, due_at=retry.due_at)\
+            .update({'due_at': datetime.utcnow() + timedelta(seconds=lease)},
+                    synchronize_session=False)
+        db.session.commit()
+        return bool(claimed)
+
+
+class TicketStats(db.Model):
+    """Number, amount and fees of tickets per ``hour`` or ``day`` they
+    were quoted in, by status and failure; see :mod:`ripple.sepa.stats`.
+
+    Unpaid quotes are left out.
+    """
+    __tablename__ = 'ticket_stats'
+    period = db.Column(db.String(4), primary_key=True)
+    start = db.Column(db.DateTime(timezone=False), primary_key=True)
+    status = db.Column(db.String(255), primary_key=True)
+    failed = db.Column(db.String(255), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Numeric, nullable=False)
+    fee = db.Column(db.Numeric, nullable=False)
+
+
+class StatsWatermark(db.Model):
+    """:class:`TicketStats` includes all changes to tickets made before
+    ``updated_before``. There is only ever one row.
+    """
+    __tablename__ = 'stats_watermark'
+    id = db.Column(db.Integer, primary_key=True)
+    updated_before = db.Column(db.DateTime(timezone=False))
+
+
+class SlowQuery(db.Model):
+    """Statements that took longer than ``SLOW_QUERY_THRESHOLD``, by
+    normalized SQL and the view that ran them; see
+    :mod:`ripple.sepa.slowlog`. Times are in seconds.
+    """
+    __tablename__ = 'slow_query'
+    id = db.Column(db.String(40), primary_key=True)
+    view = db.Column(db.String(255))
+    statement = db.Column(db.Text)
+    count = db.Column(db.Integer, nullable=False)
+    total_time = db.Column(db.Float, nullable=False)
+    max_time = db.Column(db.Float, nullable=False)
+    last_seen = db.Column(db.DateTime(timezone=False))
+    plan = db.Column(db.Text)
+
+
+# Finished tickets are only needed for audit purposes, and would
+# otherwise bloat the indices the live paths use. Same columns as the
+# ticket table; a plain table rather than native partitioning so it
+# works on both SQLite and Postgres.
+ticket_archive = sqlalchemy.Table(
+    'ticket_archive', db.metadata,
+    *[c.copy() for c in Ticket.__table__.columns])
+
+
+def upgrade_schema(engine):
+    """Add the columns and indices that tables created by an earlier
+    version lack; ``create_all`` only creates missing tables. Returns
+    a description of each change made.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    changes = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                quote(table.name), quote(column.name),
+                column.type.compile(dialect=engine.dialect)))
+            changes.append('Added column %s.%s' % (table.name, column.name))
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+                changes.append('Created index %s' % index.name)
+    return changes
+
+
+class AnyTicket(object):
+    """Read-only mapping over both live and archived tickets, for the
+    admin.
+    """
+
+_any_ticket = sqlalchemy.union_all(
+    sqlalchemy.select([Ticket.__table__]),
+    sqlalchemy.select([ticket_archive])).alias('any_ticket')
+orm.mapper(AnyTicket, _any_ticket, primary_key=[_any_ticket.c.id])
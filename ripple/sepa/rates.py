@@ -0,0 +1,102 @@
+"""Exchange rates, for quotes paid in XRP or IOUs other than EUR.
+
+The rates are fetched from ``RATES_URL``, a JSON document of the form::
+
+    {"version": "2014-10-18T12:00:00Z",
+     "rates": {"XRP": "0.0042", "USD": "0.79"}}
+
+giving the EUR value of one unit of each currency. ``version`` is
+optional; without it, the rates are identified by a hash of them.
+
+The rates in use are an immutable snapshot held in memory, refreshed
+in the background every ``RATES_REFRESH_INTERVAL`` seconds. If the
+snapshot is older than ``RATES_MAX_AGE``, only EUR is accepted.
+Every ticket quoted in another currency records the version of the
+snapshot it was converted with.
+"""
+
+from collections import namedtuple
+from decimal import Decimal, ROUND_DOWN, ROUND_UP
+import hashlib
+import json
+import time
+
+import logbook
+import requests
+
+from ripple.sepa.utils import BackgroundRefresh
+
+
+log = logbook.Logger(__name__)
+
+
+CENT = Decimal('0.01')
+# XRP is divisible into millionths; IOUs are quoted at the same precision.
+UNIT = Decimal('0.000001')
+
+
+RateSnapshot = namedtuple('RateSnapshot', ['version', 'rates', 'fetched_at'])
+
+
+def parse_rates(data, fetched_at=None):
+    rates = {}
+    for currency, rate in data['rates'].items():
+        rate = Decimal(rate)
+        # Anything else would fail when a quote is rounded to cents.
+        if currency.upper() != 'EUR' and rate.is_finite() and rate > 0:
+            rates[currency.upper()] = rate
+    version = data.get('version')
+    if not version:
+        canonical = json.dumps(sorted(
+            (c, '%s' % r.normalize()) for c, r in rates.items()))
+        version = hashlib.sha1(canonical.encode('ascii')).hexdigest()[:16]
+    return RateSnapshot('%s' % version, rates,
+                        time.time() if fetched_at is None else fetched_at)
+
+
+def to_eur(snapshot, value, currency):
+    """What ``value`` in ``currency`` is worth in EUR, in whole cents
+    (rounded down, so we never pay out more than we were paid).
+    """
+    return (value * snapshot.rates[currency]).quantize(CENT, ROUND_DOWN)
+
+
+def from_eur(snapshot, amount, currency):
+    """How much of ``currency`` pays for ``amount`` EUR (rounded up)."""
+    return (amount / snapshot.rates[currency]).quantize(UNIT, ROUND_UP)
+
+
+class RateFeed(object):
+    """The current rate snapshot."""
+
+    def __init__(self, url=None, interval=60, max_age=300):
+        self.url = url
+        self.interval = interval
+        self.max_age = max_age
+        self.snapshot = None
+        self._background = BackgroundRefresh(
+            self.refresh, interval, log, 'Unable to fetch exchange rates: {}')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['RATES_URL'], config['RATES_REFRESH_INTERVAL'],
+                   config['RATES_MAX_AGE'])
+
+    def refresh(self):
+        response = requests.get(self.url, timeout=10)
+        response.raise_for_status()
+        snapshot = parse_rates(response.json())
+        if not self.snapshot or snapshot.version != self.snapshot.version:
+            log.info('Using exchange rates {}: {}', snapshot.version,
+                     ', '.join('%s %s' % r for r in sorted(snapshot.rates.items())))
+        self.snapshot = snapshot
+        self._background.refreshed()
+
+    def current(self):
+        """The snapshot to quote with, or None if there is no recent one."""
+        if self.url:
+            self._background.maybe_start()
+        snapshot = self.snapshot
+        if not snapshot or time.time() - snapshot.fetched_at > self.max_age:
+            return None
+        return snapshot
@@ -0,0 +1,140 @@
+"""Match bank statements against tickets we submitted.
+
+Statements can be large, so both parsers stream entries one by one,
+and :func:`reconcile` takes them in batches, looking up only the
+tickets each batch refers to.
+"""
+
+import csv
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from xml.etree import ElementTree
+
+from flask import current_app
+from ripple.sepa.model import (
+    db, Ticket, REFERENCE_LENGTH, REFERENCE_BATCH_SIZE, tickets_changed)
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _find(elem, *path):
+    """Like ``elem.find()``, but ignoring XML namespaces."""
+    for name in path:
+        for child in elem:
+            if _local(child.tag) == name:
+                elem = child
+                break
+        else:
+            return None
+    return elem
+
+
+def _text(elem, *path):
+    found = _find(elem, *path)
+    return found.text.strip() if found is not None and found.text else None
+
+
+def parse_camt053(fileobj):
+    """Yield ``(reference, amount)`` for every outgoing transfer in a
+    camt.053 statement.
+
+    Each ``<Ntry>`` is removed from the tree once processed, so memory
+    use does not depend on the size of the statement.
+    """
+    stack = []
+    for event, elem in ElementTree.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if _local(elem.tag) != 'Ntry':
+            continue
+
+        if _text(elem, 'CdtDbtInd') == 'DBIT':
+            entry_amount = _text(elem, 'Amt')
+            details = _find(elem, 'NtryDtls')
+            for tx in (details if details is not None else ()):
+                if _local(tx.tag) != 'TxDtls':
+                    continue
+                amount = _text(tx, 'AmtDtls', 'TxAmt', 'Amt') or \
+                    _text(tx, 'Amt') or entry_amount
+                yield _text(tx, 'Refs', 'EndToEndId'), amount
+
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+
+def parse_csv(fileobj):
+    """Yield ``(reference, amount)`` for each row of a CSV export that
+    has a ``reference`` and an ``amount`` column.
+    """
+    for row in csv.DictReader(fileobj):
+        yield row.get('reference'), row.get('amount')
+
+
+def reconcile(entries, on_unmatched=None, batch_size=REFERENCE_BATCH_SIZE):
+    """Mark ``sent`` tickets found in ``entries`` as ``confirmed``.
+
+    Entries are processed ``batch_size`` at a time, with one SELECT and
+    one UPDATE each. ``on_unmatched`` is called with the reference,
+    amount and reason for every entry that does not correspond to a sent
+    ticket.
+
+    Returns a dict with the number of matched and unmatched entries.
+    """
+    batch_size = min(batch_size, REFERENCE_BATCH_SIZE)
+    counts = {'matched': 0, 'unmatched': 0}
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, batch_size))
+        if not batch:
+            return counts
+        _reconcile_batch(batch, on_unmatched, counts)
+
+
+def _reconcile_batch(entries, on_unmatched, counts):
+    references = set(
+        reference.lower() for reference, amount in entries
+        if reference and len(reference) == REFERENCE_LENGTH)
+    outstanding = {}
+    if references:
+        for id, amount in db.session.query(Ticket.id, Ticket.amount)\
+                .filter(Ticket.with_reference(references),
+                        Ticket.status == 'sent'):
+            outstanding[id[:REFERENCE_LENGTH]] = (id, amount)
+
+    matched = []
+    for reference, amount in entries:
+        reason = None
+        try:
+            amount = Decimal(amount.replace(',', '')) if amount else None
+        except InvalidOperation:
+            amount = None
+
+        ticket = outstanding.get((reference or '').lower())
+        if not ticket:
+            reason = 'no matching sent ticket'
+        elif amount is None or abs(amount) != ticket[1]:
+            reason = 'amount does not match (expected %s)' % ticket[1]
+        else:
+            del outstanding[reference.lower()]
+            matched.append(ticket[0])
+            counts['matched'] += 1
+            continue
+
+        counts['unmatched'] += 1
+        if on_unmatched:
+            on_unmatched(reference, amount, reason)
+
+    if matched:
+        Ticket.query\
+            .filter(Ticket.id.in_(matched), Ticket.status == 'sent')\
+            .update({'status': 'confirmed'}, synchronize_session=False)
+        db.session.commit()
+        tickets_changed.send(current_app._get_current_object(), ids=matched)
+    else:
+        # End the transaction of the lookup.
+        db.session.commit()
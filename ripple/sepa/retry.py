@@ -0,0 +1,142 @@
+"""Resubmits transfers the SEPA backend did not accept.
+
+Runs as a separate process (``manage.py retry-worker``). Failed
+submissions are retried with exponential backoff and jitter, so that a
+backend outage results in a slowly spreading trickle of attempts, and
+at most ``concurrency`` of them are in flight at any time.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import random
+import time
+
+from flask import render_template
+import logbook
+
+from ripple.sepa.model import db, Ticket, SubmissionRetry, NOT_FAILED
+from ripple.sepa.bridge import (
+    submit_transfer, send_mail, report_unknown, SubmissionUnknown)
+
+
+log = logbook.Logger(__name__)
+
+
+def backoff(attempts, base, maximum):
+    """Seconds to wait after the given number of failed attempts."""
+    delay = min(base * 2 ** attempts, maximum)
+    return delay * random.uniform(0.5, 1.5)
+
+
+class RetryScheduler(object):
+
+    # How long a claimed retry is hidden from other workers.
+    LEASE = 300
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.concurrency = config['RETRY_CONCURRENCY']
+        self.base_delay = config['RETRY_BASE_DELAY']
+        self.max_delay = config['RETRY_MAX_DELAY']
+        self.max_attempts = config['RETRY_MAX_ATTEMPTS']
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def run_once(self):
+        """Attempt the submissions that are due, up to ``concurrency``
+        at a time. Returns the number attempted.
+        """
+        with self.app.app_context():
+            # Not for tickets failed or cancelled meanwhile.
+            due = SubmissionRetry.query\
+                .join(Ticket, Ticket.id == SubmissionRetry.ticket_id)\
+                .filter(NOT_FAILED)\
+                .filter(SubmissionRetry.due_at <= datetime.utcnow())\
+                .order_by(SubmissionRetry.due_at)\
+                .limit(self.concurrency)\
+                .all()
+            claimed = [r.ticket_id for r in due
+                       if SubmissionRetry.claim(r, self.LEASE)]
+        for future in [self.pool.submit(self.attempt, id) for id in claimed]:
+            future.result()
+        return len(claimed)
+
+    def run_forever(self, poll_interval=30):
+        while True:
+            if self.run_once():
+                continue
+            with self.app.app_context():
+                next_due = db.session.query(
+                    db.func.min(SubmissionRetry.due_at)).scalar()
+                db.session.remove()
+            wait = poll_interval
+            if next_due:
+                wait = min(wait, max(
+                    (next_due - datetime.utcnow()).total_seconds(), 0))
+            time.sleep(wait)
+
+    def attempt(self, ticket_id):
+        with self.app.app_context():
+            try:
+                self._attempt(ticket_id)
+            except Exception:
+                log.exception('Retrying submission of {} failed', ticket_id)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def _attempt(self, ticket_id):
+        retry = SubmissionRetry.query.get(ticket_id)
+        if not retry:
+            # Finished meanwhile, by another worker or the admin.
+            return
+        ticket = Ticket.query.get(ticket_id)
+
+        # Same protocol as the webhook: move the ticket into "sending"
+        # before calling the backend, but only if nobody else did, and
+        # nobody failed or cancelled it.
+        if not ticket or not ticket.transition(
+                ('received',), 'sending', NOT_FAILED):
+            db.session.delete(retry)
+            db.session.commit()
+            if ticket and ticket.status == 'sending':
+                send_mail('SEPA bridge: Transfer stuck in sending',
+                          'Ticket %s needs to be resolved manually.' % ticket_id)
+            return
+        db.session.commit()
+
+        try:
+            error = submit_transfer(ticket, retry.tx_hash)
+        except SubmissionUnknown as e:
+            # Keep the hash, but do not try again.
+            retry.due_at = None
+            retry.last_error = '%s' % e
+            db.session.commit()
+            report_unknown(ticket, e)
+            return
+        if not error:
+            text = render_template('transfer.txt', ticket=ticket)
+            ticket.transition(('sending',), 'sent', **Ticket.CLEARED)
+            db.session.delete(retry)
+            db.session.commit()
+            send_mail('SEPA bridge: Transaction processed', text)
+            return
+
+        ticket.transition(('sending',), 'received')
+        retry.attempts += 1
+        retry.last_error = error
+        if retry.attempts >= self.max_attempts:
+            # Keep the hash of the payment, for a re-queue by the admin.
+            ticket.failed = 'backend'
+            retry.due_at = None
+            db.session.commit()
+            send_mail('SEPA bridge: Giving up on transfer',
+                      'Ticket %s was not accepted by the backend after %s '
+                      'attempts: %s' % (ticket_id, retry.attempts, error))
+            return
+
+        retry.due_at = datetime.utcnow() + timedelta(seconds=backoff(
+            retry.attempts, self.base_delay, self.max_delay))
+        db.session.commit()
+        log.info('Submission of {} failed again, attempt {}: {}',
+                 ticket_id, retry.attempts, error)
@@ -0,0 +1,136 @@
+"""Screening of transfer recipients against a sanctions list.
+
+The list is a CSV file with a ``name`` and/or an ``iban`` column (other
+columns are ignored), as configured by ``SANCTIONS_LIST``. It is loaded
+into an in-memory index once: IBANs go into a set, names into an index
+from character trigrams to entries, so that a lookup only compares a
+name against the few entries sharing trigrams with it.
+
+The file is checked for changes every ``SANCTIONS_CHECK_INTERVAL``
+seconds; a new version is indexed in the background and swapped in
+once complete, without a restart.
+"""
+
+from collections import Counter, defaultdict
+import csv
+import os
+import re
+import unicodedata
+
+import logbook
+
+from ripple.sepa.utils import BackgroundRefresh
+
+
+log = logbook.Logger(__name__)
+
+
+def normalize_name(name):
+    """Lowercase, without accents or punctuation, and with the words
+    sorted, so that "Doe, John" and "JOHN DOE" look the same.
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    words = re.findall(r'\w+', name.lower())
+    return ' '.join(sorted(words))
+
+
+def normalize_iban(iban):
+    return re.sub(r'\s+', '', iban).upper()
+
+
+def trigrams(name):
+    padded = '  %s ' % name
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class SanctionsIndex(object):
+    """An immutable index over the entries of one version of the list."""
+
+    def __init__(self, names=(), ibans=()):
+        self.ibans = frozenset(normalize_iban(i) for i in ibans if i)
+        self.names = []
+        self._sizes = []
+        self._postings = defaultdict(list)
+        for name in set(normalize_name(n) for n in names if n):
+            grams = trigrams(name)
+            for gram in grams:
+                self._postings[gram].append(len(self.names))
+            self.names.append(name)
+            self._sizes.append(len(grams))
+
+    @classmethod
+    def from_file(cls, path):
+        names, ibans = [], []
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                names.append(row.get('name'))
+                ibans.append(row.get('iban'))
+        return cls(names, ibans)
+
+    def __len__(self):
+        return len(self.names) + len(self.ibans)
+
+    def match_iban(self, iban):
+        return bool(iban) and normalize_iban(iban) in self.ibans
+
+    def match_name(self, name, threshold):
+        """The listed name most similar to ``name``, and the similarity
+        (Dice coefficient of the trigrams, 1.0 being identical), if at
+        least ``threshold``; otherwise None.
+        """
+        grams = trigrams(normalize_name(name))
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        best = None
+        for entry, count in shared.items():
+            score = 2.0 * count / (len(grams) + self._sizes[entry])
+            if score >= threshold and (not best or score > best[1]):
+                best = (self.names[entry], score)
+        return best
+
+
+class Screening(object):
+    """Screens recipients against the current version of the list."""
+
+    def __init__(self, path=None, threshold=0.85, interval=60):
+        self.path = path
+        self.threshold = threshold
+        self.interval = interval
+        self.index = SanctionsIndex()
+        self._mtime = None
+        self._background = BackgroundRefresh(
+            self.reload, interval, log, 'Unable to reload sanctions list: {}')
+        if path:
+            self.reload()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['SANCTIONS_LIST'],
+                   config['SANCTIONS_MATCH_THRESHOLD'],
+                   config['SANCTIONS_CHECK_INTERVAL'])
+
+    def reload(self):
+        """Index the list file, if it changed since last time."""
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            index = SanctionsIndex.from_file(self.path)
+            self.index, self._mtime = index, mtime
+            log.info('Loaded {} sanctions list entries', len(index))
+        self._background.refreshed()
+
+    def screen(self, name, iban):
+        """Returns a description of the match if the recipient is listed,
+        or None.
+        """
+        if self.path:
+            self._background.maybe_start()
+        index = self.index
+        if index.match_iban(iban):
+            return 'IBAN %s is listed' % iban
+        match = index.match_name(name or '', self.threshold)
+        if match:
+            return 'name "%s" matches listed "%s" (%.2f)' % (
+                name, match[0], match[1])
+        return None
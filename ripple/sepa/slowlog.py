@@ -0,0 +1,191 @@
+"""Records statements slower than ``SLOW_QUERY_THRESHOLD``.
+
+Slow statements are timed with engine events and kept in memory until
+the end of the app context (for a web worker, the request), and then
+added to the ``slow_query`` table in short transactions of their own,
+aggregated by normalized SQL and calling view. The first time a
+statement is recorded, its plan is captured with EXPLAIN, using the
+parameters it ran with. Postgres writes these into the plan as
+literals; they may be recipient data, so they are removed before the
+plan is stored.
+
+The table is shown in the admin.
+"""
+
+from collections import deque
+from datetime import datetime
+import hashlib
+import re
+import threading
+import time
+
+from flask import has_request_context, request
+import logbook
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from ripple.sepa.model import db, SlowQuery
+
+
+log = logbook.Logger(__name__)
+
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+# Upper bound on slow statements waiting to be written.
+MAX_PENDING = 1000
+
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def normalize(statement):
+    """Reduce a statement to its shape: placeholders and literals become
+    ``?``, and lists of them a single ``?...``.
+    """
+    sql = STRING_LITERAL.sub('?', statement)
+    sql = re.sub(r'%\(\w+\)s|(?<!:):\w+|%s', '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\?(\s*,\s*\?)+', '?...', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def redact(plan):
+    """Replace the literals in a plan by ``?``. Postgres quotes all but
+    integers, e.g. ``(iban = 'DE89...'::text)``; the costs and row
+    counts stay.
+    """
+    return STRING_LITERAL.sub('?', plan)
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, engine, threshold):
+        # Where the statements are recorded.
+        self.engine = engine
+        self.threshold = threshold
+        self.pending = deque(maxlen=MAX_PENDING)
+        # Statements we know to have a plan recorded.
+        self.explained = set()
+        self._local = threading.local()
+
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('slowlog_started', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed = time.time() - conn.info['slowlog_started'].pop()
+        if elapsed < self.threshold or getattr(self._local, 'busy', False):
+            return
+        view = request.endpoint if has_request_context() else None
+        sql = normalize(statement)
+        key = hashlib.sha1(('%s\n%s' % (view, sql)).encode('utf-8')).hexdigest()
+        self.pending.append((key, view, sql, elapsed, conn.engine,
+                             None if executemany else (statement, parameters)))
+
+    def explain(self, engine, statement, parameters):
+        prefix = EXPLAIN.get(engine.dialect.name)
+        if not prefix or not statement.lstrip().upper().startswith('SELECT'):
+            return None
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(prefix + statement, parameters)
+            return redact('\n'.join(
+                '%s' % row[-1] for row in cursor.fetchall()))
+        except Exception as e:
+            return 'EXPLAIN failed: %s' % e
+        finally:
+            raw.rollback()
+            raw.close()
+
+    def flush(self, exception=None):
+        """Write the pending statements to the database."""
+        if not self.pending:
+            return
+        records = []
+        while self.pending:
+            records.append(self.pending.popleft())
+
+        totals = {}
+        for key, view, sql, elapsed, engine, explainable in records:
+            if key not in totals:
+                totals[key] = dict(view=view, statement=sql, count=0,
+                                   total_time=0, max_time=0, engine=engine,
+                                   explainable=explainable)
+            entry = totals[key]
+            entry['count'] += 1
+            entry['total_time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
+
+        self._local.busy = True
+        try:
+            self._write(totals)
+        except Exception as e:
+            log.error('Unable to record slow queries: {}', e)
+        finally:
+            self._local.busy = False
+
+    def _write(self, totals):
+        table = SlowQuery.__table__
+        engine = self.engine
+        unexplained = set(totals) - self.explained
+        if unexplained:
+            with engine.connect() as conn:
+                self.explained.update(row[0] for row in conn.execute(
+                    sqlalchemy.select([table.c.id])
+                        .where(table.c.id.in_(unexplained))
+                        .where(table.c.plan != None)))
+
+        now = datetime.utcnow()
+        for key, entry in totals.items():
+            plan = None
+            if key not in self.explained and entry['explainable']:
+                plan = self.explain(entry['engine'], *entry['explainable'])
+                self.explained.add(key)
+
+            update = table.update().where(table.c.id == key).values(
+                count=table.c.count + entry['count'],
+                total_time=table.c.total_time + entry['total_time'],
+                max_time=sqlalchemy.case(
+                    [(table.c.max_time < entry['max_time'], entry['max_time'])],
+                    else_=table.c.max_time),
+                last_seen=now,
+                plan=sqlalchemy.func.coalesce(table.c.plan, plan))
+            with engine.begin() as conn:
+                if conn.execute(update).rowcount:
+                    continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(table.insert().values(
+                        id=key, view=entry['view'],
+                        statement=entry['statement'], count=entry['count'],
+                        total_time=entry['total_time'],
+                        max_time=entry['max_time'], last_seen=now, plan=plan))
+            except IntegrityError:
+                # Another worker recorded it just now.
+                with engine.begin() as conn:
+                    conn.execute(update)
+
+
+def init_app(app):
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is None:
+        return
+    with app.app_context():
+        engine = db.get_engine(app)
+        slowlog = app.extensions['slow_queries'] = \
+            SlowQueryLog(engine, threshold)
+        slowlog.watch(engine)
+        if 'replica' in (app.config['SQLALCHEMY_BINDS'] or {}):
+            slowlog.watch(db.get_engine(app, bind='replica'))
+    app.teardown_appcontext(slowlog.flush)
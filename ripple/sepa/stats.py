@@ -0,0 +1,158 @@
+"""Hourly and daily ticket statistics.
+
+:class:`TicketStats` rolls tickets up by the hour and day they were
+quoted in. :func:`refresh`, run from cron via ``manage.py stats``,
+brings it up to date: it finds the tickets changed since its last run
+through the indexed ``updated_at`` column, and recomputes only the
+hours those tickets belong to. Reports read the rollup, never the
+tickets themselves.
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import sqlalchemy
+
+from ripple.sepa.model import db, AnyTicket, TicketStats, StatsWatermark
+
+
+# Transactions still in progress may have stamped their changes a bit
+# before they commit; stay this far behind, so none are missed.
+LAG = timedelta(seconds=60)
+
+PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+# Tickets that are included in the statistics: not unpaid quotes, be
+# they waiting or expired.
+COUNTED = sqlalchemy.or_(
+    AnyTicket.status != 'quoted',
+    sqlalchemy.and_(AnyTicket.failed != None, AnyTicket.failed != '',
+                    AnyTicket.failed != 'expired'))
+
+
+def truncate(dt, period):
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0) if period == 'day' else dt
+
+
+def _ranges(starts, step):
+    """Group sorted bucket starts into ``(first, end)`` runs."""
+    run = None
+    for start in sorted(starts):
+        if run and start == run[1]:
+            run[1] = start + step
+            continue
+        if run:
+            yield tuple(run)
+        run = [start, start + step]
+    if run:
+        yield tuple(run)
+
+
+def _replace(period, buckets, totals):
+    """Replace the ``period`` rows for ``buckets`` by ``totals``."""
+    table = TicketStats.__table__
+    buckets = sorted(buckets)
+    for i in range(0, len(buckets), 500):
+        db.session.execute(table.delete()
+            .where(table.c.period == period)
+            .where(table.c.start.in_(buckets[i:i+500])))
+    rows = [dict(period=period, start=start, status=status, failed=failed,
+                 count=count, amount=amount, fee=fee)
+            for (start, status, failed), (count, amount, fee)
+            in totals.items()]
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+
+def _add(totals, key, count, amount, fee):
+    c, a, f = totals.get(key, (0, Decimal(0), Decimal(0)))
+    totals[key] = (c + count, a + (amount or 0), f + (fee or 0))
+
+
+def refresh(now=None, batch_size=1000):
+    """Recompute the statistics of every hour (and its day) in which a
+    ticket changed since the last run. Commits, and returns the number
+    of hours recomputed.
+    """
+    mark = StatsWatermark.query.get(1) or StatsWatermark(id=1)
+    until = (now or datetime.utcnow()) - LAG
+
+    changed = db.session.query(AnyTicket.created_at).filter(COUNTED)
+    if mark.updated_before:
+        changed = changed.filter(
+            AnyTicket.updated_at >= mark.updated_before,
+            AnyTicket.updated_at < until)
+    hours = {truncate(c, 'hour') for c, in changed.yield_per(batch_size)}
+
+    totals = {}
+    for first, end in _ranges(hours, PERIODS['hour']):
+        tickets = db.session.query(
+                AnyTicket.created_at, AnyTicket.status, AnyTicket.failed,
+                AnyTicket.amount, AnyTicket.fee)\
+            .filter(COUNTED)\
+            .filter(AnyTicket.created_at >= first, AnyTicket.created_at < end)
+        for created_at, status, failed, amount, fee in \
+                tickets.yield_per(batch_size):
+            _add(totals, (truncate(created_at, 'hour'), status, failed or ''),
+                 1, amount, fee)
+    _replace('hour', hours, totals)
+
+    # Days are summed up from their hours.
+    days = {truncate(h, 'day') for h in hours}
+    totals = {}
+    for first, end in _ranges(days, PERIODS['day']):
+        for row in TicketStats.query.filter(
+                TicketStats.period == 'hour',
+                TicketStats.start >= first, TicketStats.start < end):
+            _add(totals, (truncate(row.start, 'day'), row.status, row.failed),
+                 row.count, row.amount, row.fee)
+    _replace('day', days, totals)
+
+    mark.updated_before = until
+    db.session.add(mark)
+    db.session.commit()
+    return len(hours)
+
+
+def rebuild():
+    """Throw the statistics away and compute them from scratch."""
+    TicketStats.query.delete()
+    StatsWatermark.query.delete()
+    return refresh()
+
+
+def series(period='day', start=None, end=None):
+    """The statistics of each ``period`` in ``[start, end)``, oldest
+    first, as JSON-friendly dicts.
+    """
+    query = TicketStats.query.filter(TicketStats.period == period)
+    if start:
+        query = query.filter(TicketStats.start >= start)
+    if end:
+        query = query.filter(TicketStats.start < end)
+
+    buckets = []
+    for row in query.order_by(TicketStats.start):
+        if not buckets or buckets[-1]['start'] != row.start.isoformat():
+            buckets.append({
+                'start': row.start.isoformat(), 'count': 0, 'failed': 0,
+                'amount': Decimal(0), 'fee': Decimal(0), 'by_status': {}})
+        bucket = buckets[-1]
+        bucket['count'] += row.count
+        if row.failed:
+            bucket['failed'] += row.count
+        else:
+            # Only successful tickets make volume and earn fees.
+            bucket['amount'] += row.amount
+            bucket['fee'] += row.fee
+        status = bucket['by_status'].setdefault(
+            row.status, {'count': 0, 'failed': 0})
+        status['count'] += row.count
+        if row.failed:
+            status['failed'] += row.count
+
+    for bucket in buckets:
+        bucket['amount'] = str(bucket['amount'])
+        bucket['fee'] = str(bucket['fee'])
+    return buckets
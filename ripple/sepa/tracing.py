@@ -0,0 +1,344 @@
+"""Where the time of a request goes.
+
+Every request is traced: a span for the request itself, and spans
+within it for each statement and commit, the wasipaid receipt check,
+the SEPA backend call and each mail sent. Calls to upstream services
+carry a W3C ``traceparent`` header, and an incoming one is continued.
+
+Finished traces are
+
+- written to ``TRACE_FILE``, if set, one trace per line in OTLP JSON
+  (``{"resourceSpans": ...}``), from a background thread; a collector
+  can pick them up from there, or ``manage.py traces`` summarizes them;
+- kept in memory, the last ``TRACE_KEEP`` per endpoint, for the tail
+  latency breakdown in the admin.
+
+The breakdown shows, per endpoint, the latency percentiles, and for
+the slowest tenth of requests, the average time spent in each kind of
+span.
+"""
+
+from collections import defaultdict, deque
+import binascii
+from contextlib import contextmanager
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+from flask import current_app, has_app_context, request
+import logbook
+from sqlalchemy import event
+
+from ripple.sepa.model import RoutingSession
+from ripple.sepa.slowlog import normalize
+
+
+log = logbook.Logger(__name__)
+
+
+SERVICE_NAME = 'ripple-sepa-bridge'
+
+# OTLP span kinds.
+INTERNAL = 1
+SERVER = 2
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+def _random_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start',
+                 'end', 'attributes', 'error')
+
+    def __init__(self, trace_id, parent_id, name, attributes=None,
+                 start=None, kind=INTERNAL):
+        self.trace_id = trace_id
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': '%d' % (self.start * 1e9),
+            'endTimeUnixNano': '%d' % (self.end * 1e9),
+            'attributes': [{'key': k, 'value': {'stringValue': '%s' % v}}
+                           for k, v in sorted(self.attributes.items())],
+            'status': {'code': 2, 'message': self.error}
+                      if self.error else {'code': 0},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def to_otlp(spans):
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [span.to_otlp() for span in spans]}]}]}
+
+
+class FileExporter(object):
+    """Appends traces to ``path`` from a background thread. Traces that
+    do not fit the queue are dropped rather than waited for.
+    """
+
+    def __init__(self, path, maxsize=1000):
+        self.path = path
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        thread = threading.Thread(target=self._write)
+        thread.daemon = True
+        thread.start()
+
+    def export(self, spans):
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            spans = self.queue.get()
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(to_otlp(spans)) + '\n')
+            except OSError as e:
+                log.error('Unable to write trace: {}', e)
+
+
+def durations(root, spans):
+    """Total duration of ``root``, and the time spent in each kind of
+    span below it.
+    """
+    by_name = defaultdict(float)
+    for span in spans:
+        if span is not root:
+            by_name[span.name] += span.duration
+    return root.duration, dict(by_name)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def breakdown(samples):
+    """Summarize ``(total, {span name: seconds})`` samples of one
+    endpoint: latency percentiles, and the average time per kind of span
+    for requests at or above the 90th percentile.
+    """
+    samples = sorted(samples, key=lambda s: s[0])
+    totals = [total for total, by_name in samples]
+    p90 = percentile(totals, 90)
+    tail = [s for s in samples if s[0] >= p90]
+    spent = defaultdict(float)
+    for total, by_name in tail:
+        for name, seconds in by_name.items():
+            spent[name] += seconds
+        spent['other'] += max(total - sum(by_name.values()), 0)
+    return {
+        'count': len(samples),
+        'p50': percentile(totals, 50),
+        'p90': p90,
+        'p99': percentile(totals, 99),
+        'max': totals[-1] if totals else 0,
+        'tail': dict((name, seconds / len(tail))
+                     for name, seconds in spent.items()) if tail else {},
+    }
+
+
+class Tracer(object):
+
+    def __init__(self, exporter=None, keep=1000):
+        self.exporter = exporter
+        self.recent = defaultdict(lambda: deque(maxlen=keep))
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        return getattr(self._local, 'stack', None)
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        match = TRACEPARENT.match(traceparent or '')
+        if match:
+            trace_id, parent_id = match.groups()
+        else:
+            trace_id, parent_id = _random_id(16), None
+        root = Span(trace_id, parent_id, name, attributes, kind=SERVER)
+        self._local.stack = [root]
+        self._local.spans = [root]
+        return root
+
+    def finish_trace(self, error=None):
+        stack = self.active
+        if not stack:
+            return
+        root, spans = stack[0], self._local.spans
+        self._local.stack = self._local.spans = None
+        root.end = time.time()
+        if error is not None:
+            root.error = '%s' % error
+        self.recent[root.name].append(durations(root, spans))
+        if self.exporter:
+            self.exporter.export(spans)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self.active
+        if not stack:
+            yield None
+            return
+        span = Span(stack[0].trace_id, stack[-1].span_id, name, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = '%s' % e
+            raise
+        finally:
+            span.end = time.time()
+            stack.pop()
+            self._local.spans.append(span)
+
+    def record(self, name, start, end, **attributes):
+        """Add a span that already happened."""
+        stack = self.active
+        if not stack:
+            return
+        span = Span(stack[0].trace_id, stack[-1].span_id, name, attributes,
+                    start=start)
+        span.end = end
+        self._local.spans.append(span)
+
+    def headers(self):
+        """Headers that continue the current trace upstream."""
+        stack = self.active
+        if not stack:
+            return {}
+        return {'traceparent': '00-%s-%s-01' % (
+            stack[0].trace_id, stack[-1].span_id)}
+
+    def breakdown(self):
+        return dict((name, breakdown(list(samples)))
+                    for name, samples in self.recent.items())
+
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('trace_started', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        started = conn.info['trace_started'].pop()
+        if self.active:
+            self.record('db.query', started, time.time(),
+                        statement=normalize(statement)[:200])
+
+
+def _tracer():
+    return current_app.extensions.get('tracer') if has_app_context() else None
+
+
+# Never has a trace active; stands in when tracing is disabled.
+_NO_TRACER = Tracer()
+
+
+def span(name, **attributes):
+    """A span within the current trace; does nothing outside of one."""
+    return (_tracer() or _NO_TRACER).span(name, **attributes)
+
+
+def trace_headers():
+    """Headers to pass to upstream services, for them to continue the
+    current trace.
+    """
+    return (_tracer() or _NO_TRACER).headers()
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.time()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    tracer = _tracer()
+    if started and tracer:
+        tracer.record('db.commit', started, time.time())
+
+
+def load_samples(f):
+    """Read the samples for :func:`breakdown` by endpoint from a trace
+    file as written by :class:`FileExporter`.
+    """
+    samples = defaultdict(list)
+    for line in f:
+        spans = json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        root, by_name = None, defaultdict(float)
+        for span in spans:
+            seconds = (int(span['endTimeUnixNano']) -
+                       int(span['startTimeUnixNano'])) / 1e9
+            if span['kind'] == SERVER:
+                root = (span['name'], seconds)
+            else:
+                by_name[span['name']] += seconds
+        if root:
+            samples[root[0]].append((root[1], dict(by_name)))
+    return samples
+
+
+def init_app(app):
+    if not app.config['TRACING']:
+        return
+    exporter = FileExporter(app.config['TRACE_FILE']) \
+        if app.config['TRACE_FILE'] else None
+    tracer = app.extensions['tracer'] = Tracer(
+        exporter, app.config['TRACE_KEEP'])
+    with app.app_context():
+        from ripple.sepa.model import db
+        tracer.watch(db.get_engine(app))
+        if 'replica' in (app.config['SQLALCHEMY_BINDS'] or {}):
+            tracer.watch(db.get_engine(app, bind='replica'))
+
+    def start_trace():
+        tracer.start_trace(
+            request.endpoint or 'unknown',
+            request.headers.get('traceparent'),
+            method=request.method, path=request.path)
+
+    def finish_trace(exception=None):
+        tracer.finish_trace(exception)
+
+    # Open the trace before, and close it after, all other request
+    # hooks, so that it includes the commit in the bridge's teardown.
+    # (Teardown functions are called in reverse.)
+    app.before_request_funcs.setdefault(None, []).insert(0, start_trace)
+    app.teardown_request_funcs.setdefault(None, []).insert(0, finish_trace)
@@ -0,0 +1,104 @@
+"""The issuers the bridge accounts trust, from rippled.
+
+Without ``ACCEPTED_ISSUERS``, quotes used to name the bridge account
+itself as the issuer, relying on the client to take that as "any issuer
+the bridge trusts" (https://ripplelabs.atlassian.net/browse/WC-1855).
+If ``RIPPLED_URL`` is set, the trustlines of the bridge accounts are
+fetched with ``account_lines`` instead, and the issuers listed.
+
+The trustlines are kept in memory, and refreshed in the background
+every ``TRUSTLINE_REFRESH_INTERVAL`` seconds. If rippled cannot be
+reached, the old snapshot stays in use.
+"""
+
+from decimal import Decimal
+import json
+
+import logbook
+import requests
+
+from ripple.sepa.utils import BackgroundRefresh
+
+
+log = logbook.Logger(__name__)
+
+
+def account_lines(url, account, timeout=10):
+    """All trustlines of ``account`` in the last validated ledger."""
+    lines, marker = [], None
+    while True:
+        params = {'account': account, 'ledger_index': 'validated'}
+        if marker:
+            params['marker'] = marker
+        response = requests.post(url, data=json.dumps({
+            'method': 'account_lines', 'params': [params]}),
+            headers={'Content-Type': 'application/json'}, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()['result']
+        if result.get('status') != 'success':
+            raise ValueError('account_lines failed for %s: %s' % (
+                account, result.get('error_message') or result.get('error')))
+        lines.extend(result['lines'])
+        marker = result.get('marker')
+        if not marker:
+            return lines
+
+
+def trusted_issuers(lines, currency='EUR'):
+    """The issuers of ``currency`` trusted with a positive limit, in
+    the order of the trustlines.
+    """
+    issuers = []
+    for line in lines:
+        if line['currency'] == currency and Decimal(line['limit']) > 0 \
+                and line['account'] not in issuers:
+            issuers.append(line['account'])
+    return issuers
+
+
+class TrustlineSnapshot(object):
+    """Issuers trusted by each bridge account, by currency, as last
+    fetched.
+    """
+
+    def __init__(self, url=None, accounts=(), interval=300):
+        self.url = url
+        self.accounts = list(accounts)
+        self.interval = interval
+        self.issuers_by_account = {}
+        self._background = BackgroundRefresh(
+            self.refresh, interval, log, 'Unable to fetch trustlines: {}')
+
+    @classmethod
+    def from_config(cls, config, accounts):
+        return cls(config['RIPPLED_URL'], accounts,
+                   config['TRUSTLINE_REFRESH_INTERVAL'])
+
+    def refresh(self):
+        snapshot = {}
+        for account in self.accounts:
+            lines = account_lines(self.url, account)
+            snapshot[account] = dict(
+                (currency, tuple(trusted_issuers(lines, currency)))
+                for currency in set(line['currency'] for line in lines))
+        self.issuers_by_account = snapshot
+        self._background.refreshed()
+        log.info('Bridge accounts trust {} EUR issuers', len(set(
+            i for lines in snapshot.values() for i in lines.get('EUR', ()))))
+
+    def issuers(self, account=None, currency='EUR'):
+        """The issuers of ``currency`` that ``account`` trusts, or any
+        of the bridge accounts if not given. Empty until the first fetch
+        completed.
+        """
+        if self.url:
+            self._background.maybe_start()
+        snapshot = self.issuers_by_account
+        if account:
+            return list(snapshot.get(account, {}).get(currency, ()))
+        issuers = []
+        for account in self.accounts:
+            for issuer in snapshot.get(account, {}).get(currency, ()):
+                if issuer not in issuers:
+                    issuers.append(issuer)
+        return issuers
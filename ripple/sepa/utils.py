@@ -1,9 +1,12 @@
 from functools import wraps
+import hashlib
 import string
 from datetime import timedelta, datetime
 import stdnum.iban
 from stdnum.exceptions import ValidationError
 import base64
+import threading
+import time
 from flask import make_response
 
 
@@ -299,6 +302,77 @@ def add_response_headers(headers={}):
     return decorator
 
 
+class BackgroundRefresh(object):
+    """Runs ``refresh`` in a daemon thread when it was last done more
+    than ``interval`` seconds ago, so that the requests asking for it
+    never wait. Only one thread refreshes at a time; meanwhile, and if
+    it fails, the previous data stays in use. A failure is logged as
+    ``message`` to ``log``, and tried again an interval later.
+
+    ``refresh`` should build the new data completely before replacing
+    the old in one assignment, so that readers see either, never a mix.
+    """
+
+    def __init__(self, refresh, interval, log, message):
+        self.refresh = refresh
+        self.interval = interval
+        self.log = log
+        self.message = message
+        self.done_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def refreshed(self):
+        """Record that the data is current, e.g. after a refresh in the
+        foreground.
+        """
+        self.done_at = time.time()
+
+    def maybe_start(self):
+        if self.done_at and time.time() - self.done_at < self.interval:
+            return
+        if self._lock.acquire(False):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.log.error(self.message, e)
+        finally:
+            self.refreshed()
+            self._lock.release()
+
+
+def bridge_addresses(config):
+    """All accounts payments to the bridge may be sent to, the main
+    ``BRIDGE_ADDRESS`` first.
+    """
+    addresses = [config['BRIDGE_ADDRESS']]
+    for address in config.get('BRIDGE_ADDRESSES') or ():
+        if address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def assign_bridge_address(invoice_id, addresses):
+    """Pick the account a quote should be paid to.
+
+    Uses rendezvous hashing: the choice is deterministic for an invoice,
+    spreads quotes evenly, and adding or removing an account only moves
+    the quotes assigned to that account.
+    """
+    def weight(address):
+        return hashlib.sha1(
+            ('%s:%s' % (invoice_id, address)).encode('utf-8')).digest()
+    return max(addresses, key=weight)
+
+
 def parse_sepa_destination(s):
     """Parse a string into a dict of SEPA information. The format is::
 
@@ -1,13 +1,52 @@
+import base64
+import errno
+import gzip
+import io
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import Counter
 from decimal import Decimal
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import json
+import logbook
 from unittest import mock
 from flask import url_for, current_app
 import postmark
 import responses
 import pytest
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from requests.exceptions import ConnectionError, ReadTimeout
+from requests.packages.urllib3.exceptions import ProtocolError
 from ripple.sepa import create_app
-from ripple.sepa.bridge import Ticket, db
-from ripple.sepa.utils import parse_sepa_destination, validate_sepa
+from ripple.sepa.admin import admin, bulk_action
+from ripple.sepa.admission import AdmissionController
+from ripple.sepa.assets import Assets, minify_css
+from ripple.sepa.bridge import Ticket, accept_payment, db
+from ripple.sepa.export import export_tickets, to_csv, to_jsonl
+from ripple.sepa.fees import FeeSchedule
+from ripple.sepa.liquidity import LiquidityLedger
+from ripple.sepa import rates
+from ripple.sepa.logs import QueuedHandler, json_formatter
+from ripple.sepa import loadtest
+from ripple.sepa.model import (
+    AnyTicket, LimitBudget, SlowQuery, SubmissionRetry, RoutingSession,
+    NOT_FAILED, tickets_changed, upgrade_schema)
+from ripple.sepa.reconcile import parse_camt053, parse_csv, reconcile
+from ripple.sepa.retry import RetryScheduler, backoff
+from ripple.sepa import bankdir
+from ripple.sepa.screening import SanctionsIndex, Screening
+from ripple.sepa.slowlog import normalize, redact
+from ripple.sepa.trustlines import TrustlineSnapshot
+from ripple.sepa import tracing
+from ripple.sepa import stats
+from ripple.sepa.utils import (
+    parse_sepa_destination, validate_sepa, bridge_addresses,
+    assign_bridge_address)
 
 
 def test_sepa_url():
@@ -72,6 +111,369 @@ def test_sepa_validate():
                        'name': '', 'text': 'b'*140})
 
 
+def test_fee_schedule():
+    """Test tiered, per-country and time-based fees."""
+    day, night = datetime(2014, 7, 1, 12), datetime(2014, 7, 1, 23)
+    fees = FeeSchedule('1.50', '5', [
+        {'min_amount': '100', 'fixed': '1', 'volume': '2'},
+        {'min_amount': '0', 'fixed': '0', 'volume': '1',
+         'countries': ['DE']},
+        {'min_amount': '50', 'fixed': '3', 'volume': '0',
+         'hours': [22, 6]},
+    ])
+
+    # Below the first tier, the base fee applies
+    assert fees.fee(Decimal('10'), 'GB82WEST', day) == Decimal('2.00')
+    assert fees.fee(Decimal('100'), 'GB82WEST', day) == Decimal('3.00')
+    # Country schedule replaces the general one
+    assert fees.fee(Decimal('100'), 'DE8937', day) == Decimal('1.00')
+    assert fees.fee(Decimal('100'), 'DE8937', night) == Decimal('1.00')
+    # At night, the hour-restricted schedule applies
+    assert fees.fee(Decimal('10'), 'GB82WEST', night) == Decimal('2.00')
+    assert fees.fee(Decimal('100'), 'GB82WEST', night) == Decimal('3')
+
+    assert [t.min_amount for t in fees.tiers(hour=12)] == [0, 100]
+    assert fees.has_special_rates
+
+    # Would otherwise select the highest tier
+    for amount in ('0', '-5'):
+        with pytest.raises(ValueError):
+            fees.fee(Decimal(amount), 'GB82WEST', day)
+
+
+def test_template_cache(tmpdir):
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///',
+        'BRIDGE_ADDRESS': 'rNrvihhhjDu6xmAzJBiKmEZDkjdYufh8s4',
+        'POSTMARK_KEY': 'foobar',
+        'POSTMARK_SENDER': 'admin@foo.bar',
+        'TEMPLATE_CACHE_DIR': str(tmpdir),
+    }
+    app = create_app(config=config)
+    assert len(tmpdir.listdir()) == len(app.jinja_loader.list_templates())
+
+    # A new worker loads the templates from the cache, without compiling
+    with mock.patch('jinja2.Environment.compile') as compile:
+        create_app(config=config)
+        assert not compile.called
+
+    # By default, in a directory only we can write to.
+    del config['TEMPLATE_CACHE_DIR']
+    directory = create_app(config=config).jinja_env.bytecode_cache.directory
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert os.stat(directory).st_uid == os.getuid()
+
+
+def test_minify_css():
+    assert minify_css("""
+        /* Header */
+        header > div, a:hover {
+          background: url(p5.png) repeat;
+          margin: 0 auto;
+        }
+    """) == 'header>div,a:hover{background:url(p5.png) repeat;margin:0 auto}'
+
+
+def test_assets_prune(tmpdir):
+    source = tmpdir.mkdir('static')
+    source.join('app.js').write('var a = 1;')
+    target = tmpdir.join('build')
+    assets = Assets(str(source), str(target))
+    old = assets.build()['app.js']
+
+    source.join('app.js').write('var a = 2;')
+    new = assets.build()['app.js']
+    # The previous release may still be serving it.
+    assert target.join(old).check() and target.join(old + '.gz').check()
+
+    stale = time.time() - Assets.KEEP_OLD - 1
+    for name in (old, old + '.gz', new):
+        os.utime(str(target.join(name)), (stale, stale))
+    assets.build()
+    assert not target.join(old).check()
+    assert not target.join(old + '.gz').check()
+    assert target.join(new).check() and target.join(new + '.gz').check()
+
+
+def test_sample_iban():
+    for n in (0, 1, 12345):
+        validate_sepa({'iban': loadtest.sample_iban(n), 'bic': 'COBADEFFXXX',
+                       'name': 'Load Test', 'text': ''})
+
+
+def test_queued_logging():
+    # Block the writer, so that the queue fills up
+    blocked = threading.Event()
+    release = threading.Event()
+    class Stream(io.StringIO):
+        def write(self, s):
+            blocked.set()
+            release.wait()
+            return io.StringIO.write(self, s)
+    output = Stream()
+    target = logbook.StreamHandler(output)
+    target.formatter = json_formatter
+    handler = QueuedHandler(target, maxsize=2)
+    logger = logbook.Logger('test')
+
+    with handler.threadbound():
+        logger.info('first')
+        blocked.wait(5)
+        for i in range(5):
+            logger.info('queued {}', i)
+        release.set()
+        for i in range(500):
+            if 'dropped' in output.getvalue():
+                break
+            time.sleep(0.01)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed')
+    handler.close()
+
+    assert handler.dropped == 3
+    lines = [json.loads(l) for l in output.getvalue().splitlines()]
+    assert [l['message'] for l in lines] == [
+        'first', 'queued 0', 'queued 1',
+        '3 log records dropped, the log queue was full', 'failed']
+    assert 'ValueError: boom' in lines[-1]['exception']
+    assert lines[-1]['level'] == 'ERROR'
+
+
+def test_log_handler_installed_once():
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///',
+        'BRIDGE_ADDRESS': 'rNrvihhhjDu6xmAzJBiKmEZDkjdYufh8s4',
+        'POSTMARK_KEY': 'foobar',
+        'POSTMARK_SENDER': 'admin@foo.bar',
+    }
+    first = create_app(config=config).extensions['log_handler']
+    second = create_app(config=config).extensions['log_handler']
+    assert first is second
+
+
+def test_sanctions_index():
+    index = SanctionsIndex(
+        names=['John Doe', 'Société Générale Exemple', 'Max Mustermann'],
+        ibans=['GB82 WEST 1234 5698 7654 32'])
+    assert index.match_iban('GB82WEST12345698765432')
+    assert not index.match_iban('DE89370400440532013000')
+    assert index.match_name('DOE, John', 0.85)[1] == 1.0
+    assert index.match_name('Societe Generale Exemple', 0.85)
+    assert index.match_name('Max Musterman', 0.85)
+    assert not index.match_name('Erika Mustermann', 0.85)
+    assert not index.match_name('', 0.85)
+
+
+def test_screening_reload(tmpdir):
+    listfile = tmpdir.join('sanctions.csv')
+    listfile.write('id,name,iban\n1,John Doe,\n')
+    screening = Screening(str(listfile), interval=0)
+    assert screening.screen('John Doe', '')
+    assert not screening.screen('Jane Roe', '')
+
+    listfile.write('id,name,iban\n1,John Doe,\n2,Jane Roe,\n')
+    os.utime(str(listfile), (time.time() + 10, time.time() + 10))
+    for i in range(500):
+        if screening.screen('Jane Roe', ''):
+            break
+        time.sleep(0.01)
+    assert screening.screen('Jane Roe', '')
+
+
+def test_bank_directory(tmpdir):
+    path = str(tmpdir.join('banks'))
+    rows = [('DE', '%08d' % n, 'BANKDE%02dXXX' % (n % 100))
+            for n in range(1000)]
+    rows.append(('DE', '37040044', 'COBADEFFXXX'))
+    rows.append(('GB', 'WEST', 'WESTGB22'))
+    assert bankdir.build(rows, path) == 1002
+
+    banks = bankdir.BankDirectory(path)
+    assert banks.bic('DE89 3704 0044 0532 0130 00') == 'COBADEFFXXX'
+    assert banks.bic('GB82WEST12345698765432') == 'WESTGB22'
+    assert banks.bic('DE02%08d0000000000' % 417) == 'BANKDE17XXX'
+    assert banks.bic('DE02999999990000000000') is None
+    assert banks.bic('NO9386011117947') is None
+    assert banks.bic(u'DE89370\xe40440532013000') is None
+
+    banks.check('DE89370400440532013000', 'COBADEFF')
+    banks.check('DE89370400440532013000', 'COBADEBBXXX')
+    banks.check('DE02999999990000000000', 'DEUTDEFF')
+    with pytest.raises(ValueError):
+        banks.check('DE89370400440532013000', 'DEUTDEFF')
+
+    assert not bankdir.BankDirectory(str(tmpdir.join('missing')))
+    assert bankdir.BankDirectory().bic('DE89370400440532013000') is None
+
+
+class FakeRippled(HTTPServer):
+    """Answers ``account_lines`` from ``lines``, an account's trustlines
+    by account, two per page.
+    """
+
+    def __init__(self):
+        self.lines = {}
+        self.calls = 0
+        self.fail = False
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeRippledHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_port
+
+
+class _FakeRippledHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        call = json.loads(self.rfile.read(length).decode('utf-8'))
+        params = call['params'][0]
+        self.server.calls += 1
+        if self.server.fail:
+            result = {'status': 'error', 'error': 'noNetwork'}
+        else:
+            lines = self.server.lines.get(params['account'], [])
+            start = params.get('marker', 0)
+            result = {'status': 'success', 'account': params['account'],
+                      'lines': lines[start:start+2]}
+            if start + 2 < len(lines):
+                result['marker'] = start + 2
+        body = json.dumps({'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rippled(request):
+    server = FakeRippled()
+    request.addfinalizer(server.shutdown)
+    return server
+
+
+def trustline(issuer, currency='EUR', limit='1000'):
+    return {'account': issuer, 'currency': currency, 'limit': limit,
+            'balance': '0'}
+
+
+def test_trustline_snapshot(rippled):
+    rippled.lines = {
+        'rBridge': [trustline('rIssuer1'), trustline('rUSD', 'USD'),
+                    trustline('rZero', limit='0'), trustline('rIssuer2'),
+                    trustline('rIssuer1')],
+        'rOther': [trustline('rIssuer3'), trustline('rIssuer2')],
+    }
+    snapshot = TrustlineSnapshot(rippled.url, ['rBridge', 'rOther'])
+    snapshot.refresh()
+    assert snapshot.issuers('rBridge') == ['rIssuer1', 'rIssuer2']
+    assert snapshot.issuers() == ['rIssuer1', 'rIssuer2', 'rIssuer3']
+    assert rippled.calls == 4
+
+    # A failed refresh, in the background, keeps the last snapshot.
+    rippled.fail = True
+    snapshot._background.done_at -= snapshot.interval
+    assert snapshot.issuers('rOther') == ['rIssuer3', 'rIssuer2']
+    for i in range(500):
+        if rippled.calls > 4 and not snapshot._background.running:
+            break
+        time.sleep(0.01)
+    assert rippled.calls == 5
+    assert snapshot.issuers('rOther') == ['rIssuer3', 'rIssuer2']
+
+
+class FakeRateFeed(HTTPServer):
+    """Serves ``feed`` as JSON to GET requests."""
+
+    def __init__(self):
+        self.feed = {'rates': {}}
+        self.fail = False
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeRateFeedHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/rates.json' % self.server_port
+
+
+class _FakeRateFeedHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.server.fail:
+            self.send_error(503)
+            return
+        body = json.dumps(self.server.feed).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rate_feed(request):
+    server = FakeRateFeed()
+    server.feed = {'rates': {'XRP': '0.004', 'USD': '0.8', 'EUR': '1'}}
+    request.addfinalizer(server.shutdown)
+    return server
+
+
+def test_rate_conversion():
+    snapshot = rates.parse_rates({'rates': {'XRP': '0.004', 'USD': '0.8'}})
+    assert snapshot.version == rates.parse_rates(
+        {'rates': {'USD': '0.80', 'XRP': '0.0040'}}).version
+    assert rates.parse_rates({'version': 'v7', 'rates': {}}).version == 'v7'
+    assert list(rates.parse_rates({'rates': {
+        'USD': '0.8', 'XAU': 'Infinity', 'XAG': 'NaN', 'GBP': '0',
+        'JPY': '-Infinity'}}).rates) == ['USD']
+    assert rates.to_eur(snapshot, Decimal('10.01'), 'USD') == Decimal('8.00')
+    assert rates.from_eur(snapshot, Decimal('8.00'), 'USD') == Decimal('10')
+    assert rates.from_eur(snapshot, Decimal('0.01'), 'USD') == \
+        Decimal('0.0125')
+    assert rates.from_eur(snapshot, Decimal('1.00'), 'XRP') == Decimal('250')
+
+
+def test_rate_feed(rate_feed):
+    feed = rates.RateFeed(rate_feed.url, interval=60, max_age=300)
+    feed.refresh()
+    first = feed.current()
+    assert first.rates == {'XRP': Decimal('0.004'), 'USD': Decimal('0.8')}
+
+    # A failed refresh, in the background, keeps the last snapshot ...
+    rate_feed.fail = True
+    feed._background.done_at -= 60
+    assert feed.current() is first
+    for i in range(500):
+        if not feed._background.running and \
+                feed._background.done_at > first.fetched_at:
+            break
+        time.sleep(0.01)
+    assert feed.current() is first
+
+    # ... until it is too old to be used.
+    feed.snapshot = first._replace(fetched_at=first.fetched_at - 301)
+    assert feed.current() is None
+
+    rate_feed.fail = False
+    rate_feed.feed['rates']['USD'] = '0.81'
+    feed.refresh()
+    assert feed.current().version != first.version
+
+
 @pytest.fixture
 def app(request):
     app = create_app(config={
@@ -85,6 +487,7 @@ def app(request):
         'POSTMARK_KEY': 'foobar',
         'POSTMARK_SENDER': 'admin@foo.bar',
         'ADMINS': ['foo@example.org'],
+        'QUOTES_DISABLED': False,
     })
 
     ctx = app.app_context()
@@ -115,6 +518,28 @@ class TestBridgeAPI:
         response = client.get(url_for('bridge.index'))
         assert response.status_code == 200
 
+    def test_assets(self, app, client):
+        assets = app.extensions['assets']
+        css = assets.manifest['style.css']
+        assert css.startswith('style.') and css != 'style.css'
+        response = client.get(url_for('bridge.index'))
+        assert ('/assets/' + css).encode('ascii') in response.data
+        assert assets.manifest['iban.js'].encode('ascii') in response.data
+
+        response = client.get(assets.url('style.css'),
+                              headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in response.headers['Cache-Control']
+        css = gzip.decompress(response.data).decode('utf-8')
+        assert 'url(%s)' % assets.manifest['p5.png'] in css
+
+        response = client.get(assets.url('p5.png'))
+        assert response.mimetype == 'image/png'
+        assert 'Content-Encoding' not in response.headers
+        assert client.get(url_for('bridge.asset', filename='style.css'))\
+            .status_code == 404
+
     def test_federation(self, client):
         """Test the Ripple federation view.
         """
@@ -142,6 +567,43 @@ class TestBridgeAPI:
         assert result['federation_json']['extra_fields'][2]['value'] == 'b'
         assert result['federation_json']['extra_fields'][3]['value'] == 'f'
 
+    def test_bank_directory(self, app, client, tmpdir):
+        """The BIC is looked up, and has to match the IBAN."""
+        path = str(tmpdir.join('banks'))
+        bankdir.build([('DE', '37040044', 'COBADEFFXXX')], path)
+        app.extensions['bank_directory'] = bankdir.BankDirectory(path)
+
+        response = client.get(url_for('bridge.federation'), query_string={
+            'type': 'federation', 'domain': 'testinghost',
+            'destination': 'M/DE89370400440532013000//f'})
+        fields = json.loads(response.data.decode('utf8'))[
+            'federation_json']['extra_fields']
+        assert fields[2]['value'] == 'COBADEFFXXX'
+        assert not fields[2]['required']
+
+        response = client.get(url_for('bridge.bic_lookup'), query_string={
+            'iban': 'DE89370400440532013000'})
+        assert json.loads(response.data.decode('utf8')) == {
+            'bic': 'COBADEFFXXX'}
+        response = client.get(url_for('bridge.bic_lookup'), query_string={
+            'iban': u'DE89370\xe40440532013000'})
+        assert response.status_code == 200
+
+        response = client.get(url_for('bridge.quote'), query_string={
+            'type': 'quote', 'domain': 'testinghost',
+            'name': 'User A', 'bic': 'DEUTDEFF',
+            'iban': 'DE89370400440532013000', 'amount': '22.00/EUR'})
+        result = json.loads(response.data.decode('utf8'))
+        assert result['error'] == 'invalidSEPA'
+        assert 'COBADEFFXXX' in result['error_message']
+
+        response = client.get(url_for('bridge.quote'), query_string={
+            'type': 'quote', 'domain': 'testinghost', 'name': 'User A',
+            'iban': 'DE89370400440532013000', 'amount': '22.00/EUR'})
+        result = json.loads(response.data.decode('utf8'))
+        assert Ticket.query.get(result['quote']['invoice_id']).bic == \
+            'COBADEFFXXX'
+
     def test_quote(self, client):
         """Test the Ripple quote view.
         """
@@ -175,6 +637,20 @@ class TestBridgeAPI:
         assert tickets[0].amount + tickets[0].fee == \
                Decimal(result['quote']['send'][0]['value'])
 
+    def test_quote_sanctioned(self, app, client):
+        """No quotes for transfers to sanctioned parties."""
+        app.extensions['screening'].index = SanctionsIndex(names=['A User'])
+        with mock.patch.object(postmark.PMMail, 'send') as send:
+            response = client.get(url_for('bridge.quote'), query_string={
+                'type': 'quote', 'domain': 'testinghost',
+                'name': 'User A', 'bic': 'DABADKKK',
+                'iban': 'GB82WEST12345698765432', 'text': 'Text',
+                'amount': '22.00/EUR'})
+        result = json.loads(response.data.decode('utf8'))
+        assert result['error'] == 'unavailable'
+        assert len(send.mock_calls) == 1
+        assert not Ticket.query.all()
+
     def test_quote_amount(self, client):
         # Test a request with incorrectly formatted amount.
         response = client.get(url_for('bridge.quote'), query_string={
@@ -186,6 +662,21 @@ class TestBridgeAPI:
         assert result['error']
         assert not Ticket.query.all()
 
+    def test_quote_not_positive(self, client):
+        """Amounts of zero or less are refused before anything is
+        reserved.
+        """
+        for amount in ('0/EUR', '-5/EUR', 'NaN/EUR'):
+            response = client.get(url_for('bridge.quote'), query_string={
+                'type': 'quote', 'domain': 'testinghost',
+                'name': 'User', 'bic': 'DABADKKK',
+                'iban': 'GB82WEST12345698765432', 'amount': amount})
+            assert response.status_code == 200
+            result = json.loads(response.data.decode('utf8'))
+            assert result['error'] == 'invalidAmount'
+        assert not Ticket.query.all()
+        assert not LimitBudget.query.all()
+
     def test_quoted_issuers(self, client):
         """Test the ACCEPTED_ISSUERS configuration."""
         current_app.config['ACCEPTED_ISSUERS'] = ['a', 'b', 'c']
@@ -211,6 +702,959 @@ class TestBridgeAPI:
         assert len(result['quote']['send']) == 1
         assert result['quote']['send'][0]['issuer'] == 'foobar'
 
+    def test_trustline_issuers(self, app, client, rippled):
+        """Without ACCEPTED_ISSUERS, the trusted issuers are named."""
+        app.config['ACCEPTED_ISSUERS'] = []
+        address = app.config['BRIDGE_ADDRESS']
+        rippled.lines = {address: [trustline('rIssuer1'),
+                                   trustline('rIssuer2')]}
+        snapshot = app.extensions['trustlines'] = TrustlineSnapshot(
+            rippled.url, [address])
+        snapshot.refresh()
+        calls = rippled.calls
+
+        response = client.get(url_for('bridge.federation'), query_string={
+            'type': 'federation', 'domain': 'testinghost', 'destination': 'foo'})
+        result = json.loads(response.data.decode('utf8'))
+        assert result['federation_json']['currencies'] == [
+            {'currency': 'EUR', 'issuer': 'rIssuer1'},
+            {'currency': 'EUR', 'issuer': 'rIssuer2'}]
+
+        response = client.get(url_for('bridge.quote'), query_string={
+            'type': 'quote', 'domain': 'testinghost',
+            'name': 'User', 'bic': 'DABADKKK',
+            'iban': 'GB82WEST12345698765432', 'text': 'Text',
+            'amount': '22.00/EUR'})
+        result = json.loads(response.data.decode('utf8'))
+        assert [s['issuer'] for s in result['quote']['send']] == [
+            'rIssuer1', 'rIssuer2']
+        # Answered from the snapshot.
+        assert rippled.calls == calls
+
+    def test_cross_currency_quote(self, app, client, rate_feed):
+        """Quotes in other currencies are converted to EUR."""
+        feed = app.extensions['rates'] = rates.RateFeed(rate_feed.url)
+        feed.refresh()
+        address = app.config['BRIDGE_ADDRESS']
+        app.extensions['trustlines'].issuers_by_account = {
+            address: {'USD': ('rUSDIssuer',)}}
+
+        def quote(amount):
+            response = client.get(url_for('bridge.quote'), query_string={
+                'type': 'quote', 'domain': 'testinghost',
+                'name': 'User', 'bic': 'DABADKKK',
+                'iban': 'GB82WEST12345698765432', 'text': 'Text',
+                'amount': amount})
+            return json.loads(response.data.decode('utf8'))
+
+        result = quote('25/USD')
+        ticket = Ticket.query.get(result['quote']['invoice_id'])
+        assert ticket.amount == Decimal('20.00')
+        assert ticket.currency == 'USD'
+        assert ticket.rate_version == feed.snapshot.version
+        assert ticket.send_value == \
+            ((ticket.amount + ticket.fee) / Decimal('0.8')).quantize(rates.UNIT)
+        send, = result['quote']['send']
+        assert (send['currency'], send['issuer']) == ('USD', 'rUSDIssuer')
+        assert Decimal(send['value']) == ticket.send_amount
+
+        result = quote('1000/XRP')
+        assert Ticket.query.get(result['quote']['invoice_id']).amount == 4
+        assert list(result['quote']['send'][0]) == ['currency', 'value']
+
+        assert quote('10/GBP')['error'] == 'invalidAmount'
+        feed.snapshot = feed.snapshot._replace(fetched_at=0)
+        assert quote('10/USD')['error'] == 'invalidAmount'
+        assert 'quote' in quote('10/EUR')
+
+        response = client.get(url_for('bridge.federation'), query_string={
+            'type': 'federation', 'domain': 'testinghost', 'destination': 'foo'})
+        currencies = json.loads(response.data.decode('utf8'))[
+            'federation_json']['currencies']
+        assert [c['currency'] for c in currencies] == ['EUR']
+
+    def test_address_pool(self, client):
+        """Quotes are spread over all bridge accounts."""
+        current_app.config['ACCEPTED_ISSUERS'] = []
+        current_app.config['BRIDGE_ADDRESSES'] = ['rA', 'rB', 'rC']
+        response = client.get(url_for('bridge.ripple_txt'))
+        assert response.data.decode('utf8').endswith(
+            'rNrvihhhjDu6xmAzJBiKmEZDkjdYufh8s4\nrA\nrB\nrC')
+
+        addresses = set()
+        for i in range(20):
+            response = client.get(url_for('bridge.quote'), query_string={
+                'type': 'quote', 'domain': 'testinghost',
+                'name': 'User', 'bic': 'DABADKKK',
+                'iban': 'GB82WEST12345698765432', 'text': 'Text',
+                'amount': '1.00/EUR'})
+            quote = json.loads(response.data.decode('utf8'))['quote']
+            assert quote['send'][0]['issuer'] == quote['address']
+            assert quote['address'] == assign_bridge_address(
+                quote['invoice_id'], bridge_addresses(current_app.config))
+            addresses.add(quote['address'])
+        assert len(addresses) > 1
+
+
+class TestAdmission:
+    """Test shedding quotes while the backend is behind."""
+
+    def create_ticket(self, status, minutes_ago=0, quoted_before=0):
+        ticket = Ticket(amount='100', fee='10')
+        ticket.status = status
+        ticket.paid_at = datetime.utcnow() - timedelta(minutes=minutes_ago)
+        ticket.created_at = ticket.paid_at - timedelta(minutes=quoted_before)
+        db.session.add(ticket)
+        db.session.commit()
+
+    def test_depth(self, app):
+        controller = AdmissionController(max_depth=2, interval=60)
+        self.create_ticket('received')
+        self.create_ticket('sent')
+        assert not controller.overloaded()
+
+        # The backlog is cached until the interval passes
+        self.create_ticket('sending')
+        assert not controller.overloaded()
+        controller.refresh()
+        assert controller.overloaded()
+
+    def test_age(self, app):
+        controller = AdmissionController(max_age=600)
+        self.create_ticket('received', minutes_ago=5)
+        assert not controller.overloaded()
+        # Counted from the payment, not the quote
+        self.create_ticket('received', quoted_before=50)
+        controller.refresh()
+        assert not controller.overloaded()
+        self.create_ticket('received', minutes_ago=15)
+        controller.refresh()
+        assert controller.overloaded()
+
+    def test_quote(self, app, client):
+        app.extensions['admission'] = AdmissionController(max_depth=1)
+        self.create_ticket('received')
+        response = client.get(url_for('bridge.quote'), query_string={
+            'type': 'quote', 'domain': 'testinghost',
+            'name': 'User', 'bic': 'DABADKKK',
+            'iban': 'GB82WEST12345698765432', 'text': 'Text',
+            'amount': '22.00/EUR'})
+        result = json.loads(response.data.decode('utf8'))
+        assert result['error'] == 'unavailable'
+
+
+class TestLiquidity:
+    """Test quoting against the bank balance."""
+
+    @pytest.fixture
+    def ledger(self, app, tmpdir):
+        balance = tmpdir.join('balance')
+        balance.write('150.00\n')
+        ledger = app.extensions['liquidity'] = LiquidityLedger(
+            str(balance), interval=3600)
+        ledger.engine = db.get_engine(app)
+        ledger.sync()
+        return ledger
+
+    def create_ticket(self, status='quoted', amount='100'):
+        ticket = Ticket(amount=amount, fee='10')
+        ticket.status = status
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket
+
+    def test_transitions(self, app, ledger):
+        self.create_ticket('received', amount='30')
+        ledger.sync()
+        assert ledger.available == Decimal('120')
+
+        # Commitments follow new quotes and committed transitions,
+        # without queries.
+        ticket = Ticket(amount='100', fee='10')
+        db.session.add(ticket)
+        db.session.flush()
+        assert ledger.available == Decimal('120')
+        db.session.commit()
+        assert ledger.available == Decimal('20')
+        ticket.transition(('quoted',), 'received')
+        db.session.commit()
+        statements = []
+        listener = lambda *args: statements.append(args)
+        event.listen(ledger.engine, 'before_cursor_execute', listener)
+        try:
+            assert ledger.available == Decimal('20')
+            assert ledger.can_pay(Decimal('20'))
+            assert not ledger.can_pay(Decimal('20.01'))
+        finally:
+            event.remove(ledger.engine, 'before_cursor_execute', listener)
+        assert not statements
+
+        ticket.transition(('received',), 'sending')
+        db.session.commit()
+        assert ledger.available == Decimal('20')
+        ticket.transition(('sending',), 'sent')
+        db.session.rollback()
+        assert ledger.available == Decimal('20')
+        ticket.transition(('sending',), 'sent')
+        db.session.commit()
+        assert ledger.available == Decimal('120')
+
+        # Quotes count until they expire.
+        quote = self.create_ticket(amount='50')
+        assert ledger.available == Decimal('70')
+        quote.created_at -= timedelta(hours=2)
+        db.session.commit()
+        LimitBudget.release_expired()
+        ledger.sync()
+        assert ledger.available == Decimal('120')
+
+    def test_balance_update(self, app, client, ledger):
+        app.config['SEPA_CALLBACK_AUTH'] = 'secret'
+        self.create_ticket('sending', amount='30')
+        ledger.sync()
+        response = client.post(
+            url_for('bridge.on_balance_update'),
+            data=json.dumps({'balance': '80.50'}),
+            content_type='application/json',
+            headers={'Authorization': 'secret'})
+        assert json.loads(response.data.decode('utf8')) == {
+            'balance': '80.50', 'available': '50.50'}
+        with open(ledger.balance_file) as f:
+            assert Decimal(f.read()) == Decimal('80.50')
+
+        # Other processes pick it up.
+        other = LiquidityLedger(ledger.balance_file)
+        other.engine = ledger.engine
+        other.sync()
+        assert other.available == Decimal('50.50')
+
+        for invalid in ('lots', 'NaN', 'Infinity', '-5'):
+            assert client.post(
+                url_for('bridge.on_balance_update'),
+                data=json.dumps({'balance': invalid}),
+                content_type='application/json',
+                headers={'Authorization': 'secret'}).status_code == 400
+
+        # Nor is one taken from the file.
+        with open(ledger.balance_file, 'w') as f:
+            f.write('NaN\n')
+        os.utime(ledger.balance_file, (0, 0))
+        ledger.sync()
+        assert not ledger.can_pay(Decimal('1'))
+
+    def test_quote(self, app, client, ledger):
+        self.create_ticket('received', amount='100')
+        ledger.sync()
+        def quote():
+            response = client.get(url_for('bridge.quote'), query_string={
+                'type': 'quote', 'domain': 'testinghost',
+                'name': 'User', 'bic': 'DABADKKK',
+                'iban': 'GB82WEST12345698765432', 'text': 'Text',
+                'amount': '30.00/EUR'})
+            return json.loads(response.data.decode('utf8'))
+        # The first quote is counted against the second.
+        assert quote()['result'] == 'success'
+        assert quote()['error'] == 'limitExceeded'
+
+
+class TestReplica:
+    """Test read-replica routing."""
+
+    @pytest.fixture
+    def app(self, request):
+        app = create_app(config={
+            'SERVER_NAME': 'testinghost',
+            'TESTING': True,
+            'DEBUG': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///',
+            'REPLICA_DATABASE_URI': 'sqlite:///',
+            'BRIDGE_ADDRESS': 'rNrvihhhjDu6xmAzJBiKmEZDkjdYufh8s4',
+            'POSTMARK_KEY': 'foobar',
+            'POSTMARK_SENDER': 'admin@foo.bar',
+        })
+        ctx = app.app_context()
+        ctx.push()
+        request.addfinalizer(ctx.pop)
+        # The replica is a separate (empty) in-memory database here.
+        db.Model.metadata.create_all(db.get_engine(app, bind='replica'))
+        return app
+
+    def test_routing(self, app):
+        db.session.add(Ticket(amount='100', fee='10'))
+        db.session.commit()
+
+        assert Ticket.query.count() == 1
+        with db.replica():
+            assert Ticket.query.count() == 0
+
+            # Writes still go to the primary
+            db.session.add(Ticket(amount='100', fee='10'))
+            db.session.flush()
+        assert Ticket.query.count() == 2
+
+
+def test_upgrade_schema(tmpdir):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('old.db'))
+    # The ticket table as created by the first version.
+    engine.execute("""CREATE TABLE ticket (
+        id VARCHAR PRIMARY KEY, amount NUMERIC, fee NUMERIC,
+        created_at DATETIME, ripple_address VARCHAR(255),
+        status VARCHAR(255), failed VARCHAR(255),
+        recipient_name VARCHAR(255), bic VARCHAR(255), iban VARCHAR(255),
+        text VARCHAR(255))""")
+    engine.execute("INSERT INTO ticket (id, amount, status) "
+                   "VALUES ('old', 10, 'sent')")
+
+    changes = upgrade_schema(engine)
+    assert 'Added column ticket.updated_at' in changes
+    assert 'Added column ticket.rate_version' in changes
+    assert 'Added column ticket.paid_at' in changes
+    assert 'Created index ix_ticket_updated_at' in changes
+    columns = sqlalchemy.inspect(engine).get_columns('ticket')
+    assert {c['name'] for c in columns} == \
+        {c.name for c in Ticket.__table__.columns}
+    assert engine.execute(
+        sqlalchemy.select([Ticket.__table__])).fetchone().id == 'old'
+    assert upgrade_schema(engine) == []
+
+
+class TestArchive:
+    """Test moving finished tickets to the archive table."""
+
+    def create_ticket(self, status, days_ago, failed='', iban=''):
+        ticket = Ticket(amount='100', fee='10', iban=iban)
+        ticket.status = status
+        ticket.failed = failed
+        ticket.created_at = datetime.utcnow() - timedelta(days=days_ago)
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+    def test_archive(self, app):
+        old_sent = self.create_ticket('sent', 40)
+        old_failed = self.create_ticket('quoted', 40, failed='unexpected')
+        self.create_ticket('sent', 5)
+        self.create_ticket('received', 40)
+        # Not yet cleared of recipient data
+        self.create_ticket('sent', 40, iban='GB82WEST12345698765432')
+
+        assert Ticket.archive_finished(30, batch_size=1) == 2
+        assert Ticket.query.count() == 3
+        assert not Ticket.query.get(old_sent)
+        assert not Ticket.query.get(old_failed)
+
+        # Both tables can be queried together
+        assert db.session.query(AnyTicket).count() == 5
+        assert db.session.query(AnyTicket).get(old_sent).status == 'sent'
+
+    def test_admin(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        admin.init_app(app)
+        self.create_ticket('sent', 40)
+        Ticket.archive_finished(30)
+
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        response = client.get(url_for('alltickets.index_view'),
+                              headers=auth)
+        assert response.status_code == 200
+
+
+class TestExport:
+    """Test the ticket export for accounting."""
+
+    def create_ticket(self, days_ago):
+        ticket = Ticket(amount='100', fee='10')
+        ticket.status = 'sent'
+        ticket.created_at = datetime(2014, 6, 1) - timedelta(days=days_ago)
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+    def test_export(self, app):
+        old = self.create_ticket(10)
+        Ticket.archive_finished(0)
+        new = self.create_ticket(0)
+        self.create_ticket(-10)
+
+        rows = list(export_tickets(
+            datetime(2014, 5, 1), datetime(2014, 6, 2), batch_size=1))
+        assert [r[0] for r in rows] == [old, new]
+
+        lines = list(to_csv(rows))
+        assert lines[0].startswith('id,created_at,status')
+        assert lines[1].startswith('%s,2014-05-22T00:00:00,sent,' % old)
+        assert Decimal(json.loads(list(to_jsonl(rows))[1])['amount']) == 100
+
+    def test_admin(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        admin.init_app(app)
+        self.create_ticket(0)
+
+        url = url_for('export.index')
+        query = {'start': '2014-06-01', 'format': 'jsonl'}
+        assert client.get(url, query_string=query).status_code == 401
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        response = client.get(url, query_string=query, headers=auth)
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert len(response.data.splitlines()) == 1
+
+        response = client.get(url, query_string={'start': 'June'},
+                              headers=auth)
+        assert response.status_code == 400
+
+
+class TestStats:
+    """Test the statistics rollup."""
+
+    def create_ticket(self, status, created_at, failed=''):
+        ticket = Ticket(amount='100', fee='10')
+        ticket.status = status
+        ticket.failed = failed
+        ticket.created_at = created_at
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket
+
+    def test_refresh(self, app):
+        now = datetime(2014, 6, 1, 12, 30)
+        self.create_ticket('sent', datetime(2014, 6, 1, 10, 5))
+        self.create_ticket('received', datetime(2014, 6, 1, 10, 55))
+        self.create_ticket('quoted', datetime(2014, 6, 1, 11, 0),
+                           failed='unexpected')
+        self.create_ticket('sent', datetime(2014, 5, 1, 9, 0))
+        Ticket.archive_finished(0)
+        # Unpaid quotes are not counted, expired or not
+        self.create_ticket('quoted', datetime(2014, 6, 1, 11, 0))
+        self.create_ticket('quoted', datetime(2014, 6, 1, 11, 0),
+                           failed='expired')
+
+        assert stats.refresh(now=datetime.utcnow() + stats.LAG) == 3
+        day = stats.series('day', start=datetime(2014, 6, 1))
+        assert len(day) == 1
+        assert day[0]['count'] == 3
+        assert day[0]['failed'] == 1
+        assert Decimal(day[0]['amount']) == 200
+        assert Decimal(day[0]['fee']) == 20
+        hours = stats.series('hour', start=datetime(2014, 6, 1))
+        assert [h['count'] for h in hours] == [2, 1]
+        assert hours[0]['by_status'] == {
+            'sent': {'count': 1, 'failed': 0},
+            'received': {'count': 1, 'failed': 0}}
+
+        # Only the hour with a changed ticket is recomputed
+        received = Ticket.query.filter_by(status='received').one()
+        assert received.transition(('received',), 'sent')
+        db.session.commit()
+        assert stats.refresh(now=datetime.utcnow() + stats.LAG) == 1
+        hours = stats.series('hour', start=datetime(2014, 6, 1))
+        assert hours[0]['by_status'] == {'sent': {'count': 2, 'failed': 0}}
+
+        assert stats.rebuild() == 3
+
+    def test_admin(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        admin.init_app(app)
+        self.create_ticket('sent', datetime.utcnow())
+        stats.refresh()
+
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        assert client.get(url_for('stats.index')).status_code == 401
+        response = client.get(url_for('stats.index'), headers=auth)
+        assert response.status_code == 200
+        response = client.get(url_for('stats.json'), headers=auth,
+                              query_string={'period': 'hour'})
+        assert json.loads(response.data.decode('utf-8'))['stats'][0]['count'] == 1
+
+
+class TestLoadTest:
+    """Test the webhook load generator, against the test client."""
+
+    def test_replay(self, app, client):
+        app.config['RECEIPT_DEBUGGING'] = True
+        quotes = loadtest.seed_quotes(app, 20, Decimal('1.00'))
+        sends, expected = loadtest.plan(
+            quotes, duplicates=0.1, wrong_amount=0.1, unknown=0.1, seed=1)
+        kinds = Counter(kind for kind, id, body in sends)
+        assert kinds == {'payment': 18, 'wrong_amount': 2,
+                         'duplicate': 2, 'unknown': 2}
+
+        responses.add(
+            responses.POST, app.config['SEPA_API'],
+            body='{"success": true}', status=200)
+        # Answer errors with a 500, as in production.
+        app.config['PROPAGATE_EXCEPTIONS'] = False
+        refused = []
+        responses.start()
+        try:
+            with mock.patch.object(postmark.PMMail, 'send'):
+                for kind, id, body in sends:
+                    response = client.post(
+                        url_for('bridge.on_payment_received'),
+                        data=body, content_type='application/json')
+                    if response.status_code != 200:
+                        assert response.status_code == 500
+                        refused.append(id)
+            submissions = Counter(json.loads(call.request.body)['id']
+                                  for call in responses.calls)
+        finally:
+            responses.stop()
+            responses.reset()
+        assert loadtest.check(expected, submissions) == []
+        # Of the two deliveries of a notification, whichever came second
+        # was refused, without submitting the transfer again.
+        assert sorted(refused) == sorted(
+            id for kind, id, body in sends if kind == 'duplicate')
+
+        # A transfer submitted twice is reported
+        id = [i for i, kind in expected.items() if kind == 'payment'][0]
+        submissions[id[:35]] += 1
+        assert len(loadtest.check(expected, submissions)) == 1
+
+
+class TestSlowQueries:
+    """Test the slow query log."""
+
+    def test_normalize(self):
+        assert normalize(
+            "SELECT ticket.id FROM ticket\n  WHERE ticket.id IN "
+            "(%(id_1)s, %(id_2)s) AND status = 'sent' LIMIT 10") == \
+            "SELECT ticket.id FROM ticket WHERE ticket.id IN (?...) " \
+            "AND status = ? LIMIT ?"
+
+    def test_redact(self):
+        assert redact(
+            "Index Scan using ticket_pkey on ticket  "
+            "(cost=0.15..8.17 rows=1 width=32)\n"
+            "  Index Cond: ((id)::text = 'abc'::text)\n"
+            "  Filter: ((recipient_name)::text = 'O''Brien'::text)") == \
+            "Index Scan using ticket_pkey on ticket  " \
+            "(cost=0.15..8.17 rows=1 width=32)\n" \
+            "  Index Cond: ((id)::text = ?::text)\n" \
+            "  Filter: ((recipient_name)::text = ?::text)"
+
+    def test_record(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        admin.init_app(app)
+        slowlog = app.extensions['slow_queries']
+        slowlog.threshold = 0
+        client.get(url_for('bridge.index'))
+        client.get(url_for('bridge.index'))
+        slowlog.flush()
+        slowlog.threshold = 1000
+
+        query = SlowQuery.query.filter_by(view='bridge.index')\
+            .filter(SlowQuery.statement.like('SELECT%FROM ticket%'))
+        recorded = query.one()
+        assert recorded.count == 2
+        assert recorded.max_time <= recorded.total_time
+        assert recorded.plan
+
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        response = client.get(url_for('slowqueries.index_view'),
+                              headers=auth)
+        assert response.status_code == 200
+
+
+class TestTracing:
+    """Test request tracing."""
+
+    def test_spans(self):
+        tracer = tracing.Tracer()
+        with tracer.span('outside'):
+            pass
+        assert tracer.headers() == {}
+
+        root = tracer.start_trace(
+            'bridge.quote',
+            '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01')
+        assert root.trace_id == '0af7651916cd43dd8448eb211c80319c'
+        assert root.parent_id == 'b7ad6b7169203331'
+        with tracer.span('sepa.submit') as span:
+            assert tracer.headers() == {'traceparent': '00-%s-%s-01' % (
+                root.trace_id, span.span_id)}
+        with pytest.raises(ValueError):
+            with tracer.span('mail.send'):
+                raise ValueError('no mail today')
+        tracer.finish_trace()
+        assert tracer.headers() == {}
+
+        (total, by_name), = tracer.recent['bridge.quote']
+        assert set(by_name) == {'sepa.submit', 'mail.send'}
+        assert total >= sum(by_name.values())
+
+        # A malformed traceparent starts a new trace.
+        root = tracer.start_trace('bridge.quote', 'garbage')
+        assert len(root.trace_id) == 32 and root.parent_id is None
+        tracer.finish_trace()
+
+    def test_breakdown(self):
+        samples = [(0.01, {'db.query': 0.005})] * 90 + \
+                  [(1.0, {'db.query': 0.1, 'sepa.submit': 0.8})] * 10
+        stats = tracing.breakdown(samples)
+        assert stats['count'] == 100
+        assert stats['p50'] == 0.01
+        assert stats['p90'] == stats['p99'] == stats['max'] == 1.0
+        assert stats['tail'] == pytest.approx(
+            {'db.query': 0.1, 'sepa.submit': 0.8, 'other': 0.1})
+        assert tracing.breakdown([])['tail'] == {}
+
+    def test_trace_file(self, app, client, tmpdir):
+        path = str(tmpdir.join('traces.jsonl'))
+        tracer = app.extensions['tracer']
+        tracer.exporter = tracing.FileExporter(path)
+        client.get(url_for('bridge.index'), headers={
+            'traceparent':
+                '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'})
+        for i in range(50):
+            if os.path.exists(path) and open(path).read().endswith('\n'):
+                break
+            time.sleep(0.01)
+
+        with open(path) as f:
+            line = f.read()
+        spans = json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        assert {s['traceId'] for s in spans} == \
+            {'0af7651916cd43dd8448eb211c80319c'}
+        root = [s for s in spans if s['kind'] == 2][0]
+        assert root['name'] == 'bridge.index'
+        assert root['parentSpanId'] == 'b7ad6b7169203331'
+        assert 'db.query' in {s['name'] for s in spans}
+
+        samples = tracing.load_samples(io.StringIO(line))
+        assert list(samples) == ['bridge.index']
+
+    def test_admin(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        admin.init_app(app)
+        client.get(url_for('bridge.index'))
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        response = client.get(url_for('traces.index'), headers=auth)
+        assert response.status_code == 200
+        assert b'bridge.index' in response.data
+
+
+class TestReconcile:
+    """Test matching bank statements against sent tickets."""
+
+    CAMT = '''<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+<BkToCstmrStmt><Stmt>
+  <Ntry><Amt Ccy="EUR">100.00</Amt><CdtDbtInd>DBIT</CdtDbtInd>
+    <NtryDtls><TxDtls><Refs><EndToEndId>{ref}</EndToEndId></Refs></TxDtls></NtryDtls>
+  </Ntry>
+  <Ntry><Amt Ccy="EUR">5.00</Amt><CdtDbtInd>DBIT</CdtDbtInd>
+    <NtryDtls><TxDtls><Refs><EndToEndId>UNKNOWN</EndToEndId></Refs></TxDtls></NtryDtls>
+  </Ntry>
+  <Ntry><Amt Ccy="EUR">100.00</Amt><CdtDbtInd>CRDT</CdtDbtInd>
+    <NtryDtls><TxDtls><Refs><EndToEndId>{ref}</EndToEndId></Refs></TxDtls></NtryDtls>
+  </Ntry>
+</Stmt></BkToCstmrStmt>
+</Document>'''
+
+    def create_ticket(self, status='sent'):
+        ticket = Ticket(amount=Decimal('100'), fee=Decimal('10'))
+        ticket.status = status
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+    def test_camt053(self, app):
+        sent, other = self.create_ticket(), self.create_ticket()
+        statement = self.CAMT.format(ref=sent[:35]).encode('utf-8')
+        assert list(parse_camt053(io.BytesIO(statement))) == [
+            (sent[:35], '100.00'), ('UNKNOWN', '5.00')]
+
+        unmatched = []
+        counts = reconcile(parse_camt053(io.BytesIO(statement)),
+                           on_unmatched=lambda *a: unmatched.append(a[0]))
+        assert counts == {'matched': 1, 'unmatched': 1}
+        assert unmatched == ['UNKNOWN']
+        assert Ticket.query.get(sent).status == 'confirmed'
+        assert Ticket.query.get(other).status == 'sent'
+
+    def test_csv(self, app):
+        sent, received = self.create_ticket(), self.create_ticket('received')
+        statement = io.StringIO(
+            'reference,amount\n%s,-100.00\n%s,100.00\n%s,100.00\n' % (
+                sent[:35], received[:35], sent[:35]))
+        counts = reconcile(parse_csv(statement))
+        # The second entry for the same ticket is not matched again.
+        assert counts == {'matched': 1, 'unmatched': 2}
+        assert Ticket.query.get(sent).status == 'confirmed'
+        assert Ticket.query.get(received).status == 'received'
+
+    def test_batches(self, app):
+        ids = [self.create_ticket() for i in range(3)]
+        entries = [(id[:35], '100.00') for id in ids] * 2 + \
+            [('%035x' % i, '1.00') for i in range(1000)]
+        parameters = []
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, params, context, executemany):
+            parameters.append(len(params))
+        try:
+            counts = reconcile(entries, batch_size=1000)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        assert counts == {'matched': 3, 'unmatched': 1003}
+        assert all(Ticket.query.get(id).status == 'confirmed' for id in ids)
+        # Within SQLite's limit of bound parameters per statement
+        assert max(parameters) <= 999
+
+
+class TestStatusCallback:
+    """Test bulk status updates pushed by the SEPA backend."""
+
+    def create_ticket(self, status):
+        ticket = Ticket(amount='100', fee='10')
+        ticket.status = status
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+    def post(self, client, updates, auth='secret'):
+        return client.post(
+            url_for('bridge.on_status_update'),
+            data=json.dumps({'updates': updates}),
+            content_type='application/json',
+            headers={'Authorization': auth})
+
+    def test_auth(self, app, client):
+        assert self.post(client, []).status_code == 401
+        app.config['SEPA_CALLBACK_AUTH'] = 'secret'
+        assert self.post(client, [], auth='wrong').status_code == 401
+        assert self.post(client, []).status_code == 200
+
+    def test_updates(self, app, client):
+        app.config['SEPA_CALLBACK_AUTH'] = 'secret'
+        sent, failing, quoted = [self.create_ticket(s) for s in
+                                 ('sent', 'sending', 'quoted')]
+
+        changed = []
+        def listener(sender, ids):
+            changed.extend(ids)
+        tickets_changed.connect(listener)
+        try:
+            response = self.post(client, [
+                {'id': sent[:35], 'status': 'confirmed'},
+                {'id': failing[:35], 'failed': 'rejected'},
+                {'id': quoted[:35], 'status': 'confirmed'},
+            ])
+        finally:
+            tickets_changed.disconnect(listener)
+
+        assert json.loads(response.data.decode('utf8')) == {
+            'updated': 2, 'ignored': 1}
+        assert sorted(changed) == sorted([sent, failing])
+        assert Ticket.query.get(sent).status == 'confirmed'
+        assert Ticket.query.get(failing).failed == 'rejected'
+        assert Ticket.query.get(quoted).status == 'quoted'
+
+        # Unknown statuses are rejected
+        assert self.post(client, [
+            {'id': sent[:35], 'status': 'quoted'}]).status_code == 400
+        for update in ({'id': 35, 'status': 'confirmed'},
+                       {'id': sent[:35], 'failed': ['rejected']}):
+            assert self.post(client, [update]).status_code == 400
+
+    def test_many_updates(self, app, client):
+        """More references than SQLite takes parameters in a statement"""
+        app.config['SEPA_CALLBACK_AUTH'] = 'secret'
+        ids = [self.create_ticket('sent') for i in range(3)]
+        updates = [{'id': '%035x' % i, 'status': 'confirmed'}
+                   for i in range(1000)]
+        updates += [{'id': id[:35], 'status': 'confirmed'} for id in ids]
+        parameters = []
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, params, context, executemany):
+            parameters.append(len(params))
+        try:
+            response = self.post(client, updates)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        assert response.status_code == 200
+        assert max(parameters) <= 999
+        assert json.loads(response.data.decode('utf8')) == {
+            'updated': 3, 'ignored': 1000}
+
+    def test_update_uses_index(self, app):
+        ticket = self.create_ticket('sent')
+        statements = []
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.get_engine(app), 'before_cursor_execute', listener)
+        try:
+            assert Ticket.bulk_update(
+                [ticket[:35].upper(), 'short'], ('sent',),
+                status='confirmed') == [ticket]
+        finally:
+            event.remove(db.get_engine(app), 'before_cursor_execute', listener)
+        assert not [s for s in statements if 'substr' in s.lower()]
+        assert len([s for s in statements if s.startswith('UPDATE')]) == 1
+
+
+class TestBulkActions:
+    """Test the admin's set-based bulk actions."""
+
+    def create_ticket(self, status, failed=None, text='outage'):
+        ticket = Ticket(amount='100', fee='10', name='A User',
+                        bic='DABADKKK', iban='GB82WEST12345698765432',
+                        text=text)
+        ticket.status, ticket.failed = status, failed
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+    def test_guards(self, app):
+        quoted, received, sent = [self.create_ticket(s) for s in
+                                  ('quoted', 'received', 'sent')]
+        ids = Ticket.id.in_([quoted, received, sent])
+
+        updates = []
+        def listener(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE'):
+                updates.append(statement.split()[1])
+        event.listen(db.get_engine(app), 'before_cursor_execute', listener)
+        try:
+            assert bulk_action('cancel', ids) == 2
+        finally:
+            event.remove(db.get_engine(app), 'before_cursor_execute', listener)
+        # One for the tickets, one to stop their retries.
+        assert updates == ['submission_retry', 'ticket']
+        assert Ticket.query.get(quoted).failed == 'cancelled'
+        assert Ticket.query.get(sent).failed is None
+
+        assert bulk_action('fail', ids) == 1
+        assert Ticket.query.get(sent).failed == 'manual'
+        assert bulk_action('clear', ids) == 3
+        assert Ticket.query.get(received).iban == ''
+
+    def test_admin(self, app, client):
+        app.config['ADMIN_AUTH'] = {'admin': 'secret'}
+        app.secret_key = 'test'
+        admin.init_app(app)
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        given_up = self.create_ticket('received', failed='backend')
+        no_hash = self.create_ticket('received', failed='manual')
+        stuck = self.create_ticket('sending')
+        rejected = self.create_ticket('sent', failed='rejected')
+        waiting = self.create_ticket('received')
+        other = self.create_ticket('received', failed='backend',
+                                   text='unrelated')
+        cancelled = self.create_ticket('received', failed='cancelled')
+        for id in (given_up, other, cancelled):
+            db.session.add(SubmissionRetry(
+                ticket_id=id, tx_hash='hash-%s' % id, attempts=20))
+        db.session.commit()
+
+        response = client.get(url_for('ticketview.index_view'), headers=auth)
+        assert b'Apply to all 7 matching' in response.data
+
+        # Everything the search matches, across pages; only what the
+        # backend verifiably does not have, with the payment's hash.
+        changed = []
+        def listener(sender, ids):
+            changed.extend(ids)
+        tickets_changed.connect(listener)
+        try:
+            response = client.post(
+                url_for('ticketview.bulk_view'),
+                query_string={'search': 'outage'},
+                data={'action': 'requeue'}, headers=auth)
+        finally:
+            tickets_changed.disconnect(listener)
+        assert response.status_code == 302
+        assert 'search=outage' in response.headers['Location']
+        assert changed == [given_up]
+        ticket = Ticket.query.get(given_up)
+        assert (ticket.status, ticket.failed) == ('received', None)
+        retry = SubmissionRetry.query.get(given_up)
+        assert retry.tx_hash == 'hash-%s' % given_up
+        assert retry.attempts == 0 and retry.due_at <= datetime.utcnow()
+        assert SubmissionRetry.query.get(no_hash) is None
+        assert Ticket.query.get(no_hash).failed == 'manual'
+        assert Ticket.query.get(stuck).status == 'sending'
+        assert Ticket.query.get(rejected).failed == 'rejected'
+        assert SubmissionRetry.query.get(other).due_at is None
+        assert Ticket.query.get(cancelled).failed == 'cancelled'
+        assert SubmissionRetry.query.get(cancelled).due_at is None
+
+        # The selected ones.
+        client.post(url_for('ticketview.action_view'), headers=auth,
+                    data={'action': 'fail', 'rowid': [stuck, waiting]})
+        assert Ticket.query.get(stuck).failed == 'manual'
+        assert Ticket.query.get(waiting).failed == 'manual'
+
+        assert client.post(
+            url_for('alltickets.bulk_view'), data={'action': 'clear'},
+            headers=auth).status_code == 403
+        assert client.post(
+            url_for('ticketview.bulk_view'), data={'action': 'drop'},
+            headers=auth).status_code == 400
+
+
+class TestStatusEvents:
+    """Test the live ticket status stream."""
+
+    def create_ticket(self, status):
+        ticket = Ticket(amount='100', fee='10')
+        ticket.status = status
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket
+
+    def test_broadcast(self, app):
+        ticket, other = self.create_ticket('received'), self.create_ticket('received')
+        broadcaster = app.extensions['status_events'].broadcaster
+        subscription = broadcaster.subscribe([ticket.id])
+
+        ticket.status = other.status = 'sent'
+        db.session.commit()
+        change = subscription.get(timeout=1)
+        assert change['id'] == ticket.id
+        assert change['status'] == 'sent'
+        assert change['text'] == 'SEPA transfer executed'
+        assert subscription.queue.empty()
+
+        # Nothing is sent for changes that are rolled back
+        ticket.status = 'confirmed'
+        db.session.flush()
+        db.session.rollback()
+        assert subscription.queue.empty()
+
+    def test_poll(self, app, client):
+        ticket = self.create_ticket('received')
+        response = client.get(url_for('bridge.events'),
+                              query_string={'tickets': ticket.id})
+        data = response.get_data().decode('utf8')
+        assert data.startswith('retry: 10000')
+        assert '"status": "received"' in data
+
+        # Not every ticket at once.
+        assert client.get(url_for('bridge.events')).status_code == 400
+        app.config['EVENTS_MAX_TICKETS'] = 1
+        assert client.get(url_for('bridge.events'), query_string={
+            'tickets': 'a,b'}).status_code == 400
+
+    def test_stream(self, app, client):
+        app.config['EVENTS_STREAM_TIMEOUT'] = 0.1
+        ticket = self.create_ticket('received')
+        response = client.get(url_for('bridge.events'),
+                              query_string={'tickets': ticket.id},
+                              buffered=False)
+
+        ticket.status = 'sent'
+        db.session.commit()
+        data = response.get_data().decode('utf8')
+        assert '"status": "received"' in data
+        assert '"status": "sent"' in data
+
 
 class TestWasIPaidNotifications:
     """Test incoming payment notifications on the bridge account."""
@@ -278,7 +1722,7 @@ class TestWasIPaidNotifications:
 
         # Validate the call to the SEPA API
         assert len(responses.calls) == 2
-        data_sent = json.loads(responses.calls[1].request.body, True)
+        data_sent = json.loads(responses.calls[1].request.body)
         assert data_sent['name'] == 'A User'
         assert data_sent['iban'] == 'IBAN'
         assert data_sent['bic'] == 'BIC'
@@ -288,12 +1732,308 @@ class TestWasIPaidNotifications:
         # assigned the sending ripple address.
         assert ticket.status == 'sent'
         assert ticket.ripple_address == 'rsender'
+        assert ticket.paid_at >= ticket.created_at
         assert ticket.iban == ''
         assert ticket.bic == ''
         assert ticket.text == ''
         assert ticket.recipient_name == ''
 
-    # TODO: Test the SEPA_API backend call failing.
+    def test_late_payment(self, client):
+        """A quote paid after it expired is still found, and sent."""
+        ticket = self.create_ticket()
+        ticket_id = ticket.id
+        ticket.created_at -= timedelta(hours=2)
+        db.session.commit()
+        assert LimitBudget.release_expired() == 1
+
+        response = client.post(
+            url_for('bridge.on_payment_received'),
+            data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+            content_type='application/json')
+        assert response.status_code == 200
+        ticket = Ticket.query.get(ticket_id)
+        assert (ticket.status, ticket.failed) == ('sent', None)
+        # Its amount counts against the limits again.
+        today = datetime.utcnow().date()
+        assert LimitBudget.query.get((today, LimitBudget.BRIDGE)).used == 10000
+
+    def test_late_payment_refused(self, app, client):
+        """Late payments over the limits, or for quotes cleared after
+        expiring, are not sent.
+        """
+        over, cleared = self.create_ticket(), self.create_ticket()
+        ids = over.id, cleared.id
+        over.created_at -= timedelta(hours=2)
+        cleared.created_at -= timedelta(days=8)
+        db.session.commit()
+        assert LimitBudget.release_expired() == 2
+        assert Ticket.clear_expired(7) == 1
+
+        app.config['BRIDGE_TX_LIMIT'] = Decimal(50)
+        for id in ids:
+            response = client.post(
+                url_for('bridge.on_payment_received'),
+                data=self.wasipaid_tx('110', 'EUR', invoice_id=id),
+                content_type='application/json')
+            assert response.status_code == 200
+            assert Ticket.query.get(id).failed == 'expired'
+        assert len(responses.calls) == 2
+        assert len(postmark.PMMail.send.mock_calls) == 2
+
+    def test_expired_meanwhile(self, client):
+        """A quote that expires after the webhook loaded it is sent
+        without its failure, and reserved again.
+        """
+        ticket = self.create_ticket()
+        Ticket.query.filter_by(id=ticket.id)\
+            .update({'failed': 'expired'}, synchronize_session=False)
+        assert ticket.failed is None
+        assert accept_payment(ticket, 'sending', 'rsender') is None
+        assert (ticket.status, ticket.failed) == ('sending', None)
+        assert LimitBudget.query.all()
+
+    def test_cancelled_payment(self, client):
+        """A payment for a cancelled quote is not sent."""
+        ticket = self.create_ticket()
+        ticket_id = ticket.id
+        assert bulk_action('cancel', Ticket.id == ticket_id) == 1
+
+        response = client.post(
+            url_for('bridge.on_payment_received'),
+            data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+            content_type='application/json')
+        assert response.status_code == 200
+        assert len(responses.calls) == 1
+        ticket = Ticket.query.get(ticket_id)
+        assert (ticket.status, ticket.failed) == ('quoted', 'cancelled')
+        assert len(postmark.PMMail.send.mock_calls) == 1
+
+        # Nor if it was cancelled after we looked at it.
+        ticket = self.create_ticket()
+        Ticket.query.filter_by(id=ticket.id)\
+            .update({'failed': 'cancelled'}, synchronize_session=False)
+        assert not ticket.transition(
+            ('quoted', 'received'), 'sending', NOT_FAILED)
+
+    def test_traced(self, app, client):
+        """The payment is traced, and the trace continued upstream."""
+        ticket = self.create_ticket()
+        response = client.post(
+            url_for('bridge.on_payment_received'),
+            data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket.id),
+            content_type='application/json')
+        assert response.status_code == 200
+
+        (total, by_name), = \
+            app.extensions['tracer'].recent['bridge.on_payment_received']
+        assert {'wasipaid.receipt', 'sepa.submit', 'db.query',
+                'db.commit'} <= set(by_name)
+        parents = [call.request.headers['traceparent']
+                   for call in responses.calls]
+        assert len(parents) == 2
+        assert parents[0].split('-')[1] == parents[1].split('-')[1]
+        assert parents[0] != parents[1]
+
+    def test_cross_currency_payment(self, client):
+        """Tickets quoted in another currency want it paid in that."""
+        ticket = self.create_ticket()
+        ticket.currency, ticket.send_amount = 'XRP', Decimal('27500')
+        db.session.commit()
+
+        client.post(url_for('bridge.on_payment_received'),
+                    data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket.id),
+                    content_type='application/json')
+        assert Ticket.query.get(ticket.id).failed == 'unexpected'
+
+        ticket = self.create_ticket()
+        ticket.currency, ticket.send_amount = 'XRP', Decimal('27500')
+        db.session.commit()
+        client.post(url_for('bridge.on_payment_received'),
+                    data=self.wasipaid_tx('27500', 'XRP', invoice_id=ticket.id),
+                    content_type='application/json')
+        ticket = Ticket.query.get(ticket.id)
+        assert ticket.status == 'sent' and not ticket.failed
+
+    def test_commits(self, client):
+        """A payment is recorded and processed in two commits; requests
+        that change nothing do not commit at all.
+        """
+        ticket = self.create_ticket()
+        commits = []
+        listener = lambda session: commits.append(session)
+        event.listen(RoutingSession, 'after_commit', listener)
+        try:
+            client.get(url_for('bridge.index'))
+            assert len(commits) == 0
+
+            client.post(
+                url_for('bridge.on_payment_received'),
+                data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket.id),
+                content_type='application/json')
+            assert len(commits) == 2
+        finally:
+            event.remove(RoutingSession, 'after_commit', listener)
+        assert ticket.status == 'sent'
+
+        # A second notification for the same ticket is not processed
+        assert not ticket.transition(('quoted', 'received'), 'sending')
+
+    def test_backend_failure(self, app, client):
+        """If the SEPA backend does not accept the transfer, we accept
+        the notification and retry the submission ourselves.
+        """
+        ticket = self.create_ticket()
+        ticket_id = ticket.id
+        responses.reset()
+        responses.add(
+            responses.POST, 'https://wasipaid.com/receipt',
+            body='VALID', status=200)
+        responses.add(
+            responses.POST, app.config['SEPA_API'],
+            body='{"error": "unavailable"}', status=200)
+
+        response = client.post(
+            url_for('bridge.on_payment_received'),
+            data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+            content_type='application/json')
+        assert response.status_code == 200
+        assert ticket.status == 'received'
+        assert ticket.iban == 'IBAN'
+        retry = SubmissionRetry.query.get(ticket_id)
+        assert retry.tx_hash == 'foo'
+        assert 'unavailable' in retry.last_error
+
+        # The retry fails again, and is pushed back
+        scheduler = RetryScheduler(app)
+        scheduler.attempt(ticket_id)
+        retry = SubmissionRetry.query.get(ticket_id)
+        assert retry.attempts == 1
+        assert retry.due_at > datetime.utcnow()
+        assert Ticket.query.get(ticket_id).status == 'received'
+
+        # Once the backend is back, the transfer goes through
+        responses.reset()
+        responses.add(
+            responses.POST, app.config['SEPA_API'],
+            body='{"success": true}', status=200)
+        scheduler.attempt(ticket_id)
+        assert not SubmissionRetry.query.get(ticket_id)
+        ticket = Ticket.query.get(ticket_id)
+        assert ticket.status == 'sent'
+        assert ticket.iban == ''
+
+    def test_backend_gives_up(self, app):
+        """When the retries run out, the ticket fails, and the hash of
+        its payment is kept for a re-queue.
+        """
+        ticket = self.create_ticket()
+        ticket_id = ticket.id
+        ticket.status = 'received'
+        SubmissionRetry.schedule(ticket, 'foo', 'unavailable')
+        db.session.commit()
+        responses.reset()
+        responses.add(
+            responses.POST, app.config['SEPA_API'],
+            body='{"error": "unavailable"}', status=200)
+
+        app.config['RETRY_MAX_ATTEMPTS'] = 1
+        RetryScheduler(app).attempt(ticket_id)
+        assert Ticket.query.get(ticket_id).failed == 'backend'
+        retry = SubmissionRetry.query.get(ticket_id)
+        assert retry.tx_hash == 'foo' and retry.due_at is None
+
+        assert bulk_action('requeue', Ticket.id == ticket_id) == 1
+        assert SubmissionRetry.query.get(ticket_id).due_at is not None
+
+    def test_cancelled_retry(self, app):
+        """Tickets failed or cancelled in the admin are not retried."""
+        responses.reset()
+        responses.add(
+            responses.POST, app.config['SEPA_API'],
+            body='{"success": true}', status=200)
+        ids = []
+        for i in range(2):
+            ticket = self.create_ticket()
+            ticket.status = 'received'
+            SubmissionRetry.schedule(ticket, 'foo', 'unavailable')
+            ids.append(ticket.id)
+        db.session.commit()
+
+        assert bulk_action('cancel', Ticket.id == ids[0]) == 1
+        assert SubmissionRetry.query.get(ids[0]).due_at is None
+        # Failed behind the worker's back.
+        Ticket.query.filter_by(id=ids[1])\
+            .update({'failed': 'manual'}, synchronize_session=False)
+        db.session.commit()
+
+        scheduler = RetryScheduler(app)
+        assert scheduler.run_once() == 0
+        scheduler.attempt(ids[1])
+        assert len(responses.calls) == 0
+        assert Ticket.query.get(ids[1]).status == 'received'
+
+    def test_backend_unknown(self, app, client):
+        """Failures after the transfer may have reached the backend are
+        not retried, but left in sending for manual review.
+        """
+        app.config['RECEIPT_DEBUGGING'] = True
+        cases = [
+            # How the pinned requests 2.4 reports a refused connection
+            (ConnectionError(ProtocolError('Connection aborted.',
+                ConnectionRefusedError(errno.ECONNREFUSED, 'refused'))),
+             'received'),
+            (ReadTimeout('read timed out'), 'sending'),
+            (ConnectionError(ProtocolError('connection reset')), 'sending'),
+        ]
+        for error, status in cases:
+            ticket_id = self.create_ticket().id
+            postmark.PMMail.send.reset_mock()
+            with mock.patch('requests.post', side_effect=error):
+                response = client.post(
+                    url_for('bridge.on_payment_received'),
+                    data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+                    content_type='application/json')
+            assert response.status_code == 200
+            assert Ticket.query.get(ticket_id).status == status
+            retry = SubmissionRetry.query.get(ticket_id)
+            assert (retry is not None) == (status == 'received')
+            assert len(postmark.PMMail.send.mock_calls) == \
+                (status == 'sending')
+
+        # A backend that is down, on a port nothing listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        app.config['SEPA_API'] = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        sock.close()
+        ticket_id = self.create_ticket().id
+        responses.stop()
+        try:
+            response = client.post(
+                url_for('bridge.on_payment_received'),
+                data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+                content_type='application/json')
+        finally:
+            responses.start()
+        assert response.status_code == 200
+        assert Ticket.query.get(ticket_id).status == 'received'
+        assert SubmissionRetry.query.get(ticket_id) is not None
+        app.config['SEPA_API'] = 'http://sepa/'
+
+        # A gateway error is no refusal either.
+        ticket_id = self.create_ticket().id
+        responses.reset()
+        responses.add(responses.POST, app.config['SEPA_API'],
+                      body='Bad Gateway', status=502)
+        client.post(
+            url_for('bridge.on_payment_received'),
+            data=self.wasipaid_tx('110', 'EUR', invoice_id=ticket_id),
+            content_type='application/json')
+        assert Ticket.query.get(ticket_id).status == 'sending'
+
+    def test_backoff(self):
+        assert 15 <= backoff(0, 30, 3600) <= 45
+        assert 120 <= backoff(3, 30, 3600) <= 360
+        assert backoff(20, 30, 3600) <= 5400
 
     def test_correct_payment_send_email(self, client):
         # With no SEPA backend configured, we will simply send out
@@ -334,6 +2074,21 @@ class TestWasIPaidNotifications:
         # Test that an email was sent to postmark
         assert len(postmark.PMMail.send.mock_calls) == 1
 
+    def test_unknown_destination(self, client):
+        """A payment to an account that is not ours is not processed."""
+        ticket = self.create_ticket()
+        tx = json.loads(self.wasipaid_tx('110', 'EUR', invoice_id=ticket.id))
+        tx['data']['destination'] = 'rUnknown'
+        response = client.post(
+            url_for('bridge.on_payment_received'),
+            data=json.dumps(tx), content_type='application/json')
+        assert response.status_code == 200
+
+        # Validate only wasipaid was called, not the SEPA API
+        assert len(responses.calls) == 1
+        assert ticket.status == 'quoted'
+        assert len(postmark.PMMail.send.mock_calls) == 1
+
     def test_incorrect_ticket(self, client):
         """Assume a payment that has no matching ticket."""
         response = client.post(
@@ -446,3 +2201,80 @@ class TestLimits:
         assert response.status_code == 200
         result = json.loads(response.data.decode('utf8'))
         assert result['quote']
+
+    def test_reservation(self, app):
+        """Quotes reserve their amount until they expire."""
+        limits = [('GB82WEST12345698765432', Decimal(100)),
+                  (LimitBudget.BRIDGE, Decimal(150))]
+        assert LimitBudget.reserve(Decimal('60.50'), limits) is None
+        db.session.commit()
+        # The IBAN limit is reached, not changing the bridge budget
+        assert LimitBudget.reserve(Decimal(40), limits) == \
+            'GB82WEST12345698765432'
+        assert LimitBudget.query.get(
+            (datetime.utcnow().date(), LimitBudget.BRIDGE)).used == 6050
+
+        # An expired quote gives its reservation back
+        ticket = self.create_ticket('quoted', Decimal('60.50'), 0,
+                                    iban='GB82WEST12345698765432')
+        ticket.created_at -= timedelta(hours=2)
+        db.session.commit()
+        assert LimitBudget.release_expired() == 1
+        assert LimitBudget.release_expired() == 0
+        ticket = Ticket.query.one()
+        assert ticket.failed == 'expired'
+        assert ticket.iban == 'GB82WEST12345698765432'
+        assert LimitBudget.reserve(Decimal(40), limits) is None
+
+        # Until it is cleared, and archived, after a grace period
+        db.session.commit()
+        assert Ticket.clear_expired(7) == 0
+        ticket.created_at -= timedelta(days=8)
+        db.session.commit()
+        assert Ticket.clear_expired(7) == 1
+        assert Ticket.query.one().iban == ''
+        assert Ticket.archive_finished(7) == 1
+
+    @pytest.mark.parametrize('database', ['sqlite', 'postgres'])
+    def test_concurrent_reservations(self, tmpdir, database):
+        """Many workers reserving at once cannot exceed the limit."""
+        if database == 'postgres':
+            uri = os.environ.get('TEST_POSTGRES_URI')
+            if not uri:
+                pytest.skip('TEST_POSTGRES_URI is not set')
+        else:
+            uri = 'sqlite:///%s' % tmpdir.join('db')
+        app = create_app(config={
+            'SQLALCHEMY_DATABASE_URI': uri,
+            'BRIDGE_ADDRESS': 'rNrvihhhjDu6xmAzJBiKmEZDkjdYufh8s4',
+            'POSTMARK_KEY': 'foobar',
+            'POSTMARK_SENDER': 'admin@foo.bar',
+        })
+        with app.app_context():
+            LimitBudget.query.delete()
+            db.session.commit()
+        limits = [(LimitBudget.BRIDGE, Decimal(100))]
+        reserved = []
+
+        def worker():
+            # Until the limit is reached, so that the total is known.
+            with app.app_context():
+                for i in range(100):
+                    try:
+                        if LimitBudget.reserve(Decimal(10), limits):
+                            break
+                        db.session.commit()
+                        reserved.append(10)
+                    except OperationalError:
+                        # SQLite gave up waiting for the lock; try again.
+                        db.session.rollback()
+
+        threads = [threading.Thread(target=worker) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sum(reserved) == 100
+        with app.app_context():
+            assert LimitBudget.query.one().used == 10000